@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+from calibration.FileTools import hashFile
+
+""" AnalysisCache class.
+
+    On-disk cache of the results of the PandoraAnalysis calibrators.
+    A cache entry is keyed on :
+     - the calibrator name and the backend (binary or native) running the analysis
+     - the content hash of the binary (binary backend), so that a rebuilt binary invalidates its entries
+     - the content hash of the input files (root files, lcio files for the native mip extraction)
+     - the arguments of the analysis (region, cos(theta) range, energy, ...), output paths excluded
+    Each entry is a json file <cacheDir>/<key>.json containing the outputs of the calibrator.
+"""
+class AnalysisCache(object):
+    def __init__(self, cacheDir):
+        self._cacheDir = os.path.abspath(cacheDir)
+        self._logger = logging.getLogger("analysisCache")
+        self._fingerprints = {}
+
+        if not os.path.isdir(self._cacheDir):
+            os.makedirs(self._cacheDir)
+
+    def cacheDir(self):
+        return self._cacheDir
+
+    """ Compute the cache key of an analysis. The executable is the binary running the analysis, if any
+    """
+    def createKey(self, name, backend, inputFiles, arguments, executable=None):
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps({
+            "name" : name,
+            "backend" : backend,
+            "executable" : self._fingerprint(executable) if executable and os.path.isfile(executable) else executable,
+            "inputs" : [self._fingerprint(f) for f in inputFiles],
+            "arguments" : arguments}, sort_keys=True))
+        return sha1.hexdigest()
+
+    """ Get the outputs stored in a cache entry. Returns None if the entry doesn't exist
+    """
+    def get(self, key):
+        entryFile = self._entryFile(key)
+
+        if not os.path.isfile(entryFile):
+            return None
+
+        with open(entryFile) as f:
+            entry = json.load(f)
+
+        self._logger.debug("Analysis cache hit {0} (created {1})".format(key, time.ctime(entry["created"])))
+        return entry["outputs"]
+
+    """ Store the outputs of an analysis (output name -> json serializable value)
+    """
+    def store(self, key, outputs, metadata=None):
+        entry = dict(metadata) if metadata else {}
+        entry.update({"key" : key, "created" : time.time(), "outputs" : outputs})
+
+        # write then rename : concurrent analyses never see a partial entry
+        fd, tmpFile = tempfile.mkstemp(dir=self._cacheDir, suffix=".tmp")
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f, indent=2, sort_keys=True)
+
+        os.rename(tmpFile, self._entryFile(key))
+        self._logger.debug("Stored analysis outputs in cache entry {0}".format(key))
+
+    """ Remove a cache entry
+    """
+    def invalidate(self, key):
+        try:
+            os.remove(self._entryFile(key))
+        except OSError:
+            pass
+
+    """ Remove all the cache entries
+    """
+    def clear(self):
+        for fname in os.listdir(self._cacheDir):
+            if fname.endswith(".json"):
+                self.invalidate(fname[:-len(".json")])
+
+    def _entryFile(self, key):
+        return os.path.join(self._cacheDir, key + ".json")
+
+    def _fingerprint(self, fname):
+        path = os.path.realpath(fname)
+        stat = os.stat(path)
+        cacheKey = (path, stat.st_size, stat.st_mtime)
+
+        if cacheKey not in self._fingerprints:
+            self._fingerprints[cacheKey] = hashFile(path)
+
+        return self._fingerprints[cacheKey]
@@ -2,13 +2,21 @@
 """
 
 from calibration.Marlin import Marlin
+from calibration.MarlinCache import MarlinCache
+from calibration.AnalysisCache import AnalysisCache
+from calibration.Convergence import convergenceStrategies
+from calibration.ProcessExecutor import getExecutor
+from calibration.Workspace import getWorkspace
 from calibration.PandoraAnalysis import *
 from calibration.FileTools import *
-from calibration.GeometryInterface import DDGeometryInterface as GeometryInterface
+from calibration.GeometryInterface import DDGeometryInterface, CachedGeometryInterface
+from calibration.GearConverter import GearConverter
+from calibration.StepScheduler import StepScheduler
 import os, sys
 from calibration.XmlTools import *
 import argparse
 import logging
+import threading
 
 
 class CalibrationManager(object) :
@@ -21,6 +29,8 @@ class CalibrationManager(object) :
         self._endStep = sys.maxint
         self._badRun = False
         self._runException = None
+        self._maxParallelSteps = 1
+        self._workspace = getWorkspace()
         
         # Preconfigure logging before any other thing...
         # Use a specific argparser for that
@@ -44,6 +54,9 @@ class CalibrationManager(object) :
         
         self._logger = logging.getLogger("calibrationMgr")
         self._geometry = None
+        self._compactFile = None
+        self._geometryCacheDir = None
+        self._geometryLock = threading.Lock()
         self._argparser = argparse.ArgumentParser("Calibration runner:", formatter_class=argparse.RawTextHelpFormatter, add_help=True)
         self._getDefaultArgs(self._argparser)
 
@@ -97,8 +110,62 @@ class CalibrationManager(object) :
                                 help="The input muon energy (unit GeV)", required = False)
         parser.add_argument("--pandoraSettings", action="store", default="PandoraSettingsDefault.xml",
                                 help="The pandora settings XML file", required = ("pandoraSettings" in requiredArgs))
+        parser.add_argument("--convergenceStrategy", action="store", default="fixedPoint", choices=sorted(convergenceStrategies.keys()),
+                                help="The strategy used to compute the calibration constants of the next iteration in iterative steps (default fixedPoint)", required = False)
+        parser.add_argument("--bracketScales", action="store", default="",
+                                help="Comma separated list of candidate scales of the input constants (i.e 0.95,1,1.05) run concurrently at the first iteration of iterative steps (default none)", required = False)
+        parser.add_argument("--bracketSinglePass", action="store_true",
+                                help="Evaluate the bracket candidates in a single Marlin job by cloning the modified processor chain", required = False)
+        parser.add_argument("--pruneProcessors", action="store_true",
+                                help="Turn off the Marlin processors not needed by the steps, from the collection dataflow of the steering file", required = False)
+        parser.add_argument("--regionSkimDirectory", action="store", default="",
+                                help="The directory of the region skim files. If set, the ecal/hcal energy steps split their input in detector regions once and only process the regions still to calibrate", required = False)
+        parser.add_argument("--eventSchedule", action="store", default="",
+                                help="Comma separated list of the number of events processed by the successive iterations of iterative steps (i.e 1000,5000). The next iterations use the full statistics (default : full statistics)", required = False)
+        parser.add_argument("--marlinShards", action="store", type=int, default=1,
+                                help="The number of Marlin processes sharing the events of a reconstruction pass (default 1)", required = False)
+        parser.add_argument("--marlinCacheDir", action="store", default="",
+                                help="The directory where the Marlin outputs are cached and reused for identical runs (default : no cache)", required = False)
+        parser.add_argument("--clearMarlinCache", action="store_true", default=False,
+                                help="Invalidate all the Marlin cache entries before running", required = False)
+        parser.add_argument("--marlinOverlay", action="store_true", default=False,
+                                help="Write the Marlin steering file once per step and pass the parameters modified by the iterations as Marlin command line overrides", required = False)
+        parser.add_argument("--marlinCheckpointDir", action="store", default="",
+                                help="The directory of the Marlin checkpoints. If set, the processors upstream of the ones modified by iterative steps are run only once and their outputs are read back from lcio checkpoint files", required = False)
+        parser.add_argument("--analysisBackend", action="store", default="binary", choices=PandoraAnalysisBinary.backends,
+                                help="The backend of the calibration analyses : LCPandoraAnalysis binaries (default), in-process (native, requires numpy and uproot, or numpy and pyLCIO for the mip scale) or auto (native if available, only for the calibrators whose native backend was checked against the binary). Check the native backend against the binaries with tests/testAnalysisBackends.py and tests/testMipExtractor.py before using it", required = False)
+        parser.add_argument("--analysisCacheDir", action="store", default="",
+                                help="The directory where the results of the calibration analyses are cached and reused for identical root files and arguments (default : no cache)", required = False)
+        parser.add_argument("--clearAnalysisCache", action="store_true", default=False,
+                                help="Remove all the analysis cache entries before running", required = False)
+        parser.add_argument("--geometryCacheDir", action="store", default="",
+                                help="The directory where the geometry summaries and the gear files of the compact files are cached, avoiding to load DD4hep or convert to gear on later runs (default : no cache)", required = False)
+        parser.add_argument("--maxParallelSteps", action="store", type=int, default=1,
+                                help="The maximum number of calibration steps running at the same time. Steps run concurrently when their dependencies allow it (default 1 : sequential run)", required = False)
+        parser.add_argument("--maxProcesses", action="store", type=int, default=0,
+                                help="The maximum number of external processes (Marlin, analysis binaries, ...) running at the same time (default : number of cores)", required = False)
+        parser.add_argument("--workspaceDir", action="store", default=".",
+                                help="The directory where the run directory (one sub-directory per step and iteration) is created (default : current directory)", required = False)
+        parser.add_argument("--scratchDir", action="store", default="",
+                                help="The directory where the small temporary files are written, e.g a tmpfs mount point as /dev/shm (default : system temporary directory)", required = False)
+        parser.add_argument("--keepArtifacts", action="store", nargs='+', default=["*"],
+                                help="The file name patterns of the run directory files kept at the end of the run, the other files are removed (default : '*', keep all. e.g '*.root' to remove the check plots and gear files)", required = False)
                                 
+    """ Get the workspace of the run (directories of the files produced by the steps)
+    """
+    def getWorkspace(self) :
+        return self._workspace
+
+    """ Get the geometry interface of the compact file.
+        The geometry is loaded on first use, from the geometry cache if configured
+    """
     def getGeometry(self) :
+        with self._geometryLock:
+            if self._geometry is None:
+                if self._geometryCacheDir:
+                    self._geometry = CachedGeometryInterface(self._compactFile, self._geometryCacheDir)
+                else:
+                    self._geometry = DDGeometryInterface(self._compactFile)
         return self._geometry
     
     def getArgParser(self):
@@ -156,14 +223,41 @@ class CalibrationManager(object) :
         self._getAdditionalArgs(self._argparser, requiredArgs)
         parsed = self._argparser.parse_args()
         
+        self._workspace.setBaseDirectory(parsed.workspaceDir)
+        if parsed.scratchDir:
+            self._workspace.setScratchBaseDirectory(parsed.scratchDir)
+        self._workspace.setKeepPatterns(parsed.keepArtifacts)
         self._xmlFile = parsed.inputCalibrationFile
         self._outputXmlFile = parsed.outputCalibrationFile if parsed.outputCalibrationFile else parsed.inputCalibrationFile
         parser = createXMLParser()
         self._xmlTree = etree.parse(self._xmlFile, parser)
-        self._geometry = GeometryInterface(parsed.compactFile)
+        self._compactFile = parsed.compactFile
+        self._geometryCacheDir = parsed.geometryCacheDir
+        if parsed.geometryCacheDir:
+            GearConverter.setDefaultCacheDirectory(parsed.geometryCacheDir)
+        Marlin.setDefaultNShards(parsed.marlinShards)
+        Marlin.setDefaultOverlayMode(parsed.marlinOverlay)
+        PandoraAnalysisBinary.setDefaultBackend(parsed.analysisBackend)
+        if parsed.marlinCacheDir:
+            marlinCache = MarlinCache(parsed.marlinCacheDir)
+            if parsed.clearMarlinCache:
+                marlinCache.clear()
+            Marlin.setDefaultCache(marlinCache)
+        if parsed.analysisCacheDir:
+            analysisCache = AnalysisCache(parsed.analysisCacheDir)
+            if parsed.clearAnalysisCache:
+                analysisCache.clear()
+            PandoraAnalysisBinary.setDefaultResultCache(analysisCache)
+        if parsed.marlinCheckpointDir:
+            Marlin.setDefaultCheckpointCache(MarlinCache(parsed.marlinCheckpointDir))
+        if parsed.maxProcesses > 0:
+            getExecutor().setMaxNProcesses(parsed.maxProcesses)
+        self._maxParallelSteps = max(1, parsed.maxParallelSteps)
             
         # Step 5) : Pass command line result to running steps
         for step in self._steps[self._startStep:self._endStep+1] :
+            if parsed.pruneProcessors:
+                step.setPruneProcessors(True)
             step.readCmdLine(parsed)
 
 
@@ -172,16 +266,22 @@ class CalibrationManager(object) :
         self.readCmdLine()
         
         try:
-            for step in self._steps[self._startStep:self._endStep+1] :
-                step.init(self._xmlTree)
-                step.run(self._xmlTree)
-                step.writeOutput(self._xmlTree)
+            if self._maxParallelSteps > 1 :
+                StepScheduler(self._steps[self._startStep:self._endStep+1], self._maxParallelSteps).run(self._xmlTree)
+            else :
+                for step in self._steps[self._startStep:self._endStep+1] :
+                    step.init(self._xmlTree)
+                    step.run(self._xmlTree)
+                    step.writeOutput(self._xmlTree)
         except RuntimeError as e:
             self._logger.error("Caught exception while running: {0}".format(str(e)))
             self._badRun = True
             self._runException = e
         
-        self.writeXml(None)
+        try:
+            self.writeXml(None)
+        finally:
+            self._workspace.cleanup()
 
     def writeXml(self, xmlFile=None) :
 
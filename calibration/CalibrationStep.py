@@ -2,6 +2,9 @@
 """
 
 from calibration.XmlTools import etree
+from calibration.Convergence import createConvergenceStrategy
+from calibration.RegionSkimmer import RegionSkimmer
+from calibration.Workspace import getWorkspace
 import logging
 import glob
 
@@ -12,10 +15,20 @@ class CalibrationStep(object) :
         self._manager = None
         self._requiredArgs = set()
         self._stepOutputsToLoad = list()
+        self._dependencies = None
         self._pfoAnalysisProcessor =  "MyPfoAnalysis"
         self._marlinPandoraProcessor = "MyDDMarlinPandora"
         self._runProcessors = list()
         self._turnoffProcessors = list()
+        self._convergenceStrategy = "fixedPoint"
+        self._bracketScales = []
+        self._bracketSinglePass = False
+        self._pruneProcessors = False
+        self._regionSkimDirectory = ""
+        self._regionSkimmer = None
+        self._regionCounts = {}
+        self._regionInputs = None
+        self._eventSchedule = []
 
     def setManager(self, mgr) :
         self._manager = mgr
@@ -45,6 +58,39 @@ class CalibrationStep(object) :
     """
     def setLoadStepOutputs(self, steps):
         self._stepOutputsToLoad = list(steps)
+
+    """ Declare explicitly the steps this step depends on (step names).
+        By default, a step depends on the loaded steps whose output processors it runs
+    """
+    def setDependencies(self, steps):
+        self._dependencies = list(steps)
+
+    """ The explicitly declared dependencies, None if not declared
+    """
+    def getDependencies(self):
+        return self._dependencies
+
+    """ The names of the steps whose outputs are loaded by this step
+    """
+    def getLoadStepOutputs(self):
+        return list(self._stepOutputsToLoad)
+
+    """ The processors run by the step, i.e whose parameters are read. None for all processors
+    """
+    def inputProcessors(self):
+        return list(self._runProcessors) if len(self._runProcessors) else None
+
+    """ The processors whose parameters are written in the step output. None if unknown
+    """
+    def outputProcessors(self):
+        return None
+
+    """ Whether the step runs a multiprocessing pool. Forking the pool workers while other
+        steps run in threads is unsafe (locks held by the other threads), the step scheduler 
+        runs such a step alone
+    """
+    def usesProcessPool(self):
+        return False
     
     """ Set the pfo analysis processor name in the reco chain
     """
@@ -61,9 +107,220 @@ class CalibrationStep(object) :
     def setTurnoffProcessors(self, processors):
         self._turnoffProcessors = list(processors)
     
+    """ Whether to turn off the processors not needed by the step, from the collection
+        dataflow of the steering file (applied after the run/turn off processor lists)
+    """
+    def setPruneProcessors(self, prune):
+        self._pruneProcessors = bool(prune)
+
+    """ The processors whose outputs are used by the step, i.e the processors kept when pruning
+    """
+    def _pruneTargets(self):
+        return [self._pfoAnalysisProcessor]
+
+    def _pruneMarlinProcessors(self, marlin):
+        if self._pruneProcessors:
+            prunedProcessors = marlin.pruneProcessors(self._pruneTargets())
+            self._logger.info("{0}: pruned processors : {1}".format(self._name, ", ".join(prunedProcessors)))
+
+    """ Set the directory of the region skim files. If set, the step input files are split once
+        in detector regions and the iterations only process the regions still to calibrate
+    """
+    def setRegionSkimDirectory(self, directory):
+        self._regionSkimDirectory = str(directory)
+
+    """ Skim the marlin input files in detector regions (list of (region, min cos theta, max cos theta)).
+        Marlin reads the skim files afterwards, so the event range is reset. Returns a dictionary
+        of region -> skim file for the regions with events, None if the region skim is disabled
+    """
+    def _skimRegions(self, regions):
+        if not self._regionSkimDirectory:
+            return None
+
+        skimmer = RegionSkimmer(self._name)
+        skimmer.setInputFiles(self._marlin.getGlobalParameter("LCIOInputFiles").split())
+        skimmer.setOutputDirectory(self._regionSkimDirectory)
+        skimmer.setEventRange(self._getMarlinIntGlobalParameter("SkipNEvents"), self._getMarlinIntGlobalParameter("MaxRecordNumber"))
+
+        for region, minCosTheta, maxCosTheta in regions:
+            skimmer.addRegion(region, minCosTheta, maxCosTheta)
+
+        counts = skimmer.run()
+        self._marlin.setSkipNEvents(0)
+        self._marlin.setMaxRecordNumber(0)
+        self._regionSkimmer = skimmer
+        self._regionCounts = counts
+
+        return {region : skimmer.regionFile(region) for region, count in counts.iteritems() if count > 0}
+
+    """ Set the marlin input files to the skim files of the given regions.
+        The event schedule (see _setScheduledStatistics) is then applied per region
+    """
+    def _setRegionInputFiles(self, regionFiles, regions):
+        regionsWithEvents = [region for region in regions if region in regionFiles]
+
+        if not regionsWithEvents:
+            raise RuntimeError("{0}: no event in regions {1}".format(self._name, ", ".join(regions)))
+
+        self._regionInputs = (regionFiles, regionsWithEvents)
+        self._marlin.setInputFiles([regionFiles[region] for region in regionsWithEvents])
+
+    """ Set the number of events processed by the successive iterations of iterative steps,
+        e.g [1000, 5000]. The iterations after the schedule use the full statistics
+    """
+    def setEventSchedule(self, schedule):
+        self._eventSchedule = [int(nEvents) for nEvents in schedule]
+
+    """ Set the marlin number of events for the given stage of the event schedule.
+        fullNEvents is the MaxRecordNumber of the full statistics (0 for all the records).
+        The scheduled number of events is converted to a MaxRecordNumber, counting the run headers
+        read with the events (see Marlin.getMaxRecordNumber).
+        If the input is split in regions (see _setRegionInputFiles), the scheduled events are shared 
+        by the regions : each region reads the first events of its own skim file.
+        Returns True if the full statistics is processed
+    """
+    def _setScheduledStatistics(self, stage, fullNEvents):
+        nEvents = self._eventSchedule[stage] if stage < len(self._eventSchedule) else 0
+
+        if self._regionInputs is not None:
+            return self._setScheduledRegionStatistics(nEvents)
+
+        maxRecordNumber = self._marlin.getMaxRecordNumber(nEvents)
+
+        if maxRecordNumber <= 0 or (fullNEvents > 0 and maxRecordNumber >= fullNEvents):
+            self._marlin.setMaxRecordNumber(fullNEvents)
+            return True
+
+        self._marlin.setMaxRecordNumber(maxRecordNumber)
+        return False
+
+    """ Set the marlin input files to the first nEvents / nRegions events of each region skim file
+        (all the events for nEvents <= 0). Returns True if the full statistics is processed
+    """
+    def _setScheduledRegionStatistics(self, nEvents):
+        regionFiles, regions = self._regionInputs
+        nRegionEvents = -(-nEvents // len(regions))
+        inputFiles = []
+        fullStatistics = True
+
+        for region in regions:
+            if nEvents > 0 and self._regionCounts[region] > nRegionEvents:
+                inputFiles.append(self._regionSkimmer.headFile(region, nRegionEvents))
+                fullStatistics = False
+            else:
+                inputFiles.append(regionFiles[region])
+
+        self._marlin.setInputFiles(inputFiles)
+        self._marlin.setMaxRecordNumber(0)
+        return fullStatistics
+
+    """ The next stage of the event schedule. The schedule jumps to the full statistics
+        once the reduced statistics can't improve the calibration anymore, or when the next
+        pass is predicted to reach the accuracy (see ConvergenceStrategy.isNextPassPredictedConverged) :
+        the confirming pass runs with the full statistics
+    """
+    def _nextScheduleStage(self, stage, fullStatistics, statisticallyResolved, predictedConverged=False):
+        if predictedConverged:
+            self._logger.info("{0}: next pass predicted to reach the accuracy, running the confirming pass with full statistics".format(self._name))
+            return len(self._eventSchedule)
+        if not fullStatistics and statisticallyResolved:
+            self._logger.info("{0}: precision limited by the reduced statistics, switching to full statistics".format(self._name))
+            return len(self._eventSchedule)
+        return stage + 1
+
+    def _getMarlinIntGlobalParameter(self, name):
+        try:
+            value = self._marlin.getGlobalParameter(name)
+            return int(value) if value else 0
+        except KeyError:
+            return 0
+
     def setMarlinPandoraProcessor(self, processor):
         self._marlinPandoraProcessor = str(processor)
-        
+
+    """ Set the convergence strategy name used by iterative steps (see calibration.Convergence)
+    """
+    def setConvergenceStrategy(self, strategy):
+        self._convergenceStrategy = str(strategy)
+
+    """ Set the candidate scales evaluated concurrently at the first iteration of
+        iterative steps (bracket mode), e.g [0.95, 1., 1.05]. An empty list disables the bracket mode
+    """
+    def setBracketScales(self, scales):
+        self._bracketScales = [float(scale) for scale in scales]
+
+    """ Whether to evaluate all the bracket candidates in a single Marlin job, 
+        by cloning the processors modified by the step (see _modifiedProcessors())
+    """
+    def setBracketSinglePass(self, singlePass):
+        self._bracketSinglePass = bool(singlePass)
+
+    """ The processors whose parameters are modified by the step between Marlin runs.
+        Must be reimplemented to enable the single pass bracket mode and the Marlin checkpoints
+    """
+    def _modifiedProcessors(self):
+        return []
+
+    def _createConvergenceStrategy(self, targets):
+        strategy = self._convergenceStrategy
+        # fit the response on the candidates rather than rescaling the best one
+        if self._bracketScales and strategy == "fixedPoint":
+            self._logger.info("{0}: bracket mode, using the 'linearFit' convergence strategy instead of 'fixedPoint'".format(self._name))
+            strategy = "linearFit"
+        return createConvergenceStrategy(strategy, targets)
+
+    """ Run concurrently one Marlin pass per bracket candidate.
+        The candidates are the bracket scales by default. configure(candidate, rootFile) must set 
+        the calibration constants for the candidate and the root output file in the step marlin instance.
+        Returns the list of root files
+    """
+    def _runBracketPasses(self, configure, candidates=None):
+        candidates = candidates if candidates is not None else self._bracketScales
+        if self._bracketSinglePass:
+            chain = self._marlin.getDownstreamProcessors(self._modifiedProcessors())
+
+            if self._pfoAnalysisProcessor in chain:
+                return self._runBracketSinglePass(configure, chain, candidates)
+
+            self._logger.warning("{0}: {1} doesn't depend on the processors modified by the step, running one Marlin job per candidate".format(self._name, self._pfoAnalysisProcessor))
+
+        marlins = []
+        rootFiles = []
+
+        for index, candidate in enumerate(candidates):
+            rootFile = self._workspacePath("PfoAnalysis_{0}_bracket{1}.root".format(self._name, index), "bracket")
+            configure(candidate, rootFile)
+            marlin = self._marlin.clone()
+            marlin.start()
+            marlins.append(marlin)
+            rootFiles.append(rootFile)
+
+        for marlin in marlins:
+            marlin.wait()
+
+        return rootFiles
+
+    """ Run all the bracket candidates in a single Marlin job : the processor chain is cloned 
+        once per candidate with the candidate parameters, the original chain is turned off
+    """
+    def _runBracketSinglePass(self, configure, chain, candidates):
+        marlin = self._marlin.clone()
+        rootFiles = []
+
+        for index, candidate in enumerate(candidates):
+            rootFile = self._workspacePath("PfoAnalysis_{0}_bracket{1}.root".format(self._name, index), "bracket")
+            configure(candidate, rootFile)
+            clones = marlin.cloneProcessorChain(chain, "_bracket{0}".format(index), self._marlin)
+            marlin.setProcessorParameter(clones[self._pfoAnalysisProcessor], "RootFile", rootFile)
+            rootFiles.append(rootFile)
+
+        marlin.turnOffProcessors(chain)
+        marlin.setCheckpointProcessors([clones[processor] for processor in chain])
+        self._logger.info("{0}: running {1} bracket candidates in a single Marlin job (cloned processors : {2})".format(self._name, len(rootFiles), ", ".join(chain)))
+        marlin.run()
+
+        return rootFiles
+
     def _loadStepOutputs(self, config):    
         for step in self._stepOutputsToLoad:
             self._marlin.loadStepOutputParameters(config, step)
@@ -135,7 +392,10 @@ class CalibrationStep(object) :
             step.append(iterations)
         return iterations
 
-    def _writeIterationOutput(self, config, iterId, parameters):
+    """ Write the output of an iteration. The overlay (see Marlin.getOverlay) of the iteration
+        Marlin run, if any, is recorded for reproducibility
+    """
+    def _writeIterationOutput(self, config, iterId, parameters, overlay=None):
         iterations = self._configureIterationOutput(config)
         iteration = etree.Element("iteration", id=str(iterId))
         iterations.append(iteration)
@@ -143,6 +403,16 @@ class CalibrationStep(object) :
             parameter = etree.Element(key)
             parameter.text = str(value)
             iteration.append(parameter)
+        if overlay:
+            overlayElement = etree.Element("overlay")
+            for processor, name, value in overlay:
+                self._writeProcessorParameter(overlayElement, processor, name, value)
+            iteration.append(overlayElement)
+
+    """ Get the path of a step file in the workspace, in the iteration directory if specified
+    """
+    def _workspacePath(self, fileName, iteration=None):
+        return getWorkspace().path(fileName, self._name, iteration)
 
     def _extractFileList(self, inputFile, extension=None) :
         if isinstance(inputFile, list) :
@@ -0,0 +1,372 @@
+""" Convergence strategies for the iterative energy scale calibration steps.
+
+    A strategy handles a set of calibration scales (relative to the input
+    calibration constants, 1 at start) and the corresponding measured responses
+    (i.e the mean reconstructed energy). From the history of the iterations, it
+    proposes the scales to use for the next reconstruction pass such that the
+    responses match the targets (i.e the true particle energy).
+    Dimensions reaching the required accuracy can be frozen : their scale is
+    not modified anymore. A dimension is only frozen on a measured precision,
+    i.e at a scale a reconstruction pass was run with. The response model of a
+    strategy can predict that the next pass reaches the accuracy : this pass is
+    then the confirming pass, but nothing is frozen on the prediction.
+    The statistical error of the responses can be provided with the measurements :
+    a dimension whose precision is below its statistical resolution is
+    considered statistically limited.
+"""
+class ConvergenceStrategy(object):
+    def __init__(self, targets):
+        self._targets = [float(t) for t in targets]
+        self._scales = []
+        self._responses = []
+        self._errors = []
+        self._frozen = [False]*len(self._targets)
+        self._frozenScales = [None]*len(self._targets)
+
+    def name(self):
+        return "none"
+
+    def dimension(self):
+        return len(self._targets)
+
+    def nIterations(self):
+        return len(self._scales)
+
+    """ Add the responses measured with the given scales.
+        The optional errors are the statistical errors of the responses (None if unknown)
+    """
+    def addMeasurement(self, scales, responses, errors=None):
+        if len(scales) != self.dimension() or len(responses) != self.dimension():
+            raise ValueError("ConvergenceStrategy.addMeasurement: expected {0} scales and responses".format(self.dimension()))
+        errors = errors if errors is not None else [None]*self.dimension()
+        self._scales.append([float(s) for s in scales])
+        self._responses.append([float(r) for r in responses])
+        self._errors.append([float(e) if e is not None else None for e in errors])
+
+    """ Add the responses measured concurrently with several candidate scales (bracket mode).
+        The measurements are ordered by decreasing error so that the best candidate
+        becomes the current iteration
+    """
+    def addMeasurements(self, scalesList, responsesList, errorsList=None):
+        errorsList = errorsList if errorsList is not None else [None]*len(scalesList)
+        measurements = zip(scalesList, responsesList, errorsList)
+        measurements.sort(key=lambda m: -max([abs(1. - float(r) / t) for r, t in zip(m[1], self._targets)]))
+
+        for scales, responses, errors in measurements:
+            self.addMeasurement(scales, responses, errors)
+
+    """ Freeze a dimension at the given scale (default : current scale).
+        Its scale won't be modified anymore
+    """
+    def freeze(self, index, scale=None):
+        self._frozen[index] = True
+        self._frozenScales[index] = scale if scale is not None else self.currentScales()[index]
+
+    def isFrozen(self, index):
+        return self._frozen[index]
+
+    """ The scales of the frozen dimensions (None for non frozen dimensions)
+    """
+    def convergedScales(self):
+        return list(self._frozenScales)
+
+    """ Freeze the dimensions whose measured precision is below the accuracy (scalar or one per dimension),
+        at the scales of the last iteration. Returns True if all the dimensions are frozen.
+        A dimension predicted to reach the accuracy at the next scales (see isNextPassPredictedConverged) 
+        is not frozen : the next iteration is the confirming pass.
+        If the last iteration didn't use the full statistics, nothing is frozen : the precision
+        may be driven by the statistical fluctuations of the reduced sample. At full statistics,
+        the statistically limited dimensions are frozen too, as more iterations can't improve them
+    """
+    def checkConvergence(self, accuracy, fullStatistics=True):
+        if not fullStatistics:
+            return False
+
+        accuracies = self._accuracies(accuracy)
+        precisions = self.precisions()
+
+        for i in range(self.dimension()):
+            if not self._frozen[i] and (precisions[i] < accuracies[i] or self.isStatisticallyLimited(i)):
+                self.freeze(i)
+
+        return all(self._frozen)
+
+    """ The current scales, 1 if no iteration was processed yet
+    """
+    def currentScales(self):
+        return list(self._scales[-1]) if self._scales else [1.]*self.dimension()
+
+    """ The precision of the last iteration for each dimension : |1 - response / target|
+    """
+    def precisions(self):
+        return [abs(1. - r / t) for r, t in zip(self._responses[-1], self._targets)]
+
+    """ The relative statistical errors of the last iteration responses (None if unknown)
+    """
+    def statisticalErrors(self):
+        return [e / t if e is not None else None for e, t in zip(self._errors[-1], self._targets)]
+
+    """ Whether the precision of the last iteration for a dimension is below twice its statistical error,
+        i.e the deviation from the target is not significant with the current statistics
+    """
+    def isStatisticallyLimited(self, index):
+        if not self._errors or self._errors[-1][index] is None:
+            return False
+        return self.precisions()[index] < 2. * self.statisticalErrors()[index]
+
+    """ Whether all the non frozen dimensions are within the accuracy or statistically limited.
+        For a reduced statistics iteration, more events are needed to improve the calibration
+    """
+    def isStatisticallyResolved(self, accuracy):
+        accuracies = self._accuracies(accuracy)
+        precisions = self.precisions()
+        return all(self._frozen[i] or precisions[i] < accuracies[i] or self.isStatisticallyLimited(i) for i in range(self.dimension()))
+
+    """ Whether the response model predicts that all the non frozen dimensions reach the accuracy
+        with the next scales, i.e the next iteration is the confirming pass. Nothing is frozen :
+        the prediction must be confirmed by a measurement (see checkConvergence).
+        False if the strategy has no response model yet or if all the dimensions are frozen
+    """
+    def isNextPassPredictedConverged(self, accuracy):
+        if not self._scales or all(self._frozen):
+            return False
+
+        accuracies = self._accuracies(accuracy)
+        responses = self._predictResponses(self.nextScales())
+
+        if responses is None:
+            return False
+
+        return all(self._frozen[i] or abs(1. - responses[i] / self._targets[i]) < accuracies[i] for i in range(self.dimension()))
+
+    """ The scales to use for the next iteration
+    """
+    def nextScales(self):
+        if not self._scales:
+            return [1.]*self.dimension()
+
+        scales = self._computeNextScales()
+        return [self._frozenScales[i] if self._frozen[i] else scales[i] for i in range(self.dimension())]
+
+    def _accuracies(self, accuracy):
+        return accuracy if isinstance(accuracy, list) else [accuracy]*self.dimension()
+
+    def _computeNextScales(self):
+        raise NotImplementedError("ConvergenceStrategy._computeNextScales: method not implemented !")
+
+    """ The responses predicted by the response model of the strategy for the given scales.
+        None if the strategy has no response model (default) or if the model is not determined yet
+    """
+    def _predictResponses(self, scales):
+        return None
+
+    """ The linear response through the last two iterations of a dimension at the given scale.
+        None if degenerated or non physical (decreasing response)
+    """
+    def _secantResponse(self, index, scale):
+        ds = self._scales[-1][index] - self._scales[-2][index]
+        dr = self._responses[-1][index] - self._responses[-2][index]
+
+        if ds == 0. or dr == 0. or dr / ds <= 0.:
+            return None
+
+        return self._responses[-1][index] + (scale - self._scales[-1][index]) * dr / ds
+
+    """ Rescale by target / response (proportional response model)
+    """
+    def _fixedPointScale(self, index):
+        return self._scales[-1][index] * self._targets[index] / self._responses[-1][index]
+
+################################################################################
+""" FixedPointConvergence class.
+    Rescale the constants by target / response at each iteration (historical behavior)
+"""
+class FixedPointConvergence(ConvergenceStrategy):
+    def name(self):
+        return "fixedPoint"
+
+    def _computeNextScales(self):
+        return [self._fixedPointScale(i) for i in range(self.dimension())]
+
+################################################################################
+""" SecantConvergence class.
+    Solve response(scale) = target in each dimension using the last two iterations.
+    Falls back to the fixed point rescaling for the first iteration
+"""
+class SecantConvergence(ConvergenceStrategy):
+    def name(self):
+        return "secant"
+
+    def _computeNextScales(self):
+        if len(self._scales) < 2:
+            return [self._fixedPointScale(i) for i in range(self.dimension())]
+
+        scales = []
+
+        for i in range(self.dimension()):
+            ds = self._scales[-1][i] - self._scales[-2][i]
+            dr = self._responses[-1][i] - self._responses[-2][i]
+
+            # degenerated or non physical (decreasing) response
+            if ds == 0. or dr == 0. or dr / ds <= 0.:
+                scales.append(self._fixedPointScale(i))
+            else:
+                scales.append(self._scales[-1][i] + (self._targets[i] - self._responses[-1][i]) * ds / dr)
+
+        return scales
+
+    def _predictResponses(self, scales):
+        if len(self._scales) < 2:
+            return None
+
+        responses = [self._secantResponse(i, scales[i]) for i in range(self.dimension())]
+        return None if None in responses else responses
+
+################################################################################
+""" LinearFitConvergence class.
+    Fit response = a + b*scale on all the iterations in each dimension
+    and solve for the target
+"""
+class LinearFitConvergence(ConvergenceStrategy):
+    def name(self):
+        return "linearFit"
+
+    def _computeNextScales(self):
+        scales = []
+
+        for i in range(self.dimension()):
+            x = [s[i] for s in self._scales]
+            y = [r[i] for r in self._responses]
+            n = float(len(x))
+            meanX, meanY = sum(x) / n, sum(y) / n
+            sxx = sum([(xi - meanX)**2 for xi in x])
+            sxy = sum([(xi - meanX)*(yi - meanY) for xi, yi in zip(x, y)])
+
+            if sxx == 0. or sxy / sxx <= 0.:
+                scales.append(self._fixedPointScale(i))
+            else:
+                slope = sxy / sxx
+                scales.append(meanX + (self._targets[i] - meanY) / slope)
+
+        return scales
+
+    def _predictResponses(self, scales):
+        responses = []
+
+        for i in range(self.dimension()):
+            x = [s[i] for s in self._scales]
+            y = [r[i] for r in self._responses]
+            n = float(len(x))
+            meanX, meanY = sum(x) / n, sum(y) / n
+            sxx = sum([(xi - meanX)**2 for xi in x])
+            sxy = sum([(xi - meanX)*(yi - meanY) for xi, yi in zip(x, y)])
+
+            if sxx == 0. or sxy / sxx <= 0.:
+                return None
+
+            responses.append(meanY + (scales[i] - meanX) * sxy / sxx)
+
+        return responses
+
+################################################################################
+""" NewtonConvergence class.
+    Newton steps using a full jacobian of the responses versus the scales,
+    i.e a 2x2 jacobian for the coupled ecal/hcal hadronic scale calibration.
+    The jacobian starts from the proportional response model (diagonal) and
+    is refined at each iteration with a Broyden rank-one update
+"""
+class NewtonConvergence(ConvergenceStrategy):
+    def __init__(self, targets):
+        ConvergenceStrategy.__init__(self, targets)
+        self._jacobian = None
+        # whether the jacobian was updated from measurements (not only the proportional model)
+        self._jacobianUpdated = False
+
+    def name(self):
+        return "newton"
+
+    def addMeasurement(self, scales, responses, errors=None):
+        ConvergenceStrategy.addMeasurement(self, scales, responses, errors)
+        n = self.dimension()
+
+        if self._jacobian is None:
+            self._jacobian = [[(self._responses[-1][i] / self._scales[-1][i] if i == j else 0.) for j in range(n)] for i in range(n)]
+            return
+
+        ds = [self._scales[-1][j] - self._scales[-2][j] for j in range(n)]
+        dr = [self._responses[-1][i] - self._responses[-2][i] for i in range(n)]
+        norm = sum([d*d for d in ds])
+
+        if norm == 0.:
+            return
+
+        for i in range(n):
+            residual = dr[i] - sum([self._jacobian[i][j]*ds[j] for j in range(n)])
+            for j in range(n):
+                self._jacobian[i][j] += residual * ds[j] / norm
+
+        self._jacobianUpdated = True
+
+    def _computeNextScales(self):
+        # solve the reduced system on the non frozen dimensions
+        free = [i for i in range(self.dimension()) if not self._frozen[i]]
+        matrix = [[self._jacobian[i][j] for j in free] for i in free]
+        vector = [self._targets[i] - self._responses[-1][i] for i in free]
+        steps = _solveLinearSystem(matrix, vector)
+        scales = list(self._scales[-1])
+
+        if steps is None:
+            return [self._fixedPointScale(i) for i in range(self.dimension())]
+
+        for index, i in enumerate(free):
+            scales[i] += steps[index]
+
+        return scales
+
+    def _predictResponses(self, scales):
+        if not self._jacobianUpdated:
+            return None
+
+        n = self.dimension()
+        return [self._responses[-1][i] + sum([self._jacobian[i][j]*(scales[j] - self._scales[-1][j]) for j in range(n)]) for i in range(n)]
+
+
+""" Solve the linear system matrix * x = vector (gaussian elimination).
+    Returns None if the matrix is singular
+"""
+def _solveLinearSystem(matrix, vector):
+    n = len(vector)
+    a = [list(matrix[i]) + [vector[i]] for i in range(n)]
+
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda row: abs(a[row][col]))
+        if a[pivot][col] == 0.:
+            return None
+        a[col], a[pivot] = a[pivot], a[col]
+        for row in range(col+1, n):
+            factor = a[row][col] / a[col][col]
+            for k in range(col, n+1):
+                a[row][k] -= factor * a[col][k]
+
+    x = [0.]*n
+    for row in reversed(range(n)):
+        x[row] = (a[row][n] - sum([a[row][k]*x[k] for k in range(row+1, n)])) / a[row][row]
+
+    return x
+
+
+""" The available convergence strategies
+"""
+convergenceStrategies = {
+    "fixedPoint" : FixedPointConvergence,
+    "secant" : SecantConvergence,
+    "linearFit" : LinearFitConvergence,
+    "newton" : NewtonConvergence
+}
+
+""" Create a convergence strategy by name for the given targets
+"""
+def createConvergenceStrategy(name, targets):
+    if name not in convergenceStrategies:
+        raise ValueError("Unknown convergence strategy '{0}'. Available : {1}".format(name, ", ".join(convergenceStrategies.keys())))
+    return convergenceStrategies[name](targets)
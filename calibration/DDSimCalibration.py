@@ -1,5 +1,5 @@
 import os
-import subprocess
+from calibration.ProcessExecutor import getExecutor
 
 
 """
@@ -21,20 +21,20 @@ class DDSimCalibration(object) :
         self.simulations.append(parameters)
 
     def run(self):
-        processes = []
+        jobs = []
 
-        # run simulations in different processes
+        # run simulations in different processes, within the executor process budget
         for sim in self.simulations :
             args = self._createDDSimArgs(sim)
             args[:0] = ['ddsim']
             print "Args : " + str(args)
-            process = subprocess.Popen(args = args)#, stdin = None, stdout = None, stderr = None)
-            processes.append(process)
+            jobs.append(getExecutor().submit(args, "ddsim"))
 
-        for p in processes :
-            p.wait()
+        getExecutor().wait(jobs)
 
         print "Simulation(s) done ..."
+        for job in jobs :
+            print "  -> {0}".format(job)
 
     def _createDDSimArgs(self, parameters) :
         args = []
@@ -73,6 +73,11 @@ class EcalEnergyStep(CalibrationStep) :
 
         self._maxNIterations = int(parsed.maxNIterations)
         self._energyScaleAccuracy = float(parsed.ecalCalibrationAccuracy)
+        self._convergenceStrategy = parsed.convergenceStrategy
+        self.setBracketScales([scale for scale in parsed.bracketScales.split(",") if scale])
+        self.setBracketSinglePass(parsed.bracketSinglePass)
+        self.setEventSchedule([nEvents for nEvents in parsed.eventSchedule.split(",") if nEvents])
+        self.setRegionSkimDirectory(parsed.regionSkimDirectory)
 
         self._inputMinCosThetaBarrel, self._inputMaxCosThetaBarrel = self._getGeometry().getEcalBarrelCosThetaRange()
         self._inputMinCosThetaEndcap, self._inputMaxCosThetaEndcap = self._getGeometry().getEcalEndcapCosThetaRange()
@@ -91,6 +96,9 @@ class EcalEnergyStep(CalibrationStep) :
 
         if len(self._turnoffProcessors):
             self._marlin.turnOffProcessors(self._turnoffProcessors)
+
+        self._pruneMarlinProcessors(self._marlin)
+        self._marlin.setCheckpointProcessors(self._modifiedProcessors())
         
 
     """ Run the calibration step
@@ -102,67 +110,138 @@ class EcalEnergyStep(CalibrationStep) :
 
         barrelRescaleFactor = 1.
         endcapRescaleFactor = 1.
-        barrelRescaleFactorCumul = 1.
-        endcapRescaleFactorCumul = 1.
+
+        newBarrelPhotonEnergy = 0.
+        newEndcapPhotonEnergy = 0.
+
+        barrelStatisticalError = None
+        endcapStatisticalError = None
 
         barrelAccuracyReached = False
         endcapAccuracyReached = False
 
-        ecalBarrelFactors = self.ecalBarrelEnergyFactors()
-        ecalEndcapFactors = self.ecalEndcapEnergyFactors()
+        inputEcalBarrelFactors = self.ecalBarrelEnergyFactors()
+        inputEcalEndcapFactors = self.ecalEndcapEnergyFactors()
+        ecalBarrelFactors = list(inputEcalBarrelFactors)
+        ecalEndcapFactors = list(inputEcalEndcapFactors)
+
+        # scales of the input factors, driven by the convergence strategy
+        barrelConvergence = self._createConvergenceStrategy([self._photonEnergy])
+        endcapConvergence = self._createConvergenceStrategy([self._photonEnergy])
 
         pfoAnalysisFile = ""
         
-        ecalCalibrator = EcalCalibrator()
-        ecalCalibrator.setPhotonEnergy(self._photonEnergy)
+        # split the input in regions, events outside of the barrel and endcap are not used
+        regionFiles = self._skimRegions([
+            ("Barrel", self._inputMinCosThetaBarrel, self._inputMaxCosThetaBarrel),
+            ("EndCap", self._inputMinCosThetaEndcap, self._inputMaxCosThetaEndcap)])
+
+        if regionFiles is not None:
+            self._setRegionInputFiles(regionFiles, ["Barrel", "EndCap"])
+
+        # event schedule : the first iterations may use a reduced statistics
+        fullNEvents = self._getMarlinIntGlobalParameter("MaxRecordNumber")
+        scheduleStage = 0
+
+        # bracket mode : run the candidate scales concurrently and fit the response
+        if self._bracketScales:
+            def configureBracketPass(scale, rootFile):
+                self.setEnergyFactors([factor*scale for factor in inputEcalBarrelFactors], [factor*scale for factor in inputEcalEndcapFactors])
+                self._marlin.setProcessorParameter(self._pfoAnalysisProcessor, "RootFile", rootFile)
+
+            barrelResponses = []
+            endcapResponses = []
+            barrelErrors = []
+            endcapErrors = []
+            fullStatistics = self._setScheduledStatistics(scheduleStage, fullNEvents)
+
+            # start the region analyses of all the candidates at once
+            calibrators = [(self._startEcalCalibrator(rootFile, "Barrel"), self._startEcalCalibrator(rootFile, "EndCap")) for rootFile in self._runBracketPasses(configureBracketPass)]
+
+            for index, (barrelCalibrator, endcapCalibrator) in enumerate(calibrators):
+                barrelCalibrator.wait()
+                barrelResponses.append([barrelCalibrator.getEcalDigiMean()])
+                barrelErrors.append([barrelCalibrator.getEcalDigiMeanError()])
+
+                endcapCalibrator.wait()
+                endcapResponses.append([endcapCalibrator.getEcalDigiMean()])
+                endcapErrors.append([endcapCalibrator.getEcalDigiMeanError()])
+
+                self._writeIterationOutput(config, "bracket{0}".format(index),
+                    {"scale" : self._bracketScales[index],
+                     "nEvents" : self._marlin.getGlobalParameter("MaxRecordNumber"),
+                     "newBarrelPhotonEnergy" : barrelResponses[-1][0],
+                     "barrelStatisticalError" : barrelErrors[-1][0],
+                     "newEndcapPhotonEnergy" : endcapResponses[-1][0],
+                     "endcapStatisticalError" : endcapErrors[-1][0]})
+
+            barrelConvergence.addMeasurements([[scale] for scale in self._bracketScales], barrelResponses, barrelErrors)
+            endcapConvergence.addMeasurements([[scale] for scale in self._bracketScales], endcapResponses, endcapErrors)
+
+            if barrelConvergence.checkConvergence(self._energyScaleAccuracy, fullStatistics):
+                barrelAccuracyReached = True
+                self._outputEcalBarrelFactors = [factor*barrelConvergence.convergedScales()[0] for factor in inputEcalBarrelFactors]
+
+            if endcapConvergence.checkConvergence(self._energyScaleAccuracy, fullStatistics):
+                endcapAccuracyReached = True
+                self._outputEcalEndcapFactors = [factor*endcapConvergence.convergedScales()[0] for factor in inputEcalEndcapFactors]
+
+            scheduleStage = self._nextScheduleStage(scheduleStage, fullStatistics,
+                barrelConvergence.isStatisticallyResolved(self._energyScaleAccuracy) and endcapConvergence.isStatisticallyResolved(self._energyScaleAccuracy),
+                barrelConvergence.isNextPassPredictedConverged(self._energyScaleAccuracy) and endcapConvergence.isNextPassPredictedConverged(self._energyScaleAccuracy))
 
         for iteration in range(self._maxNIterations) :
 
+            if barrelAccuracyReached and endcapAccuracyReached :
+                break
+
             # readjust iteration parameters
-            if not barrelAccuracyReached:
-                for index in range(len(ecalBarrelFactors)):
-                    ecalBarrelFactors[index] = ecalBarrelFactors[index]*barrelRescaleFactor
-            
-            if not endcapAccuracyReached:
-                for index in range(len(ecalEndcapFactors)):
-                    ecalEndcapFactors[index] = ecalEndcapFactors[index]*endcapRescaleFactor
+            barrelScale = barrelConvergence.nextScales()[0]
+            endcapScale = endcapConvergence.nextScales()[0]
+            ecalBarrelFactors = [factor*barrelScale for factor in inputEcalBarrelFactors]
+            ecalEndcapFactors = [factor*endcapScale for factor in inputEcalEndcapFactors]
+
+            pfoAnalysisFile = self._workspacePath("PfoAnalysis_{0}_iter{1}.root".format(self._name, iteration), iteration)
 
-            pfoAnalysisFile = "./PfoAnalysis_{0}_iter{1}.root".format(self._name, iteration)
+            # only process the regions still to calibrate
+            if regionFiles is not None:
+                self._setRegionInputFiles(regionFiles, [region for region, reached in [("Barrel", barrelAccuracyReached), ("EndCap", endcapAccuracyReached)] if not reached])
             
             # run marlin
+            fullStatistics = self._setScheduledStatistics(scheduleStage, fullNEvents)
             self.setEnergyFactors(ecalBarrelFactors, ecalEndcapFactors)
             self._marlin.setProcessorParameter(self._pfoAnalysisProcessor, "RootFile", pfoAnalysisFile)
             self._marlin.run()
 
+            # start the analyses of the regions still to calibrate, they run concurrently
+            barrelCalibrator = self._startEcalCalibrator(pfoAnalysisFile, "Barrel") if not barrelAccuracyReached else None
+            endcapCalibrator = self._startEcalCalibrator(pfoAnalysisFile, "EndCap") if not endcapAccuracyReached else None
+
             # run calibration for barrel
             if not barrelAccuracyReached:
-                ecalCalibrator.setRootFile(pfoAnalysisFile)
-                ecalCalibrator.setDetectorRegion("Barrel")
-                ecalCalibrator.setCosThetaRange(self._inputMinCosThetaBarrel, self._inputMaxCosThetaBarrel)
-                ecalCalibrator.run()
+                barrelCalibrator.wait()
                 
-                newBarrelPhotonEnergy = ecalCalibrator.getEcalDigiMean()
+                newBarrelPhotonEnergy = barrelCalibrator.getEcalDigiMean()
+                barrelStatisticalError = barrelCalibrator.getEcalDigiMeanError()
+                barrelConvergence.addMeasurement([barrelScale], [newBarrelPhotonEnergy], [barrelStatisticalError])
                 barrelRescaleFactor = float(self._photonEnergy) / newBarrelPhotonEnergy
-                barrelRescaleFactorCumul = barrelRescaleFactorCumul*barrelRescaleFactor
-                barrelCurrentPrecision = abs(1 - 1. / barrelRescaleFactor)
+                barrelCurrentPrecision = barrelConvergence.precisions()[0]
 
             # run calibration for endcap
             if not endcapAccuracyReached:
-                ecalCalibrator.setRootFile(pfoAnalysisFile)
-                ecalCalibrator.setDetectorRegion("EndCap")
-                ecalCalibrator.setCosThetaRange(self._inputMinCosThetaEndcap, self._inputMaxCosThetaEndcap)
-                ecalCalibrator.run()
+                endcapCalibrator.wait()
                                 
-                newEndcapPhotonEnergy = ecalCalibrator.getEcalDigiMean()
+                newEndcapPhotonEnergy = endcapCalibrator.getEcalDigiMean()
+                endcapStatisticalError = endcapCalibrator.getEcalDigiMeanError()
+                endcapConvergence.addMeasurement([endcapScale], [newEndcapPhotonEnergy], [endcapStatisticalError])
                 endcapRescaleFactor = float(self._photonEnergy) / newEndcapPhotonEnergy
-                endcapRescaleFactorCumul = endcapRescaleFactorCumul*endcapRescaleFactor
-                endcapCurrentPrecision = abs(1 - 1. / endcapRescaleFactor)
+                endcapCurrentPrecision = endcapConvergence.precisions()[0]
             
             self._logger.info("=============================================")
             self._logger.info("======= Barrel output for iteration {0} =======".format(iteration))
             self._logger.info(" => calibrationFactors : {0}".format(", ".join(map(str, ecalBarrelFactors))))
             self._logger.info(" => calibrationRescaleFactor : " + str(barrelRescaleFactor))
-            self._logger.info(" => calibrationRescaleFactorCumul : " + str(barrelRescaleFactorCumul))
+            self._logger.info(" => calibrationRescaleFactorCumul : " + str(barrelScale))
             self._logger.info(" => currentPrecision : " + str(barrelCurrentPrecision))
             self._logger.info(" => newPhotonEnergy : " + str(newBarrelPhotonEnergy))
             self._logger.info("=============================================")
@@ -171,33 +250,36 @@ class EcalEnergyStep(CalibrationStep) :
             self._logger.info("======= Endcap output for iteration {0} =======".format(iteration))
             self._logger.info(" => calibrationFactors : {0}".format(", ".join(map(str, ecalEndcapFactors))))
             self._logger.info(" => calibrationRescaleFactor : " + str(endcapRescaleFactor))
-            self._logger.info(" => calibrationRescaleFactorCumul : " + str(endcapRescaleFactorCumul))
+            self._logger.info(" => calibrationRescaleFactorCumul : " + str(endcapScale))
             self._logger.info(" => currentPrecision : " + str(endcapCurrentPrecision))
             self._logger.info(" => newPhotonEnergy : " + str(newEndcapPhotonEnergy))
             self._logger.info("=============================================")
 
             # write down iteration results
             self._writeIterationOutput(config, iteration,
-                {"barrelPrecision" : barrelCurrentPrecision,
-                 "barrelRescale" : barrelRescaleFactor,
+                {"nEvents" : self._marlin.getGlobalParameter("MaxRecordNumber"),
+                 "barrelPrecision" : barrelCurrentPrecision,
                  "barrelRescale" : barrelRescaleFactor,
                  "newBarrelPhotonEnergy" : newBarrelPhotonEnergy,
+                 "barrelStatisticalError" : barrelStatisticalError,
                  "endcapPrecision" : endcapCurrentPrecision,
                  "endcapRescale" : endcapRescaleFactor,
-                 "newEndcapPhotonEnergy" : newEndcapPhotonEnergy})
+                 "newEndcapPhotonEnergy" : newEndcapPhotonEnergy,
+                 "endcapStatisticalError" : endcapStatisticalError}, self._marlin.getOverlay())
 
             # are we accurate enough ??
-            if barrelCurrentPrecision < self._energyScaleAccuracy and not barrelAccuracyReached:
+            if not barrelAccuracyReached and barrelConvergence.checkConvergence(self._energyScaleAccuracy, fullStatistics):
                 barrelAccuracyReached = True
-                self._outputEcalBarrelFactors = ecalBarrelFactors
+                self._outputEcalBarrelFactors = [factor*barrelConvergence.convergedScales()[0] for factor in inputEcalBarrelFactors]
 
             # are we accurate enough ??
-            if endcapCurrentPrecision < self._energyScaleAccuracy and not endcapAccuracyReached:
+            if not endcapAccuracyReached and endcapConvergence.checkConvergence(self._energyScaleAccuracy, fullStatistics):
                 endcapAccuracyReached = True
-                self._outputEcalEndcapFactors = ecalEndcapFactors
+                self._outputEcalEndcapFactors = [factor*endcapConvergence.convergedScales()[0] for factor in inputEcalEndcapFactors]
 
-            if barrelAccuracyReached and endcapAccuracyReached :
-                break
+            scheduleStage = self._nextScheduleStage(scheduleStage, fullStatistics,
+                barrelConvergence.isStatisticallyResolved(self._energyScaleAccuracy) and endcapConvergence.isStatisticallyResolved(self._energyScaleAccuracy),
+                barrelConvergence.isNextPassPredictedConverged(self._energyScaleAccuracy) and endcapConvergence.isNextPassPredictedConverged(self._energyScaleAccuracy))
 
         if not barrelAccuracyReached or not endcapAccuracyReached :
             raise RuntimeError("{0}: Couldn't reach the user accuracy ({1})".format(self._name, self._energyScaleAccuracy))
@@ -213,6 +295,23 @@ class EcalEnergyStep(CalibrationStep) :
             self._logger.info(" => ring calib factors : {0}".format(", ".join(map(str, self._outputEcalRingFactors))))
             self._logger.info("===============================================")
 
+    """ Start the ecal calibrator of a region ("Barrel" or "EndCap") on a root file. 
+        Call wait() on the returned calibrator to get its outputs
+    """
+    def _startEcalCalibrator(self, rootFile, region):
+        ecalCalibrator = EcalCalibrator()
+        ecalCalibrator.setPhotonEnergy(self._photonEnergy)
+        ecalCalibrator.setRootFile(rootFile)
+        ecalCalibrator.setDetectorRegion(region)
+
+        if region == "Barrel":
+            ecalCalibrator.setCosThetaRange(self._inputMinCosThetaBarrel, self._inputMaxCosThetaBarrel)
+        else:
+            ecalCalibrator.setCosThetaRange(self._inputMinCosThetaEndcap, self._inputMaxCosThetaEndcap)
+
+        ecalCalibrator.start()
+        return ecalCalibrator
+
     """ Write output (must be reimplemented)
     """
     def writeOutput(self, config):
@@ -237,6 +336,11 @@ class SplitRecoEcalEnergyStep(EcalEnergyStep):
         self._ecalRecoNames[1] = endcapReco if isinstance(endcapReco, str) else None
         self._ecalRecoNames[2] = ringReco if isinstance(ringReco, str) else None
     
+    """ The ecal hit reconstruction processors written in the step output
+    """
+    def outputProcessors(self):
+        return [name for name in self._ecalRecoNames if name]
+    
     """ Write step output
     """
     def writeOutput(self, config) :
@@ -278,6 +382,9 @@ class SplitRecoEcalEnergyStep(EcalEnergyStep):
         if endcapFactors and self._ecalRecoNames[1]:
             self._marlin.setProcessorParameter(self._ecalRecoNames[1], "calibration_factorsMipGev", " ".join(map(str, endcapFactors)))
 
+    def _modifiedProcessors(self):
+        return [name for name in self._ecalRecoNames[0:2] if name]
+
 ################################################################################
 """ ILDCaloDigiEcalEnergyStep class.
     Implementation of ecal calibration using the (DD)ILDCaloDigi processor
@@ -293,6 +400,11 @@ class ILDCaloDigiEcalEnergyStep(EcalEnergyStep):
     def setILDCaloDigiName(self, name):
         self._ildCaloDigiName = str(name)
     
+    """ The ILDCaloDigi processor written in the step output
+    """
+    def outputProcessors(self):
+        return [self._ildCaloDigiName]
+    
     """ Write step output
     """
     def writeOutput(self, config) :
@@ -326,4 +438,7 @@ class ILDCaloDigiEcalEnergyStep(EcalEnergyStep):
         ecalEndcapFactor = endcapFactors[0] / barrelFactors[0]
         self._marlin.setProcessorParameter(self._ildCaloDigiName, "ECALEndcapCorrectionFactor", str(ecalEndcapFactor))
 
+    def _modifiedProcessors(self):
+        return [self._ildCaloDigiName]
+
 #
@@ -1,5 +1,8 @@
 import linecache
 import os
+import re
+import hashlib
+import logging
 
 def getFileContent(fname, lid, tokenid) :
     line = linecache.getline(fname, lid)
@@ -7,29 +10,188 @@ def getFileContent(fname, lid, tokenid) :
     linecache.clearcache()
     return lineTokens[tokenid]
 
+""" Keys of the values written by the LCPandoraAnalysis binaries in their calibration files.
+    The keys are matched (regex search) on the lower case key with the non alphanumeric characters removed, 
+    and are anchored : each one matches a single line of the calibration file of its binary.
+    These keys were NOT taken from captured binary outputs or from the LCPandoraAnalysis sources, 
+    and the calibration files in tests/data/calibration were written by hand so that the values 
+    sit at the positions read by the positional parser. Until the keys are checked against 
+    captured outputs, the value is read at its position (see calibrationPositions) when no key matches
+"""
+calibrationKeys = {
+    "ecalMip" : r"^ecalmippeak$",
+    "hcalBarrelMip" : r"^hcalbarrelmippeak$",
+    "hcalEndcapMip" : r"^hcalendcapmippeak$",
+    "hcalRingMip" : r"^hcalothermippeak$",
+    "truePhotonEnergy" : r"^truephotonenergy$",
+    "ecalDigiMean" : r"^ecaldigimean$",
+    "hcalDigiMean" : r"^kaon0lhcaldigimean$",
+    "meanDirCorrEndcap" : r"^meandirectioncorrectionendcap$",
+    "meanDirCorrRing" : r"^meandirectioncorrectionother$",
+    "ecalToGeVMip" : r"^ecaltogevmip$",
+    "hcalToGeVMip" : r"^hcaltogevmip$",
+    "muonToGeVMip" : r"^muontogevmip$",
+    "ecalToEMMean" : r"^ecaltoemmean$",
+    "ecalToHadMean" : r"^ecaltohadgevcalibration$",
+    "hcalToHadMean" : r"^hcaltohadgevcalibration$",
+    "softCompWeight" : r"^parameterp\d+$"}
+
+""" Line and token (whitespace split, starting at 0) positions of the values in the calibration files, 
+    as read by the positional parser. Fallback when no key matches. 
+    For the software compensation weights : position of the first weight, one weight per line
+"""
+calibrationPositions = {
+    "ecalMip" : (10, 4),
+    "hcalBarrelMip" : (7, 5),
+    "hcalEndcapMip" : (8, 5),
+    "hcalRingMip" : (9, 5),
+    "truePhotonEnergy" : (6, 4),
+    "ecalDigiMean" : (11, 4),
+    "hcalDigiMean" : (9, 5),
+    "meanDirCorrEndcap" : (4, 5),
+    "meanDirCorrRing" : (9, 5),
+    "ecalToGeVMip" : (8, 2),
+    "hcalToGeVMip" : (16, 2),
+    "muonToGeVMip" : (24, 2),
+    "ecalToEMMean" : (9, 3),
+    "ecalToHadMean" : (5, 2),
+    "hcalToHadMean" : (6, 2),
+    "softCompWeight" : (8, 3)}
+
+""" Parse the "key : value" lines of a calibration file (":" or "=" separator).
+    Returns the list of (key, value tokens) in the file order. Lines without value are ignored
+"""
+def parseCalibrationFile(fname) :
+    if not os.path.isfile(fname) :
+        raise RuntimeError("Calibration file '{0}' doesn't exist".format(fname))
+
+    entries = []
+
+    with open(fname) as f :
+        for line in f :
+            match = re.match(r"\s*([^:=]*[^:=\s])\s*[:=](.*)", line)
+            if not match :
+                continue
+            tokens = [token for token in match.group(2).split() if token not in (":", "=")]
+            if tokens :
+                entries.append((match.group(1), tokens))
+
+    return entries
+
+def _normalizeKey(key) :
+    return re.sub(r"[^a-z0-9]", "", key.lower())
+
+""" Get the values of the entries (see parseCalibrationFile) whose key matches the pattern, in the file order
+"""
+def getCalibrationValues(entries, pattern, fname="") :
+    values = []
+
+    for key, tokens in entries :
+        if re.search(pattern, _normalizeKey(key)) :
+            try :
+                values.append(float(tokens[0]))
+            except ValueError :
+                raise RuntimeError("Calibration file '{0}': non numeric value '{1}' for key '{2}'".format(fname, tokens[0], key))
+
+    return values
+
+""" Read a numeric value at a line/token position of a calibration file (positional parser)
+"""
+def getPositionalValue(fname, line, token) :
+    try :
+        return float(getFileContent(fname, line, token))
+    except (IndexError, ValueError) :
+        raise RuntimeError("Calibration file '{0}': no numeric value at line {1}, token {2}".format(fname, line, token))
+
+""" Get the value of the unique entry (see parseCalibrationFile) whose key matches the pattern.
+    If no entry matches and a (line, token) position is given, the value is read at this position.
+    Raise an exception if several entries match or if no entry matches without position
+"""
+def getCalibrationValue(entries, pattern, fname="", position=None) :
+    values = getCalibrationValues(entries, pattern, fname)
+
+    if not values and position is not None :
+        logging.getLogger("fileTools").warning("Calibration file '{0}': no key matching '{1}', reading the value at line {2}, token {3}".format(fname, pattern, position[0], position[1]))
+        return getPositionalValue(fname, position[0], position[1])
+
+    if len(values) != 1 :
+        keys = [key for key, tokens in entries]
+        raise RuntimeError("Calibration file '{0}': expected one key matching '{1}', found {2} (keys: {3})".format(fname, pattern, len(values), keys))
+
+    return values[0]
+
+""" Get a value of a calibration file from its name (see calibrationKeys and calibrationPositions)
+"""
+def getCalibrationEntryValue(entries, name, fname) :
+    return getCalibrationValue(entries, calibrationKeys[name], fname, calibrationPositions[name])
+
+""" Get the software compensation weights from their keys, or from their positions if no key matches
+"""
+def getSoftwareCompensationEntryWeights(entries, fname, nWeights=9) :
+    weights = getCalibrationValues(entries, calibrationKeys["softCompWeight"], fname)
+
+    if not weights :
+        line, token = calibrationPositions["softCompWeight"]
+        logging.getLogger("fileTools").warning("Calibration file '{0}': no software compensation weight key, reading the weights from line {1}, token {2}".format(fname, line, token))
+        weights = [getPositionalValue(fname, line+w, token) for w in range(nWeights)]
+
+    if len(weights) != nWeights :
+        raise RuntimeError("Calibration file '{0}': expected {1} software compensation weights, found {2}".format(fname, nWeights, len(weights)))
+
+    return weights
+
+def getCalibrationFileValue(calibFile, name) :
+    return getCalibrationEntryValue(parseCalibrationFile(calibFile), name, calibFile)
+
 def removeFile(fname):
     try :
         os.remove(fname)
     except OSError:
         pass
 
+""" Compute the sha1 hash of a file content
+"""
+def hashFile(fname, blockSize=1<<20) :
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f :
+        for block in iter(lambda: f.read(blockSize), b'') :
+            sha1.update(block)
+    return sha1.hexdigest()
+
+""" Compute a fingerprint of a file content.
+    Small files are fully hashed. For large files (i.e lcio files), the size, 
+    the modification time and the hash of the first and last blocks are used
+"""
+def fileFingerprint(fname, maxHashSize=1<<20) :
+    size = os.path.getsize(fname)
+
+    if size <= maxHashSize :
+        return hashFile(fname)
+
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f :
+        sha1.update(f.read(maxHashSize//2))
+        f.seek(-maxHashSize//2, os.SEEK_END)
+        sha1.update(f.read())
+    return "{0}:{1}:{2}".format(size, int(os.path.getmtime(fname)), sha1.hexdigest())
+
 def getHcalBarrelMip(calibFile) :
-    return float(getFileContent(calibFile, 7, 5))
+    return getCalibrationFileValue(calibFile, "hcalBarrelMip")
 
 def getHcalEndcapMip(calibFile) :
-    return float(getFileContent(calibFile, 8, 5))
+    return getCalibrationFileValue(calibFile, "hcalEndcapMip")
 
 def getHcalRingMip(calibFile) :
-    return float(getFileContent(calibFile, 9, 5))
+    return getCalibrationFileValue(calibFile, "hcalRingMip")
 
 def getEcalMip(calibFile) :
-    return float(getFileContent(calibFile, 10, 4))
+    return getCalibrationFileValue(calibFile, "ecalMip")
 
 def getTruePhotonEnergy(calibFile) :
-    return float(getFileContent(calibFile, 6, 4))
+    return getCalibrationFileValue(calibFile, "truePhotonEnergy")
 
 def getEcalDigiMean(calibFile) :
-    return float(getFileContent(calibFile, 11, 4))
+    return getCalibrationFileValue(calibFile, "ecalDigiMean")
 
 def getEcalRescalingFactor(calibFile) :
     ten = getTruePhotonEnergy(calibFile)
@@ -37,46 +199,42 @@ def getEcalRescalingFactor(calibFile) :
     return ten/digi
 
 def getHcalDigiMean(calibFile) :
-    return float(getFileContent(calibFile, 9, 5))
+    return getCalibrationFileValue(calibFile, "hcalDigiMean")
 
 def getHcalRescalingFactor(calibFile, trueKaon0LEnergy) :
     hcalDigiMean = getHcalDigiMean(calibFile)
     return trueKaon0LEnergy / hcalDigiMean
 
 def getMeanDirCorrHcalEndcap(calibFile) :
-    return float(getFileContent(calibFile, 4, 5))
+    return getCalibrationFileValue(calibFile, "meanDirCorrEndcap")
 
 def getMeanDirCorrHcalRing(calibFile) :
-    return float(getFileContent(calibFile, 9, 5))
+    return getCalibrationFileValue(calibFile, "meanDirCorrRing")
 
 def getMeanDirCorrEcalEndcap(calibFile) :
-    return float(getFileContent(calibFile, 4, 5))
+    return getCalibrationFileValue(calibFile, "meanDirCorrEndcap")
 
 def getMeanDirCorrEcalRing(calibFile) :
-    return float(getFileContent(calibFile, 9, 5))
+    return getCalibrationFileValue(calibFile, "meanDirCorrRing")
 
 def getEcalToGeVMip(calibFile) :
-    return float(getFileContent(calibFile, 8, 2))
+    return getCalibrationFileValue(calibFile, "ecalToGeVMip")
 
 def getHcalToGeVMip(calibFile) :
-    return float(getFileContent(calibFile, 16, 2))
+    return getCalibrationFileValue(calibFile, "hcalToGeVMip")
 
 def getMuonToGeVMip(calibFile) :
-    return float(getFileContent(calibFile, 24, 2))
+    return getCalibrationFileValue(calibFile, "muonToGeVMip")
 
 def getEcalToEMMean(calibFile) :
-    return float(getFileContent(calibFile, 9, 3))
+    return getCalibrationFileValue(calibFile, "ecalToEMMean")
 
 def getEcalToHadMean(calibFile) :
-    return float(getFileContent(calibFile, 5, 2))
+    return getCalibrationFileValue(calibFile, "ecalToHadMean")
 
 def getHcalToHadMean(calibFile) :
-    return float(getFileContent(calibFile, 6, 2))
+    return getCalibrationFileValue(calibFile, "hcalToHadMean")
     
 def getSoftwareCompensationWeights(calibFile, nWeights=9):
-    weights = []
-    for w in range(0, nWeights):
-        weight = getFileContent(calibFile, 8+w, 3)
-        weights.append(weight)
-    return weights
+    return getSoftwareCompensationEntryWeights(parseCalibrationFile(calibFile), calibFile, nWeights)
 #
@@ -1,36 +1,100 @@
-
 import os
+import json
+import hashlib
+import logging
+import tempfile
+from distutils.spawn import find_executable
 from calibration.XmlTools import *
-import subprocess
+from calibration.FileTools import fileFingerprint
+from calibration.ProcessExecutor import getExecutor
+from calibration.Workspace import getWorkspace
+from calibration.GeometryCache import GeometryCache
 
 
+""" GearConverter class.
+    Convert a compact file to a gear file with the 'convertToGear' utility.
+    If a cache directory is set, the gear files are stored in the cache directory
+    as gear_<key>.xml, keyed on the content hash of the compact file (and its includes),
+    the plugin name and the toolchain (convertToGear binary and DD4hep environment, 
+    see GeometryCache.toolchainEnvironment), and reused by later conversions
+"""
 class GearConverter(object) :
+    _defaultCacheDirectory = None
+    # conversions done in this process : cache key -> gear file
+    _convertedFiles = {}
+
     def __init__(self):
         self._compactFile = ""
         self._pluginName = "default"
-    
+        self._cacheDirectory = GearConverter._defaultCacheDirectory
+        self._logger = logging.getLogger("gearConverter")
+
+    """ Set the default cache directory of the gear files (None for no cache)
+    """
+    @staticmethod
+    def setDefaultCacheDirectory(cacheDirectory):
+        GearConverter._defaultCacheDirectory = cacheDirectory
+
+    """ Set the cache directory of the gear files (None for no cache)
+    """
+    def setCacheDirectory(self, cacheDirectory):
+        self._cacheDirectory = cacheDirectory
+
     """ Set the Gear converter plugin to use for conversion
     """
     def setPluginName(self, plugin):
         self._pluginName = plugin
-    
+
     """ Set the compact file to convert
     """
     def setCompactFile(self, compactFile):
         self._compactFile = compactFile
-    
+
     """ Convert the compact file to gear file using 'convertToGear' utility
-        Use force to force its generation. If the gear file is already present
-        and the force option is activated, the file is not generated
+        Use force to force its generation. If the gear file of the same compact
+        file content and plugin is already present and the force option is not
+        activated, the file is not generated.
+        The gear file is written in the cache directory if set, else in the workspace run directory
     """
     def convertToGear(self, force=False) :
-        gearFile = "gear_" + os.path.split(self._compactFile)[1]
+        key = self._createKey()
+
+        if not force and key in GearConverter._convertedFiles and os.path.isfile(GearConverter._convertedFiles[key]):
+            return GearConverter._convertedFiles[key]
 
-        if os.path.isfile(gearFile) and not force:
-            return gearFile
+        if self._cacheDirectory:
+            cacheDirectory = os.path.abspath(self._cacheDirectory)
+            if not os.path.isdir(cacheDirectory):
+                os.makedirs(cacheDirectory)
+            gearFile = os.path.join(cacheDirectory, "gear_{0}.xml".format(key))
+        else:
+            gearFile = getWorkspace().path("gear_{0}_{1}".format(key[:12], os.path.split(self._compactFile)[1]))
 
-        args = ['convertToGear', self._pluginName, self._compactFile, gearFile]
-        process = subprocess.Popen(args = args)
-        if process.wait() :
-            raise RuntimeError("Couldn't convert compact file to gear file")
-        return gearFile
\ No newline at end of file
+        if force or not os.path.isfile(gearFile):
+            # convert to a temporary file then rename : concurrent conversions never see a partial gear file
+            fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(gearFile), prefix="gear_", suffix=".tmp")
+            os.close(fd)
+            args = ['convertToGear', self._pluginName, self._compactFile, tmpFile]
+            if not getExecutor().run(args).succeeded() :
+                if os.path.isfile(tmpFile):
+                    os.remove(tmpFile)
+                raise RuntimeError("Couldn't convert compact file to gear file")
+            os.rename(tmpFile, gearFile)
+        else:
+            self._logger.info("Reusing gear file {0}".format(gearFile))
+
+        GearConverter._convertedFiles[key] = gearFile
+        return gearFile
+
+    """ The key of a conversion : content hash of the compact file and its includes, plugin name, 
+        fingerprint of the convertToGear binary and DD4hep environment
+    """
+    def _createKey(self):
+        executable = find_executable("convertToGear")
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps({
+            "plugin" : self._pluginName,
+            "converter" : fileFingerprint(executable) if executable else None,
+            "toolchain" : GeometryCache.toolchainEnvironment(),
+            "files" : GeometryCache.hashCompactFile(self._compactFile)}, sort_keys=True))
+        return sha1.hexdigest()
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+from calibration.XmlTools import *
+from calibration.FileTools import hashFile
+
+""" GeometryCache class.
+
+    On-disk cache of the geometry summaries of DD4hep compact files
+    (calorimeter extents and layer thicknesses, see DDGeometryInterface.getSummary).
+    A cache entry is keyed on the content hash of the compact file and of all the
+    files it includes (recursively), and on the DD4hep toolchain (library path and 
+    installation environment variables) building the geometry. 
+    Each entry is a json file <cacheDir>/<key>.json.
+"""
+class GeometryCache(object):
+    # increase when the summary content changes
+    _formatVersion = 1
+    # environment variables selecting the DD4hep and lcgeo installations
+    _toolchainVariables = ["LD_LIBRARY_PATH", "DD4HEP", "DD4hepINSTALL", "lcgeo_DIR"]
+
+    def __init__(self, cacheDir):
+        self._cacheDir = os.path.abspath(cacheDir)
+        self._logger = logging.getLogger("geometryCache")
+
+        if not os.path.isdir(self._cacheDir):
+            os.makedirs(self._cacheDir)
+
+    def cacheDir(self):
+        return self._cacheDir
+
+    """ Compute the cache key of a compact file
+    """
+    def createKey(self, compactFile):
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps({
+            "version" : GeometryCache._formatVersion,
+            "toolchain" : GeometryCache.toolchainEnvironment(),
+            "files" : GeometryCache.hashCompactFile(compactFile)}, sort_keys=True))
+        return sha1.hexdigest()
+
+    """ The environment variables selecting the DD4hep toolchain : variable -> value (None if not set)
+    """
+    @staticmethod
+    def toolchainEnvironment():
+        return {variable : os.environ.get(variable) for variable in GeometryCache._toolchainVariables}
+
+    """ Hash the content of a compact file and of the files it includes.
+        Returns a list of [path relative to the compact file directory, hash]
+    """
+    @staticmethod
+    def hashCompactFile(compactFile):
+        compactFile = os.path.abspath(compactFile)
+        return GeometryCache._hashIncludes(compactFile, os.path.dirname(compactFile), set())
+
+    """ Get the geometry summary stored in a cache entry. Returns None if the entry doesn't exist
+    """
+    def get(self, key):
+        entryFile = self._entryFile(key)
+
+        if not os.path.isfile(entryFile):
+            return None
+
+        with open(entryFile) as f:
+            entry = json.load(f)
+
+        self._logger.debug("Geometry cache hit {0} (created {1})".format(key, time.ctime(entry["created"])))
+        return entry["summary"]
+
+    """ Store a geometry summary (detector name -> calorimeter data)
+    """
+    def store(self, key, summary, metadata=None):
+        entry = dict(metadata) if metadata else {}
+        entry.update({"key" : key, "created" : time.time(), "summary" : summary})
+
+        # write then rename : concurrent runs never see a partial entry
+        fd, tmpFile = tempfile.mkstemp(dir=self._cacheDir, suffix=".tmp")
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f, indent=2, sort_keys=True)
+
+        os.rename(tmpFile, self._entryFile(key))
+        self._logger.debug("Stored geometry summary in cache entry {0}".format(key))
+
+    """ Remove all the cache entries
+    """
+    def clear(self):
+        for fname in os.listdir(self._cacheDir):
+            if fname.endswith(".json"):
+                try:
+                    os.remove(os.path.join(self._cacheDir, fname))
+                except OSError:
+                    pass
+
+    def _entryFile(self, key):
+        return os.path.join(self._cacheDir, key + ".json")
+
+    """ Hash a compact file and the files it references (include, gdmlFile, file elements).
+        Returns a list of [path relative to the compact file directory, hash].
+        Missing files are keyed on their path only
+    """
+    @staticmethod
+    def _hashIncludes(fname, baseDirectory, visited):
+        if fname in visited:
+            return []
+
+        visited.add(fname)
+        reference = os.path.relpath(fname, baseDirectory)
+
+        if not os.path.isfile(fname):
+            return [[reference, None]]
+
+        hashes = [[reference, hashFile(fname)]]
+
+        if not fname.endswith(".xml"):
+            return hashes
+
+        try:
+            tree = etree.parse(fname, createXMLParser())
+        except Exception:
+            return hashes
+
+        directory = os.path.dirname(fname)
+
+        for element in tree.iter("include", "gdmlFile", "file"):
+            ref = element.get("ref")
+            if not ref:
+                continue
+            ref = os.path.expandvars(ref)
+            hashes.extend(GeometryCache._hashIncludes(os.path.normpath(os.path.join(directory, ref)), baseDirectory, visited))
+
+        return hashes
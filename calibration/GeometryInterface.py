@@ -1,30 +1,64 @@
-
-
 from math import *
 import os
+import logging
 from calibration.XmlTools import *
-import subprocess
-import ROOT
-from ROOT import gROOT
-gROOT.SetBatch(1)
-import DD4hep
-import DDRec
+from calibration.GeometryCache import GeometryCache
 import calibration.SystemOfUnits as ddunits
 
+""" Load the DD4hep python modules (slow, only when a compact file has to be loaded)
+"""
+def _importDD4hep():
+    from ROOT import gROOT
+    gROOT.SetBatch(1)
+    import DD4hep
+    import DDRec
+    return DD4hep, DDRec
+
+""" DDGeometryInterface class.
+    Geometry quantities (extents, cos(theta) ranges, geometry factors) of the calorimeters
+    of a DD4hep compact file. The calorimeter data used by the calibration
+    are read once per detector and kept in a summary (detector name -> data)
+"""
 class DDGeometryInterface(object):
     def __init__(self, compactFile):
         self._compactFile = compactFile
+        self._summary = {}
+        DD4hep, self._DDRec = _importDD4hep()
         DD4hep.setPrintLevel(DD4hep.OutputLevel.ERROR)
         self._description = DD4hep.Detector.getInstance()
         self._description.fromXML(self._compactFile)
         
     def _getDetector(self, dname):
         return self._description.detector(dname)
+
+    """ Get the calorimeter data of a detector : extent and layer thicknesses (unit mm)
+    """
+    def _getCaloData(self, dname):
+        if dname not in self._summary:
+            data = self._DDRec.LayeredCalorimeterData(self._getDetector(dname))
+            layers = [{"inner_thickness" : layer.inner_thickness/ddunits.mm, 
+                       "outer_thickness" : layer.outer_thickness/ddunits.mm, 
+                       "sensitive_thickness" : layer.sensitive_thickness/ddunits.mm} for layer in data.layers]
+            self._summary[dname] = {"extent" : [data.extent[i]/ddunits.mm for i in range(4)], "layers" : layers}
+
+        return self._summary[dname]
+
+    """ Get the calorimeter data of the detectors (detector name -> data).
+        The detectors not found in the geometry are skipped
+    """
+    def getSummary(self, detectors):
+        summary = {}
+
+        for dname in detectors:
+            try:
+                summary[dname] = self._getCaloData(dname)
+            except Exception:
+                continue
+
+        return summary
     
     def getCaloExtent(self, dname, ext):
-        detector = self._getDetector(dname)
-        data = DDRec.LayeredCalorimeterData(detector)
-        return data.extent[ext]/ddunits.mm
+        return self._getCaloData(dname)["extent"][ext]
 
     def getCaloInnerR(self, dname):
         return self.getCaloExtent(dname, 0)
@@ -72,25 +106,21 @@ class DDGeometryInterface(object):
         f = (Abs_endcap / Abs_ring) * (Sens_ring / Sens_endcap)
     """
     def getCalorimeterGeometryFactor(self, endcapName, ringName):
-        endcapDetector = self._getDetector(endcapName)
-        plugDetector = self._getDetector(ringName)
         endcapAbsorberSum = 0
         endcapSensitiveSum = 0
         plugAbsorberSum = 0
         plugSensitiveSum = 0
-        endcapData = DDRec.LayeredCalorimeterData(endcapDetector)
-        plugData = DDRec.LayeredCalorimeterData(plugDetector)
             
-        for layer in endcapData.layers:
-            totalThickness = (layer.inner_thickness+layer.inner_thickness)/ddunits.mm
-            senitiveThickness = layer.sensitive_thickness/ddunits.mm
+        for layer in self._getCaloData(endcapName)["layers"]:
+            totalThickness = layer["inner_thickness"]+layer["inner_thickness"]
+            senitiveThickness = layer["sensitive_thickness"]
             absorberThickness = totalThickness - senitiveThickness
             endcapAbsorberSum = endcapAbsorberSum + absorberThickness
             endcapSensitiveSum = endcapSensitiveSum + senitiveThickness
 
-        for layer in plugData.layers:
-            totalThickness = (layer.inner_thickness+layer.inner_thickness)/ddunits.mm
-            senitiveThickness = layer.sensitive_thickness/ddunits.mm
+        for layer in self._getCaloData(ringName)["layers"]:
+            totalThickness = layer["inner_thickness"]+layer["inner_thickness"]
+            senitiveThickness = layer["sensitive_thickness"]
             absorberThickness = totalThickness - senitiveThickness
             plugAbsorberSum = plugAbsorberSum + absorberThickness
             plugSensitiveSum = plugSensitiveSum + senitiveThickness
@@ -110,15 +140,24 @@ class DDGeometryInterface(object):
     def getHcalGeometryFactor(self, hcname="HcalEndcap", hrname="HcalRing"):
         return self.getCalorimeterGeometryFactor(hcname, hrname)
 
+""" GeometryInterface class.
+    Geometry quantities of the calorimeters read from a GEAR file.
+    The detectors are indexed by (name, geartype) on load and the
+    outer extents are computed once
+"""
 class GeometryInterface(object) :
     def __init__(self, gearFile):
         self._gearFile = gearFile
         parser = createXMLParser()
         self._xmlTree = etree.parse(self._gearFile, parser)
+        self._detectors = {}
+        self._extents = {}
+
+        for detector in self._xmlTree.xpath("//gear/detectors/detector"):
+            self._detectors.setdefault((detector.get("name"), detector.get("geartype")), detector)
     
     def _getGearDetector(self, dname, dtype) :
-        elements = self._xmlTree.xpath("//gear/detectors/detector[@name='{0}'][@geartype='{1}']".format(dname, dtype))
-        return None if not len(elements) else elements[0] 
+        return self._detectors.get((dname, dtype))
     
     def getDetectorDimmensions(self, dname, dtype) :
         detector = self._getGearDetector(dname, dtype)
@@ -132,21 +171,7 @@ class GeometryInterface(object) :
             return dimensions.get("inner_r")
     
     def getDetectorOuterR(self, dname, dtype) :
-        dimensions = self.getDetectorDimmensions(dname, dtype)
-        if dimensions is not None :
-            outerR = dimensions.get("outer_r")
-            if outerR is not None :
-                return float(outerR)
-            else :
-                innerR = float(self.getDetectorInnerR(dname, dtype))
-                layers = dimensions.getparent().findall("layer")
-                outerR = innerR
-                for l in layers :
-                    repeat = int(l.get("repeat"))
-                    thickness = float(l.get("thickness"))
-                    outerR = outerR + repeat*thickness
-                return outerR
-        return None
+        return self._getOuterExtent(dname, dtype, "outer_r", "inner_r")
     
     def getDetectorInnerZ(self, dname, dtype) :
         dimensions = self.getDetectorDimmensions(dname, dtype)
@@ -154,21 +179,34 @@ class GeometryInterface(object) :
             return dimensions.get("inner_z")
         
     def getDetectorOuterZ(self, dname, dtype) :
+        return self._getOuterExtent(dname, dtype, "outer_z", "inner_z")
+
+    """ Get an outer extent of a detector (outer_r or outer_z).
+        If not specified in the dimensions, the outer extent is the inner extent
+        plus the thickness of the layers
+    """
+    def _getOuterExtent(self, dname, dtype, outerName, innerName) :
+        key = (dname, dtype, outerName)
+
+        if key in self._extents :
+            return self._extents[key]
+
+        extent = None
         dimensions = self.getDetectorDimmensions(dname, dtype)
+
         if dimensions is not None :
-            outerZ = dimensions.get("outer_z")
-            if outerZ is not None :
-                return float(outerZ)
+            outer = dimensions.get(outerName)
+            if outer is not None :
+                extent = float(outer)
             else :
-                innerZ = float(self.getDetectorInnerZ(dname, dtype))
-                layers = dimensions.getparent().findall("layer")
-                outerZ = innerZ
-                for l in layers :
+                extent = float(dimensions.get(innerName))
+                for l in dimensions.getparent().findall("layer") :
                     repeat = int(l.get("repeat"))
                     thickness = float(l.get("thickness"))
-                    outerZ = outerZ + repeat*thickness
-                return outerZ
-        return None
+                    extent = extent + repeat*thickness
+
+        self._extents[key] = extent
+        return extent
 
     def getEcalBarrelCosThetaRange(self) :
         ecalBarrelOuterR = float(self.getDetectorOuterR("EcalBarrel", "CalorimeterParameters"))
@@ -247,4 +285,38 @@ class GeometryInterface(object) :
     def getHcalGeometryFactor(self):
         return self.getCalorimeterGeometryFactor("HcalEndcap", "HcalRing")
         
-#
\ No newline at end of file
+#
+""" CachedGeometryInterface class.
+    Same interface as DDGeometryInterface, answering from the geometry summary
+    stored in a GeometryCache. DD4hep is loaded only if the summary is not
+    cached yet (or lacks a requested detector), the summary is then stored in the cache
+"""
+class CachedGeometryInterface(DDGeometryInterface):
+    # the calorimeters used by the calibration steps, summarized on cache miss
+    _summaryDetectors = ["EcalBarrel", "EcalEndcap", "EcalPlug", "HcalBarrel", "HcalEndcap", "HcalRing"]
+
+    def __init__(self, compactFile, cacheDir):
+        self._compactFile = compactFile
+        self._cache = GeometryCache(cacheDir)
+        self._key = self._cache.createKey(compactFile)
+        self._summary = self._cache.get(self._key) or {}
+        self._geometry = None
+        self._logger = logging.getLogger("geometry")
+
+    def _getDetector(self, dname):
+        return self._getDDGeometry()._getDetector(dname)
+
+    def _getCaloData(self, dname):
+        if dname not in self._summary:
+            geometry = self._getDDGeometry()
+            self._summary.update(geometry.getSummary(CachedGeometryInterface._summaryDetectors))
+            self._summary[dname] = geometry._getCaloData(dname)
+            self._cache.store(self._key, self._summary, {"compactFile" : os.path.abspath(self._compactFile)})
+
+        return self._summary[dname]
+
+    def _getDDGeometry(self):
+        if self._geometry is None:
+            self._logger.info("Geometry summary not cached, loading compact file {0}".format(self._compactFile))
+            self._geometry = DDGeometryInterface(self._compactFile)
+        return self._geometry
@@ -2,6 +2,7 @@
 
 from calibration.CalibrationStep import CalibrationStep
 from calibration.Marlin import Marlin
+from calibration.RegionSkimmer import RegionSkimmer
 from calibration.PandoraAnalysis import *
 from calibration.FileTools import *
 import os, sys
@@ -79,6 +80,11 @@ class HcalEnergyStep(CalibrationStep) :
 
         self._maxNIterations = int(parsed.maxNIterations)
         self._energyScaleAccuracy = float(parsed.hcalCalibrationAccuracy)
+        self._convergenceStrategy = parsed.convergenceStrategy
+        self.setBracketScales([scale for scale in parsed.bracketScales.split(",") if scale])
+        self.setBracketSinglePass(parsed.bracketSinglePass)
+        self.setEventSchedule([nEvents for nEvents in parsed.eventSchedule.split(",") if nEvents])
+        self.setRegionSkimDirectory(parsed.regionSkimDirectory)
         
         if self._runRingCalibration:
             self._inputHcalRingGeometryFactor = self._getGeometry().getHcalGeometryFactor()
@@ -99,6 +105,9 @@ class HcalEnergyStep(CalibrationStep) :
         if len(self._turnoffProcessors):
             self._marlin.turnOffProcessors(self._turnoffProcessors)
 
+        self._pruneMarlinProcessors(self._marlin)
+        self._marlin.setCheckpointProcessors(self._modifiedProcessors())
+
 
     def run(self, config) :
 
@@ -108,68 +117,157 @@ class HcalEnergyStep(CalibrationStep) :
 
         barrelRescaleFactor = 1.
         endcapRescaleFactor = 1.
-        barrelRescaleFactorCumul = 1.
-        endcapRescaleFactorCumul = 1.
+
+        newBarrelKaon0LEnergy = 0.
+        newEndcapKaon0LEnergy = 0.
+
+        barrelStatisticalError = None
+        endcapStatisticalError = None
 
         barrelAccuracyReached = False
         endcapAccuracyReached = False
 
-        hcalBarrelFactors = self.hcalBarrelEnergyFactors()
-        hcalEndcapFactors = self.hcalEndcapEnergyFactors()
+        inputHcalBarrelFactors = self.hcalBarrelEnergyFactors()
+        inputHcalEndcapFactors = self.hcalEndcapEnergyFactors()
+        hcalBarrelFactors = list(inputHcalBarrelFactors)
+        hcalEndcapFactors = list(inputHcalEndcapFactors)
+
+        # scales of the input factors, driven by the convergence strategy
+        barrelConvergence = self._createConvergenceStrategy([self._kaon0LEnergy])
+        endcapConvergence = self._createConvergenceStrategy([self._kaon0LEnergy])
 
         pfoAnalysisFile = ""
+        ringCalibrator = None
         
-        hcalEnergyCalibrator = HcalCalibrator()
-        hcalEnergyCalibrator.setKaon0LEnergy(self._kaon0LEnergy)
+        # split the input in regions. The ring calibration uses the endcap and 
+        # ring events of the last iteration, they are always processed in this case
+        regionFiles = self._skimRegions([
+            ("Barrel", self._inputMinCosThetaBarrel, self._inputMaxCosThetaBarrel),
+            ("EndCap", self._inputMinCosThetaEndcap, self._inputMaxCosThetaEndcap)])
+        runRegions = ["Barrel", "EndCap", RegionSkimmer.OTHER] if self._runRingCalibration else ["Barrel", "EndCap"]
+
+        if regionFiles is not None:
+            self._setRegionInputFiles(regionFiles, runRegions)
+
+        # event schedule : the first iterations may use a reduced statistics
+        fullNEvents = self._getMarlinIntGlobalParameter("MaxRecordNumber")
+        scheduleStage = 0
+
+        # bracket mode : run the candidate scales concurrently and fit the response
+        if self._bracketScales:
+            def configureBracketPass(scale, rootFile):
+                self.setEnergyFactors([factor*scale for factor in inputHcalBarrelFactors], [factor*scale for factor in inputHcalEndcapFactors])
+                self._marlin.setProcessorParameter(self._pfoAnalysisProcessor, "RootFile", rootFile)
+                self._marlin.setProcessorParameter("MyPfoAnalysis"   , "RootFile", rootFile)
+
+            barrelResponses = []
+            endcapResponses = []
+            barrelErrors = []
+            endcapErrors = []
+            fullStatistics = self._setScheduledStatistics(scheduleStage, fullNEvents)
+            bracketRootFiles = self._runBracketPasses(configureBracketPass)
+
+            # start the region analyses of all the candidates at once
+            calibrators = [(self._startHcalCalibrator(rootFile, "Barrel"), self._startHcalCalibrator(rootFile, "EndCap")) for rootFile in bracketRootFiles]
+
+            for index, (barrelCalibrator, endcapCalibrator) in enumerate(calibrators):
+                barrelCalibrator.wait()
+                barrelResponses.append([barrelCalibrator.getHcalDigiMean()])
+                barrelErrors.append([barrelCalibrator.getHcalDigiMeanError()])
+
+                endcapCalibrator.wait()
+                endcapResponses.append([endcapCalibrator.getHcalDigiMean()])
+                endcapErrors.append([endcapCalibrator.getHcalDigiMeanError()])
+
+                self._writeIterationOutput(config, "bracket{0}".format(index),
+                    {"scale" : self._bracketScales[index],
+                     "nEvents" : self._marlin.getGlobalParameter("MaxRecordNumber"),
+                     "newBarrelKaon0LEnergy" : barrelResponses[-1][0],
+                     "barrelStatisticalError" : barrelErrors[-1][0],
+                     "newEndcapKaon0LEnergy" : endcapResponses[-1][0],
+                     "endcapStatisticalError" : endcapErrors[-1][0]})
+
+            barrelConvergence.addMeasurements([[scale] for scale in self._bracketScales], barrelResponses, barrelErrors)
+            endcapConvergence.addMeasurements([[scale] for scale in self._bracketScales], endcapResponses, endcapErrors)
+
+            if barrelConvergence.checkConvergence(self._energyScaleAccuracy, fullStatistics):
+                barrelAccuracyReached = True
+                self._outputHcalBarrelFactors = [factor*barrelConvergence.convergedScales()[0] for factor in inputHcalBarrelFactors]
+
+            if endcapConvergence.checkConvergence(self._energyScaleAccuracy, fullStatistics):
+                endcapAccuracyReached = True
+                self._outputHcalEndcapFactors = [factor*endcapConvergence.convergedScales()[0] for factor in inputHcalEndcapFactors]
+
+            # the ring calibration uses the candidate closest to the endcap solution (converged or fitted scale)
+            endcapScale = endcapConvergence.convergedScales()[0] if endcapAccuracyReached else endcapConvergence.nextScales()[0]
+            closestIndex = min(range(len(self._bracketScales)), key=lambda index: abs(self._bracketScales[index] - endcapScale))
+            pfoAnalysisFile = bracketRootFiles[closestIndex]
+
+            scheduleStage = self._nextScheduleStage(scheduleStage, fullStatistics,
+                barrelConvergence.isStatisticallyResolved(self._energyScaleAccuracy) and endcapConvergence.isStatisticallyResolved(self._energyScaleAccuracy),
+                barrelConvergence.isNextPassPredictedConverged(self._energyScaleAccuracy) and endcapConvergence.isNextPassPredictedConverged(self._energyScaleAccuracy))
 
         for iteration in range(self._maxNIterations) :
 
+            if barrelAccuracyReached and endcapAccuracyReached :
+                break
+
             # readjust iteration parameters
-            if not barrelAccuracyReached:
-                for index in range(len(hcalBarrelFactors)):
-                    hcalBarrelFactors[index] = hcalBarrelFactors[index]*barrelRescaleFactor
-                    
-            if not endcapAccuracyReached:
-                for index in range(len(hcalEndcapFactors)):
-                    hcalEndcapFactors[index] = hcalEndcapFactors[index]*endcapRescaleFactor
+            barrelScale = barrelConvergence.nextScales()[0]
+            endcapScale = endcapConvergence.nextScales()[0]
+            hcalBarrelFactors = [factor*barrelScale for factor in inputHcalBarrelFactors]
+            hcalEndcapFactors = [factor*endcapScale for factor in inputHcalEndcapFactors]
+
+            pfoAnalysisFile = self._workspacePath("PfoAnalysis_{0}_iter{1}.root".format(self._name, iteration), iteration)
 
-            pfoAnalysisFile = "./PfoAnalysis_{0}_iter{1}.root".format(self._name, iteration)
+            # only process the regions still to calibrate
+            if regionFiles is not None:
+                convergedRegions = ["Barrel"] if barrelAccuracyReached else []
+                if endcapAccuracyReached and not self._runRingCalibration:
+                    convergedRegions.append("EndCap")
+                self._setRegionInputFiles(regionFiles, [region for region in runRegions if region not in convergedRegions])
 
             # run marlin ...
+            fullStatistics = self._setScheduledStatistics(scheduleStage, fullNEvents)
             self.setEnergyFactors(hcalBarrelFactors, hcalEndcapFactors)
             self._marlin.setProcessorParameter(self._pfoAnalysisProcessor, "RootFile", pfoAnalysisFile)
             self._marlin.setProcessorParameter("MyPfoAnalysis"   , "RootFile", pfoAnalysisFile)
             self._marlin.run()
 
+            # start the analyses of the regions still to calibrate, they run concurrently
+            barrelCalibrator = self._startHcalCalibrator(pfoAnalysisFile, "Barrel") if not barrelAccuracyReached else None
+            endcapCalibrator = self._startHcalCalibrator(pfoAnalysisFile, "EndCap") if not endcapAccuracyReached else None
+
+            # only a full statistics pass can be the last one : start the ring analysis 
+            # with the endcap analysis on the same root file
+            if self._runRingCalibration and fullStatistics:
+                ringCalibrator = self._startHcalRingCalibrator(pfoAnalysisFile)
+
             # run calibration for barrel
             if not barrelAccuracyReached:
-                hcalEnergyCalibrator.setRootFile(pfoAnalysisFile)
-                hcalEnergyCalibrator.setDetectorRegion("Barrel")
-                hcalEnergyCalibrator.setCosThetaRange(self._inputMinCosThetaBarrel, self._inputMaxCosThetaBarrel)
-                hcalEnergyCalibrator.run()
+                barrelCalibrator.wait()
                 
-                newBarrelKaon0LEnergy = hcalEnergyCalibrator.getHcalDigiMean()
+                newBarrelKaon0LEnergy = barrelCalibrator.getHcalDigiMean()
+                barrelStatisticalError = barrelCalibrator.getHcalDigiMeanError()
+                barrelConvergence.addMeasurement([barrelScale], [newBarrelKaon0LEnergy], [barrelStatisticalError])
                 barrelRescaleFactor = float(self._kaon0LEnergy) / newBarrelKaon0LEnergy
-                barrelRescaleFactorCumul = barrelRescaleFactorCumul*barrelRescaleFactor
-                barrelCurrentPrecision = abs(1 - 1. / barrelRescaleFactor)                
+                barrelCurrentPrecision = barrelConvergence.precisions()[0]
 
             # run calibration for endcap
             if not endcapAccuracyReached:
-                hcalEnergyCalibrator.setRootFile(pfoAnalysisFile)
-                hcalEnergyCalibrator.setDetectorRegion("EndCap")
-                hcalEnergyCalibrator.setCosThetaRange(self._inputMinCosThetaEndcap, self._inputMaxCosThetaEndcap)
-                hcalEnergyCalibrator.run()
+                endcapCalibrator.wait()
                 
-                newEndcapKaon0LEnergy = hcalEnergyCalibrator.getHcalDigiMean()
+                newEndcapKaon0LEnergy = endcapCalibrator.getHcalDigiMean()
+                endcapStatisticalError = endcapCalibrator.getHcalDigiMeanError()
+                endcapConvergence.addMeasurement([endcapScale], [newEndcapKaon0LEnergy], [endcapStatisticalError])
                 endcapRescaleFactor = float(self._kaon0LEnergy) / newEndcapKaon0LEnergy
-                endcapRescaleFactorCumul = endcapRescaleFactorCumul*endcapRescaleFactor
-                endcapCurrentPrecision = abs(1 - 1. / endcapRescaleFactor)
+                endcapCurrentPrecision = endcapConvergence.precisions()[0]
 
             self._logger.info("=============================================")
             self._logger.info("======= Barrel output for iteration {0} =======".format(iteration))
             self._logger.info(" => calibrationFactors : {0}".format(", ".join(map(str, hcalBarrelFactors))))
             self._logger.info(" => calibrationRescaleFactor : " + str(barrelRescaleFactor))
-            self._logger.info(" => calibrationRescaleFactorCumul : " + str(barrelRescaleFactorCumul))
+            self._logger.info(" => calibrationRescaleFactorCumul : " + str(barrelScale))
             self._logger.info(" => currentPrecision : " + str(barrelCurrentPrecision))
             self._logger.info(" => newKaon0LEnergy : " + str(newBarrelKaon0LEnergy))
             self._logger.info("=============================================")
@@ -178,45 +276,54 @@ class HcalEnergyStep(CalibrationStep) :
             self._logger.info("======= Endcap output for iteration {0} =======".format(iteration))
             self._logger.info(" => calibrationFactors : {0}".format(", ".join(map(str, hcalEndcapFactors))))
             self._logger.info(" => calibrationRescaleFactor : " + str(endcapRescaleFactor))
-            self._logger.info(" => calibrationRescaleFactorCumul : " + str(endcapRescaleFactorCumul))
+            self._logger.info(" => calibrationRescaleFactorCumul : " + str(endcapScale))
             self._logger.info(" => currentPrecision : " + str(endcapCurrentPrecision))
             self._logger.info(" => newKaon0LEnergy : " + str(newEndcapKaon0LEnergy))
             self._logger.info("=============================================")
 
             # write down iteration results
             self._writeIterationOutput(config, iteration,
-                {"barrelPrecision" : barrelCurrentPrecision,
-                 "barrelRescale" : barrelRescaleFactor,
+                {"nEvents" : self._marlin.getGlobalParameter("MaxRecordNumber"),
+                 "barrelPrecision" : barrelCurrentPrecision,
                  "barrelRescale" : barrelRescaleFactor,
                  "newBarrelKaon0LEnergy" : newBarrelKaon0LEnergy,
+                 "barrelStatisticalError" : barrelStatisticalError,
                  "endcapPrecision" : endcapCurrentPrecision,
                  "endcapRescale" : endcapRescaleFactor,
-                 "newEndcapKaon0LEnergy" : newEndcapKaon0LEnergy})
+                 "newEndcapKaon0LEnergy" : newEndcapKaon0LEnergy,
+                 "endcapStatisticalError" : endcapStatisticalError}, self._marlin.getOverlay())
 
             # are we accurate enough ??
-            if barrelCurrentPrecision < self._energyScaleAccuracy and not barrelAccuracyReached:
+            if not barrelAccuracyReached and barrelConvergence.checkConvergence(self._energyScaleAccuracy, fullStatistics):
                 barrelAccuracyReached = True
-                self._outputHcalBarrelFactors = hcalBarrelFactors
+                self._outputHcalBarrelFactors = [factor*barrelConvergence.convergedScales()[0] for factor in inputHcalBarrelFactors]
 
             # are we accurate enough ??
-            if endcapCurrentPrecision < self._energyScaleAccuracy and not endcapAccuracyReached:
+            if not endcapAccuracyReached and endcapConvergence.checkConvergence(self._energyScaleAccuracy, fullStatistics):
                 endcapAccuracyReached = True
-                self._outputHcalEndcapFactors = hcalEndcapFactors
+                self._outputHcalEndcapFactors = [factor*endcapConvergence.convergedScales()[0] for factor in inputHcalEndcapFactors]
 
-            if barrelAccuracyReached and endcapAccuracyReached :
-                break
+            scheduleStage = self._nextScheduleStage(scheduleStage, fullStatistics,
+                barrelConvergence.isStatisticallyResolved(self._energyScaleAccuracy) and endcapConvergence.isStatisticallyResolved(self._energyScaleAccuracy),
+                barrelConvergence.isNextPassPredictedConverged(self._energyScaleAccuracy) and endcapConvergence.isNextPassPredictedConverged(self._energyScaleAccuracy))
+
+            # not the last pass : the ring analysis of the next pass replaces this one
+            if ringCalibrator is not None and not (barrelAccuracyReached and endcapAccuracyReached):
+                ringCalibrator.wait()
+                ringCalibrator = None
 
         if not barrelAccuracyReached or not endcapAccuracyReached :
             raise RuntimeError("{0}: Couldn't reach the user accuracy ({1})".format(self._name, self._energyScaleAccuracy))
 
         if self._runRingCalibration:
-            hcalRingCalibrator = HcalRingCalibrator()
-            hcalRingCalibrator.setRootFile(pfoAnalysisFile)
-            hcalRingCalibrator.setKaon0LEnergy(self._kaon0LEnergy)
-            hcalRingCalibrator.run()
+            # converged in bracket mode : no pass of the loop started the ring analysis
+            if ringCalibrator is None:
+                ringCalibrator = self._startHcalRingCalibrator(pfoAnalysisFile)
+
+            ringCalibrator.wait()
 
-            directionCorrectionEndcap = hcalRingCalibrator.getEndcapMeanDirectionCorrection()
-            directionCorrectionRing = hcalRingCalibrator.getRingMeanDirectionCorrection()
+            directionCorrectionEndcap = ringCalibrator.getEndcapMeanDirectionCorrection()
+            directionCorrectionRing = ringCalibrator.getRingMeanDirectionCorrection()
             directionCorrectionRatio = directionCorrectionEndcap / directionCorrectionRing
 
             # compute hcal ring factor
@@ -229,6 +336,33 @@ class HcalEnergyStep(CalibrationStep) :
             self._logger.info("===============================================")
 
 
+    """ Start the hcal calibrator of a region ("Barrel" or "EndCap") on a root file. 
+        Call wait() on the returned calibrator to get its outputs
+    """
+    def _startHcalCalibrator(self, rootFile, region):
+        hcalEnergyCalibrator = HcalCalibrator()
+        hcalEnergyCalibrator.setKaon0LEnergy(self._kaon0LEnergy)
+        hcalEnergyCalibrator.setRootFile(rootFile)
+        hcalEnergyCalibrator.setDetectorRegion(region)
+
+        if region == "Barrel":
+            hcalEnergyCalibrator.setCosThetaRange(self._inputMinCosThetaBarrel, self._inputMaxCosThetaBarrel)
+        else:
+            hcalEnergyCalibrator.setCosThetaRange(self._inputMinCosThetaEndcap, self._inputMaxCosThetaEndcap)
+
+        hcalEnergyCalibrator.start()
+        return hcalEnergyCalibrator
+
+    """ Start the hcal ring calibrator on a root file. 
+        Call wait() on the returned calibrator to get its outputs
+    """
+    def _startHcalRingCalibrator(self, rootFile):
+        hcalRingCalibrator = HcalRingCalibrator()
+        hcalRingCalibrator.setRootFile(rootFile)
+        hcalRingCalibrator.setKaon0LEnergy(self._kaon0LEnergy)
+        hcalRingCalibrator.start()
+        return hcalRingCalibrator
+
     """ Write output (must be reimplemented)
     """
     def writeOutput(self, config):
@@ -263,6 +397,11 @@ class SplitRecoHcalEnergyStep(HcalEnergyStep):
         self._hcalDigiNames[1] = endcapDigi if isinstance(endcapDigi, str) else None
         self._hcalDigiNames[2] = ringDigi if isinstance(ringDigi, str) else None
     
+    """ The hcal hit reconstruction processors written in the step output
+    """
+    def outputProcessors(self):
+        return [name for name in self._hcalRecoNames if name]
+    
     """ Write step output
     """
     def writeOutput(self, config) :
@@ -303,6 +442,9 @@ class SplitRecoHcalEnergyStep(HcalEnergyStep):
 
         if endcapFactors and self._hcalRecoNames[1]:
             self._marlin.setProcessorParameter(self._hcalRecoNames[1], "calibration_factorsMipGev", " ".join(map(str, endcapFactors)))
+
+    def _modifiedProcessors(self):
+        return [name for name in self._hcalRecoNames[0:2] if name]
     
     """ Get the hcal endcap mip
     """
@@ -329,6 +471,11 @@ class ILDCaloDigiHcalEnergyStep(HcalEnergyStep):
     def setILDCaloDigiName(self, name):
         self._ildCaloDigiName = str(name)
     
+    """ The ILDCaloDigi processor written in the step output
+    """
+    def outputProcessors(self):
+        return [self._ildCaloDigiName]
+    
     """ Write step output
     """
     def writeOutput(self, config) :
@@ -358,6 +505,9 @@ class ILDCaloDigiHcalEnergyStep(HcalEnergyStep):
         self._marlin.setProcessorParameter(self._ildCaloDigiName, "CalibrHCALBarrel", " ".join(map(str, barrelFactors)))
         self._marlin.setProcessorParameter(self._ildCaloDigiName, "CalibrHCALEndcap", " ".join(map(str, endcapFactors)))
 
+    def _modifiedProcessors(self):
+        return [self._ildCaloDigiName]
+
     """ Get the hcal endcap mip
     """
     def hcalEndcapMip(self):
@@ -1,20 +1,47 @@
 
 import os
-import subprocess
+import re
+import bisect
 from calibration.XmlTools import etree
 import logging
 import tempfile
+import threading
 from calibration.MarlinXML import MarlinXML
-import time
+from calibration.ProcessExecutor import getExecutor
+from calibration.Workspace import getWorkspace
 
 """ Marlin class.
 """
 class Marlin(object) :
+    # number of shards used by default by new Marlin instances
+    _defaultNShards = 1
+    # output cache used by default by new Marlin instances
+    _defaultCache = None
+    # checkpoint cache used by default by new Marlin instances
+    _defaultCheckpointCache = None
+    _defaultOverlayMode = False
+    # checkpoints being written by running Marlin instances (the steps may run in threads)
+    _producingCheckpoints = set()
+    _producingCheckpointsLock = threading.Lock()
+    # name of the processor writing the checkpoint lcio files
+    _checkpointProcessor = "CalibrationCheckpointOutput"
+
     """ Constructor
     """
     def __init__(self, steeringFile=None) :
         self._marlinXML = MarlinXML()
         self._logger = logging.getLogger("marlin")
+        self._nShards = Marlin._defaultNShards
+        self._cache = Marlin._defaultCache
+        self._pendingRun = None
+        self._tmpSteeringFiles = []
+        self._overlayMode = Marlin._defaultOverlayMode
+        self._overlayBase = None
+        self._overlay = None
+        self._checkpointCache = Marlin._defaultCheckpointCache
+        self._checkpointProcessors = []
+        # (input files, skip n events, n events) -> max record number, see getMaxRecordNumber
+        self._maxRecordNumbers = {}
 
         # set steering file and load it
         if steeringFile is not None :
@@ -41,11 +68,21 @@ class Marlin(object) :
     def setProcessorParameter(self, processor, parameter, value) :
         self._marlinXML.setProcessorParameter(processor, parameter, value)
 
+    """ Set several processor parameters at once, see MarlinXML.setProcessorParameters
+    """
+    def setProcessorParameters(self, mapping) :
+        self._marlinXML.setProcessorParameters(mapping)
+
     """ Get a processor parameter.
     """
     def getProcessorParameter(self, processor, parameter):
         return self._marlinXML.getProcessorParameter(processor, parameter)
 
+    """ Get a global parameter
+    """
+    def getGlobalParameter(self, name):
+        return self._marlinXML.getGlobalParameter(name)
+
     """ Set the marlin steering file
     """
     def setSteeringFile(self, steeringFile, load=False) :
@@ -87,30 +124,588 @@ class Marlin(object) :
     def setMaxRecordNumber(self, maxRecordNumber) :
         self._marlinXML.setMaxRecordNumber(maxRecordNumber)
 
+    """ Get the max record number (runs + events) to read nEvents events of the input files, 
+        after the skipped events. The run headers read with the events are counted (see _getRunHeaders). 
+        Returns 0 (all the records) if nEvents <= 0 or if the input files hold at most nEvents events 
+        after the skipped ones. If the events can't be counted, a single run header is assumed
+    """
+    def getMaxRecordNumber(self, nEvents):
+        if nEvents <= 0:
+            return 0
+
+        inputFiles = self._marlinXML.getGlobalParameter("LCIOInputFiles").split()
+        skipNEvents = self._getIntGlobalParameter(self._marlinXML, "SkipNEvents")
+        key = (tuple(inputFiles), skipNEvents, nEvents)
+
+        if key not in self._maxRecordNumbers:
+            fileNEvents = self._countEvents(inputFiles)
+
+            if fileNEvents is None:
+                self._maxRecordNumbers[key] = nEvents + 1
+            else:
+                totalEvents = sum(fileNEvents)
+                beginEvent = min(skipNEvents, totalEvents)
+                endEvent = beginEvent + nEvents
+
+                if endEvent >= totalEvents:
+                    self._maxRecordNumbers[key] = 0
+                else:
+                    runHeaders = self._getRunHeaders(inputFiles, fileNEvents)
+                    self._maxRecordNumbers[key] = nEvents + Marlin._countRunHeaders(runHeaders, beginEvent, endEvent)
+
+        return self._maxRecordNumbers[key]
+
     """ Set the global random seed
     """
     def setRandomSeed(self, randomSeed) :
         self._marlinXML.setRandomSeed(randomSeed)
 
-    """ Run the marlin process using Popen function of subprocess module
+    """ Get the lcio collections read and written by a processor (see MarlinXML.getProcessorCollections)
+    """
+    def getProcessorCollections(self, processor):
+        return self._marlinXML.getProcessorCollections(processor)
+
+    """ Get the executed processors depending on the collections written by the given processors
+    """
+    def getDownstreamProcessors(self, processors):
+        return self._marlinXML.getDownstreamProcessors(processors)
+
+    """ Clone a chain of processors with distinct output collections and root files
+        (see MarlinXML.cloneProcessorChain). The processor definitions are copied from
+        the source Marlin instance (default self). Returns the processor to clone names
+    """
+    def cloneProcessorChain(self, processors, suffix, source=None):
+        return self._marlinXML.cloneProcessorChain(processors, suffix, source._marlinXML if source is not None else None)
+
+    """ Set the default number of shards of the Marlin instances created afterwards
+    """
+    @staticmethod
+    def setDefaultNShards(nShards):
+        if int(nShards) > 0:
+            Marlin._defaultNShards = int(nShards)
+
+    """ Set the number of shards (processes) to split the input events on.
+        Each shard processes an event window of the input files and the
+        root outputs of the shards are merged at the end of the run
+    """
+    def setNShards(self, nShards):
+        if int(nShards) > 0:
+            self._nShards = int(nShards)
+
+    """ Set the default output cache (MarlinCache) of the Marlin instances created afterwards
+    """
+    @staticmethod
+    def setDefaultCache(cache):
+        Marlin._defaultCache = cache
+
+    """ Set the output cache (MarlinCache). Use None to disable caching
+    """
+    def setCache(self, cache):
+        self._cache = cache
+
+    """ Create a copy of this Marlin instance (steering, shards and cache settings)
+    """
+    def clone(self):
+        marlin = Marlin()
+        marlin._marlinXML = self._marlinXML.clone()
+        marlin._nShards = self._nShards
+        marlin._cache = self._cache
+        marlin._checkpointCache = self._checkpointCache
+        marlin._checkpointProcessors = list(self._checkpointProcessors)
+        marlin._overlayMode = self._overlayMode
+        # the steering clone tracks its parameter modifications from the same base
+        marlin._overlayBase = self._overlayBase
+        return marlin
+
+    """ Set the default overlay mode of the Marlin instances created afterwards
+    """
+    @staticmethod
+    def setDefaultOverlayMode(overlay):
+        Marlin._defaultOverlayMode = bool(overlay)
+
+    """ In overlay mode, the steering file is written once (and again only if its structure changes :
+        processors turned off or cloned, ...) and the parameters modified since are passed as Marlin 
+        command line overrides (--Processor.Parameter=value, --global.Parameter=value)
+    """
+    def setOverlayMode(self, overlay):
+        self._overlayMode = bool(overlay)
+
+    """ Get the parameter overrides of the last run in overlay mode, as a list of 
+        (processor, parameter, value), processor being "global" for global parameters.
+        Returns None if the last run didn't use an overlay
+    """
+    def getOverlay(self):
+        return list(self._overlay) if self._overlay is not None else None
+
+    """ Set the default checkpoint cache (MarlinCache) of the Marlin instances created afterwards
+    """
+    @staticmethod
+    def setDefaultCheckpointCache(cache):
+        Marlin._defaultCheckpointCache = cache
+
+    """ Set the checkpoint cache (MarlinCache). Use None to disable checkpoints
+    """
+    def setCheckpointCache(self, cache):
+        self._checkpointCache = cache
+
+    """ Set the processors whose parameters are modified between runs.
+        If a checkpoint cache is set, the processors executed before the first of them 
+        (upstream processors) are run only once : the first run writes the event collections
+        to a checkpoint lcio file just before the first modified processor and the next runs 
+        read this file and execute the remaining processors only. The checkpoint is keyed on
+        the upstream processors definitions and the input files, so it is not used anymore
+        if one of them changes
+    """
+    def setCheckpointProcessors(self, processors):
+        self._checkpointProcessors = list(processors)
+
+    """ Run the marlin process through the shared process executor.
+        The input events are processed by several concurrent processes if
+        the number of shards is greater than 1.
+        If a cache is set and an identical run was already processed, 
+        the cached output files are restored instead of running Marlin
     """
     def run(self) :
-        args = self.createProcessArgs()
+        self.start()
+        self.wait()
+
+    """ Start the marlin process(es) without waiting for their termination.
+        Use wait() to wait for the end of the run. Several Marlin instances
+        can be started before waiting, their processes are run concurrently
+        within the limits of the shared process executor
+    """
+    def start(self):
+        if self._pendingRun is not None:
+            raise RuntimeError("Marlin.start: marlin is already running")
+
+        rootOutputs = self._marlinXML.getRootFileOutputs()
+        outputFiles = self._marlinXML.getOutputFiles()
+        cacheKey = None
+        shardRootFiles = None
+
+        if self._cache is not None and outputFiles:
+            cacheKey = self._cache.createKey(self._marlinXML)
+            if self._cache.restore(cacheKey, outputFiles):
+                self._logger.info("Marlin: outputs restored from cache, not running Marlin")
+                self._pendingRun = ([], {}, {}, None, None, None)
+                return
+
+        runXML, checkpointKey = self._prepareCheckpoint(rootOutputs)
+        shards = self._createShards(runXML) if self._nShards > 1 else []
+
+        if self._nShards > 1 and len(shards) < 2:
+            self._logger.warning("Marlin: couldn't split the input events in shards, running a single process")
+
+        try:
+            if len(shards) > 1:
+                jobs, shardRootFiles = self._submitShards(runXML, shards, rootOutputs)
+            else:
+                jobs = [self._submitSingle(runXML)]
+        except:
+            if checkpointKey is not None:
+                self._releaseCheckpoint(checkpointKey)
+            raise
+
+        self._pendingRun = (jobs, rootOutputs, outputFiles, shardRootFiles, cacheKey, checkpointKey)
+
+    """ Wait for the end of a run started with start()
+    """
+    def wait(self):
+        if self._pendingRun is None:
+            raise RuntimeError("Marlin.wait: marlin was not started")
+
+        jobs, rootOutputs, outputFiles, shardRootFiles, cacheKey, checkpointKey = self._pendingRun
+        self._pendingRun = None
+        getExecutor().wait(jobs)
+
+        for tmpSteeringFile in self._tmpSteeringFiles:
+            getWorkspace().release(tmpSteeringFile)
+        self._tmpSteeringFiles = []
+
+        if checkpointKey is not None:
+            try:
+                if all(job.succeeded() for job in jobs):
+                    self._commitCheckpoint(checkpointKey)
+                else:
+                    self._checkpointCache.invalidate(checkpointKey)
+            finally:
+                # released after the commit : the other instances then read the checkpoint
+                self._releaseCheckpoint(checkpointKey)
+
+        if shardRootFiles is None:
+            for job in jobs:
+                if not job.succeeded() :
+                    raise RuntimeError("Marlin ended with status {0}".format(job.returnCode()))
+            if jobs:
+                self._logger.info("Marlin ended with status 0")
+        else:
+            failedShards = [shardId for shardId, job in enumerate(jobs) if not job.succeeded()]
+
+            if failedShards:
+                raise RuntimeError("Marlin: shard(s) {0} ended with non zero status".format(", ".join(map(str, failedShards))))
+
+            for rootFile, files in shardRootFiles.iteritems():
+                self._mergeRootFiles(rootFile, files)
+
+            self._logger.info("Marlin ended with status 0 ({0} shards)".format(len(jobs)))
+
+        if cacheKey is not None:
+            # the lcio outputs of shards are written per shard and not merged
+            missingFiles = [outputFile for outputFile in outputFiles.values() if not os.path.isfile(outputFile)]
+            if missingFiles:
+                self._logger.info("Marlin: outputs not cached, missing output file(s) {0}".format(", ".join(missingFiles)))
+            else:
+                self._cache.store(cacheKey, outputFiles, {
+                    "steeringFile" : self._marlinXML.getSteeringFile(),
+                    "inputFiles" : self._marlinXML.getGlobalParameter("LCIOInputFiles").split()})
+
+    """ Get the steering to run, using or producing a checkpoint if possible.
+        Returns the steering and the key of the checkpoint to produce (None if no checkpoint is produced)
+    """
+    def _prepareCheckpoint(self, rootOutputs):
+        if self._checkpointCache is None or not self._checkpointProcessors:
+            return self._marlinXML, None
+
+        executed = self._marlinXML.getExecuteProcessors()
+        modified = [processor for processor in executed if processor in self._checkpointProcessors]
+
+        if not modified:
+            return self._marlinXML, None
+
+        split = executed.index(modified[0])
+        upstream = [processor for processor in executed[:split] if not self._marlinXML.isServiceProcessor(processor)]
+
+        if not upstream:
+            return self._marlinXML, None
+
+        if set(upstream).intersection(rootOutputs):
+            self._logger.warning("Marlin: upstream processors write root outputs, not using checkpoints")
+            return self._marlinXML, None
+
+        # the checkpoint only depends on the upstream processors and the input
+        upstreamXML = self._marlinXML.clone()
+        upstreamXML.turnOffProcessors(executed[split:])
+        upstreamXML.removeInactiveProcessors()
+        checkpointKey = self._checkpointCache.createKey(upstreamXML)
+        runXML = self._marlinXML.clone()
+
+        # reserve the checkpoint if not written nor being written by another instance
+        with Marlin._producingCheckpointsLock:
+            entry = self._checkpointCache.getEntry(checkpointKey)
+            if entry is None:
+                if checkpointKey in Marlin._producingCheckpoints:
+                    return self._marlinXML, None
+                Marlin._producingCheckpoints.add(checkpointKey)
+
+        if entry is not None:
+            # keep the events order : the shard files are read in shard order
+            checkpointFiles = [os.path.join(self._checkpointCache.entryDir(checkpointKey), f) for f in sorted(entry["outputs"].values(), key=Marlin._shardIndex)]
+            runXML.turnOffProcessors(upstream)
+            runXML.setInputFiles(checkpointFiles)
+            runXML.setSkipNEvents(0)
+            runXML.setMaxRecordNumber(0)
+            self._logger.info("Marlin: reading checkpoint {0}, running from processor {1}".format(checkpointKey, modified[0]))
+            return runXML, None
+
+        try:
+            checkpointFile = os.path.join(self._checkpointCache.createEntry(checkpointKey), "checkpoint.slcio")
+            runXML.insertProcessor(Marlin._checkpointProcessor, "LCIOOutputProcessor", 
+                {"LCIOOutputFile" : checkpointFile, "LCIOWriteMode" : "WRITE_NEW"}, before=modified[0])
+        except:
+            self._releaseCheckpoint(checkpointKey)
+            raise
+
+        self._logger.info("Marlin: writing checkpoint {0} before processor {1}".format(checkpointKey, modified[0]))
+        return runXML, checkpointKey
+
+    """ Mark a checkpoint as no longer being written by this instance
+    """
+    def _releaseCheckpoint(self, checkpointKey):
+        with Marlin._producingCheckpointsLock:
+            Marlin._producingCheckpoints.discard(checkpointKey)
+
+    """ Validate a checkpoint written by a run (one lcio file or one file per shard)
+    """
+    def _commitCheckpoint(self, checkpointKey):
+        entryDir = self._checkpointCache.entryDir(checkpointKey)
+        outputs = {f : f for f in os.listdir(entryDir) if f.endswith(".slcio")}
+        self._checkpointCache.commitEntry(checkpointKey, outputs, {
+            "steeringFile" : self._marlinXML.getSteeringFile(),
+            "inputFiles" : self._marlinXML.getGlobalParameter("LCIOInputFiles").split()})
+        self._logger.info("Marlin: checkpoint {0} written".format(checkpointKey))
+
+    """ Submit a single marlin process on the full input
+    """
+    def _submitSingle(self, marlinXML):
+        args = ['Marlin'] + self._steeringArgs(marlinXML)
         self._logger.info("Marlin command line : " + " ".join(args))
-        process = subprocess.Popen(args = args)
-        if process.wait() :
-            raise RuntimeError
-        self._logger.info("Marlin ended with status 0")
+        return getExecutor().submit(args, "Marlin")
+
+    """ Submit one marlin process per event window.
+        Returns the shard jobs and the shard root files to merge (merged root file -> shard root files)
+    """
+    def _submitShards(self, marlinXML, shards, rootOutputs):
+        shardRootFiles = {rootFile : [] for rootFile in rootOutputs.values()}
+        jobs = []
+
+        for shardId, (inputFiles, skipNEvents, maxRecordNumber) in enumerate(shards):
+            shardXML = marlinXML.clone()
+            shardXML.setInputFiles(inputFiles)
+            shardXML.setSkipNEvents(skipNEvents)
+            shardXML.setMaxRecordNumber(maxRecordNumber)
+
+            for processor, rootFile in rootOutputs.iteritems():
+                shardRootFile = self._shardFileName(rootFile, shardId)
+                shardXML.setProcessorParameter(processor, "RootFile", shardRootFile)
+                shardRootFiles[rootFile].append(shardRootFile)
+
+            # AIDA and lcio output processors would write the same file concurrently
+            for processor in shardXML.getExecuteProcessors():
+                if shardXML.getProcessorType(processor) == "AIDAProcessor":
+                    self._setAIDAShardFile(shardXML, processor, shardId, shardRootFiles)
+                elif shardXML.getProcessorType(processor) == "LCIOOutputProcessor":
+                    lcioFile = shardXML.getProcessorParameter(processor, "LCIOOutputFile")
+                    shardXML.setProcessorParameter(processor, "LCIOOutputFile", self._shardFileName(lcioFile.strip(), shardId))
+
+            args = ['Marlin', shardXML.writeTmp(False)]
+            self._tmpSteeringFiles.append(args[1])
+            self._logger.info("Marlin shard {0} command line : {1}".format(shardId, " ".join(args)))
+            jobs.append(getExecutor().submit(args, "Marlin_shard{0}".format(shardId)))
+
+        return jobs, shardRootFiles
+
+    """ Set the AIDA output file of a shard, named from the configured file name (see _shardFileName).
+        The root shard files are registered in shardRootFiles to be merged in the configured output file
+    """
+    def _setAIDAShardFile(self, shardXML, processor, shardId, shardRootFiles):
+        outputName = "{0}.FileName".format(processor)
+        outputFile = shardXML.getOutputFiles().get(outputName)
+
+        if outputFile is None:
+            return
+
+        fileName = shardXML.getProcessorParameter(processor, "FileName").strip()
+        shardXML.setProcessorParameter(processor, "FileName", self._shardFileName(fileName, shardId))
+        shardFile = shardXML.getOutputFiles()[outputName]
+
+        if not outputFile.endswith(".root"):
+            self._logger.warning("Marlin: AIDA output {0} is not a root file, the shard files are not merged".format(outputFile))
+            return
+
+        shardRootFiles.setdefault(outputFile, []).append(shardFile)
+
+    """ Split the input events in event windows, one per shard.
+        Returns a list of (input files, skip n events, max record number).
+        The windows are computed in events. SkipNEvents counts events only but
+        MaxRecordNumber counts all the records (run headers + events) : the max record
+        number of a window is its number of events plus the run headers read within it
+    """
+    def _createShards(self, marlinXML):
+        inputFiles = marlinXML.getGlobalParameter("LCIOInputFiles").split()
+        skipNEvents = self._getIntGlobalParameter(marlinXML, "SkipNEvents")
+        maxRecordNumber = self._getIntGlobalParameter(marlinXML, "MaxRecordNumber")
+        nEvents = self._countEvents(inputFiles)
+
+        # no event counts available : only whole files can be split
+        if nEvents is None:
+            if maxRecordNumber > 0 or skipNEvents > 0 or len(inputFiles) < 2:
+                return []
+            return [(inputFiles[first:last], 0, 0) for first, last in self._splitRange(0, len(inputFiles))]
+
+        runHeaders = self._getRunHeaders(inputFiles, nEvents)
+        return self._createEventWindows(inputFiles, nEvents, runHeaders, skipNEvents, maxRecordNumber)
+
+    """ Split the input events in event windows, given the number of events of each input file
+        and the run headers positions (global index of the event each run header precedes)
+    """
+    def _createEventWindows(self, inputFiles, nEvents, runHeaders, skipNEvents, maxRecordNumber):
+        totalEvents = sum(nEvents)
+        beginEvent = min(skipNEvents, totalEvents)
+        endEvent = Marlin._windowEndEvent(runHeaders, beginEvent, maxRecordNumber, totalEvents)
+        shards = []
+
+        for first, last in self._splitRange(beginEvent, endEvent):
+            shardFiles = []
+            shardSkip = 0
+            offset = 0
+            for inputFile, n in zip(inputFiles, nEvents):
+                # files without events may hold run headers read within the window
+                if offset < last and (offset + n > first or (n == 0 and offset >= first)):
+                    if not shardFiles:
+                        shardSkip = first - offset
+                    shardFiles.append(inputFile)
+                offset += n
+            shards.append((shardFiles, shardSkip, (last - first) + Marlin._countRunHeaders(runHeaders, first, last)))
+
+        return shards
+
+    """ The end event of the window starting at beginEvent and reading maxRecordNumber records
+        (run headers + events, 0 for all)
+    """
+    @staticmethod
+    def _windowEndEvent(runHeaders, beginEvent, maxRecordNumber, totalEvents):
+        if maxRecordNumber <= 0:
+            return totalEvents
+
+        endEvent = beginEvent
+        records = 0
+
+        while endEvent < totalEvents:
+            records += Marlin._countRunHeaders(runHeaders, endEvent, endEvent + 1) + 1
+            if records > maxRecordNumber:
+                break
+            endEvent += 1
+
+        return endEvent
+
+    """ The number of run headers read with the events [first, last)
+    """
+    @staticmethod
+    def _countRunHeaders(runHeaders, first, last):
+        return bisect.bisect_left(runHeaders, last) - bisect.bisect_left(runHeaders, first)
+
+    """ Get the positions of the run headers in the input files : the sorted list
+        of the global indices of the events each run header precedes.
+        The positions are read with pyLCIO if available, else each file is assumed
+        to hold a single run header before its events
+    """
+    def _getRunHeaders(self, inputFiles, nEvents):
+        try:
+            from pyLCIO import IOIMPL
+        except ImportError:
+            self._logger.warning("Marlin: pyLCIO not available, assuming a single run header at the start of each input file")
+            return [sum(nEvents[:index]) for index in range(len(inputFiles))]
+
+        runHeaders = []
+        offset = 0
+
+        for inputFile, n in zip(inputFiles, nEvents):
+            runHeaders.extend([offset + position for position in self._readRunHeaders(IOIMPL, inputFile, n)])
+            offset += n
+
+        return runHeaders
+
+    """ Read the run headers positions in a lcio file (local index of the event each run header precedes).
+        A run header is assumed before the first event of each run
+    """
+    def _readRunHeaders(self, IOIMPL, inputFile, nEvents):
+        reader = IOIMPL.LCFactory.getInstance().createLCReader()
+        reader.open(inputFile)
+
+        try:
+            nRuns = reader.getNumberOfRuns()
+            if nRuns <= 1:
+                return [0] * nRuns
+            positions = []
+            runNumber = None
+            for index in range(nEvents):
+                event = reader.readNextEvent()
+                if event is None:
+                    break
+                if event.getRunNumber() != runNumber:
+                    runNumber = event.getRunNumber()
+                    positions.append(index)
+            # runs without events : their run headers are at the end of the file
+            positions.extend([nEvents] * max(0, nRuns - len(positions)))
+            return positions
+        finally:
+            reader.close()
+
+    """ Split the range [begin, end) in (at most) n shards contiguous ranges
+    """
+    def _splitRange(self, begin, end):
+        nShards = min(self._nShards, end - begin)
+        if nShards <= 0:
+            return []
+        size, remainder = divmod(end - begin, nShards)
+        ranges = []
+        for shardId in range(nShards):
+            last = begin + size + (1 if shardId < remainder else 0)
+            ranges.append((begin, last))
+            begin = last
+        return ranges
+
+    """ Count the number of events in each lcio file using lcio_event_counter.
+        Returns None if the events couldn't be counted
+    """
+    def _countEvents(self, inputFiles):
+        outputs = [tempfile.TemporaryFile() for inputFile in inputFiles]
+        jobs = [getExecutor().submit(['lcio_event_counter', inputFile], stdout=output) for inputFile, output in zip(inputFiles, outputs)]
+        getExecutor().wait(jobs)
+        nEvents = []
+
+        try:
+            for job, output in zip(jobs, outputs):
+                if not job.succeeded():
+                    raise ValueError
+                output.seek(0)
+                nEvents.append(int(output.read().split()[-1]))
+        except (ValueError, IndexError):
+            self._logger.warning("Marlin: couldn't count the number of events with lcio_event_counter")
+            return None
+        finally:
+            for output in outputs:
+                output.close()
+
+        return nEvents
+
+    def _getIntGlobalParameter(self, marlinXML, name):
+        try:
+            value = marlinXML.getGlobalParameter(name)
+            return int(value) if value else 0
+        except KeyError:
+            return 0
+
+    def _shardFileName(self, fileName, shardId):
+        base, extension = os.path.splitext(fileName)
+        return "{0}_shard{1}{2}".format(base, shardId, extension)
+
+    """ The shard index of a file named by _shardFileName (-1 for a file not written by a shard)
+    """
+    @staticmethod
+    def _shardIndex(fileName):
+        match = re.search(r"_shard(\d+)$", os.path.splitext(fileName)[0])
+        return int(match.group(1)) if match else -1
+
+    """ Merge the shard root files in the final output file using hadd
+    """
+    def _mergeRootFiles(self, rootFile, shardRootFiles):
+        args = ['hadd', '-f', rootFile] + shardRootFiles
+        self._logger.info("Marlin: merging shard outputs : " + " ".join(args))
+        if not getExecutor().run(args).succeeded() :
+            raise RuntimeError("Marlin: couldn't merge the shard root files into {0}".format(rootFile))
+        for shardRootFile in shardRootFiles:
+            try:
+                os.remove(shardRootFile)
+            except OSError:
+                pass
 
     """ Create the marlin process command line argument (Marlin + args)
     """
     def createProcessArgs(self) :
-        args = ['Marlin']
-        # generate temporary steering file for running marlin
-        tmpSteeringFile = self._marlinXML.writeTmp(False)
-        print "Wrote marlin xml file in " + tmpSteeringFile
-        args.append(tmpSteeringFile)
-        return args
+        return ['Marlin'] + self._steeringArgs(self._marlinXML)
+
+    """ Get the steering arguments of a marlin process : a temporary steering file, or in overlay mode
+        the base steering file and the command line overrides of the parameters modified since
+    """
+    def _steeringArgs(self, marlinXML):
+        self._overlay = None
+
+        # the overlay applies to the steering of this instance only (not to shards or checkpoint steerings)
+        if not self._overlayMode or marlinXML is not self._marlinXML:
+            tmpSteeringFile = marlinXML.writeTmp(False)
+            self._tmpSteeringFiles.append(tmpSteeringFile)
+            print "Wrote marlin xml file in " + tmpSteeringFile
+            return [tmpSteeringFile]
+
+        if self._overlayBase is None or self._overlayBase[1] != marlinXML.getStructureVersion():
+            # the base files may be shared with clones, they are removed on workspace cleanup
+            baseSteeringFile = marlinXML.writeTmp(False)
+            self._overlayBase = (baseSteeringFile, marlinXML.markBase())
+            print "Wrote marlin base xml file in " + baseSteeringFile
+
+        self._overlay = marlinXML.getModifiedParameters()
+        return [self._overlayBase[0]] + ["--{0}.{1}={2}".format(processor, parameter, value) for processor, parameter, value in self._overlay]
 
     """ Turn off the target list of processors
         This method removes entries in the <execute> marlin xml element
@@ -124,6 +719,12 @@ class Marlin(object) :
     def turnOffProcessorsExcept(self, processors) :
         self._marlinXML.turnOffProcessorsExcept(processors)
 
+    """ Turn off all the processors not needed to run the target processors,
+        from the collection dataflow of the steering file. Returns the turned off processors
+    """
+    def pruneProcessors(self, targets):
+        return self._marlinXML.pruneProcessors(targets)
+
 
 ################################################################################
 
@@ -170,35 +771,28 @@ class ParallelMarlin(object):
         if maxInstances > 0 :
             self._maxNParallelInstances = maxInstances
 
-    """ Run the registered marlin concurrently
+    """ Run the registered marlin concurrently.
+        The instances are submitted to the shared process executor, at most
+        maxNParallelInstances at a time
     """
     def run(self):
         marlinQueue = list(self._marlinInstances)
-        runningMarlinInstances = {}
-        marlinEndStatus = {m : None for m in marlinQueue}
-
-        while 1:
+        runningJobs = []
+        marlinJobs = {}
+        executor = getExecutor()
 
-            if len(marlinQueue) == 0 and len(runningMarlinInstances) == 0:
-                break
-
-            if len(runningMarlinInstances) < self._maxNParallelInstances and len(marlinQueue):
+        while marlinQueue or runningJobs:
+            while marlinQueue and len(runningJobs) < self._maxNParallelInstances:
                 marlin = marlinQueue.pop(0)
-                args = marlin.createProcessArgs()
-                process = subprocess.Popen(args = args)
-                runningMarlinInstances[process] = marlin
-            else:
-                time.sleep(1)
+                job = executor.submit(marlin.createProcessArgs(), "Marlin")
+                runningJobs.append(job)
+                marlinJobs[marlin] = job
 
-            for proc, marlin in runningMarlinInstances.items():
-                status = proc.poll()
-                if status is not None :
-                    marlinEndStatus[marlin] = status
-                    del runningMarlinInstances[proc]
+            runningJobs.remove(executor.waitAny(runningJobs))
 
-        print "ParallelMarlin ended with the following status ({0} instances):".format(len(marlinEndStatus))
-        for marlin, status in marlinEndStatus.items():
-            print "  -> {0} ended with status {1}".format(marlin, status)
+        print "ParallelMarlin ended with the following status ({0} instances):".format(len(marlinJobs))
+        for marlin in self._marlinInstances:
+            print "  -> {0} ended with status {1}".format(marlin, marlinJobs[marlin].returnCode())
 
 
 
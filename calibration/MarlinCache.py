@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from calibration.FileTools import fileFingerprint
+
+""" MarlinCache class.
+
+    On-disk cache of the output files produced by Marlin runs (all the declared
+    outputs of the executed processors, see MarlinXML.getOutputFiles).
+    A cache entry is keyed on :
+     - the canonical form of the steering file, where the output file names
+       are ignored and the files referenced by parameters (lcio input files,
+       pandora settings, compact file, ...) are replaced by their fingerprint
+     - the Marlin binary and the processor libraries (MARLIN_DLL)
+    Each entry is a directory <cacheDir>/<key> containing a copy of the output
+    files and a metadata.json file describing the run.
+"""
+class MarlinCache(object):
+    def __init__(self, cacheDir):
+        self._cacheDir = os.path.abspath(cacheDir)
+        self._logger = logging.getLogger("marlinCache")
+        self._fingerprints = {}
+
+        if not os.path.isdir(self._cacheDir):
+            os.makedirs(self._cacheDir)
+
+    def cacheDir(self):
+        return self._cacheDir
+
+    """ Compute the cache key of a Marlin run from its steering (MarlinXML object)
+    """
+    def createKey(self, marlinXML):
+        steering = marlinXML.clone()
+
+        # output files are not an input of the run
+        for output in steering.getOutputFiles():
+            processor, parameter = output.rsplit(".", 1)
+            steering.setProcessorParameter(processor, parameter, "")
+
+        sha1 = hashlib.sha1()
+        sha1.update(steering.toCanonicalString(self._fingerprintValue))
+        sha1.update(self._marlinVersion())
+        return sha1.hexdigest()
+
+    """ Get the metadata of a cache entry. Returns None if the entry doesn't exist
+    """
+    def getEntry(self, key):
+        metadataFile = os.path.join(self._cacheDir, key, "metadata.json")
+
+        if not os.path.isfile(metadataFile):
+            return None
+
+        with open(metadataFile) as f:
+            return json.load(f)
+
+    """ Get the list of cache entry keys
+    """
+    def getEntries(self):
+        return [key for key in os.listdir(self._cacheDir) if self.getEntry(key) is not None]
+
+    """ Copy the cached output files to their output locations (output name -> file name).
+        Returns False if the entry doesn't exist or doesn't provide all the outputs
+    """
+    def restore(self, key, outputFiles):
+        entry = self.getEntry(key)
+
+        if entry is None or not set(outputFiles).issubset(set(entry["outputs"])):
+            return False
+
+        for output, outputFile in outputFiles.iteritems():
+            shutil.copyfile(os.path.join(self._cacheDir, key, entry["outputs"][output]), outputFile)
+
+        self._logger.info("Restored Marlin outputs from cache entry {0} (created {1})".format(key, time.ctime(entry["created"])))
+        return True
+
+    """ Store the output files of a Marlin run (output name -> file name) in the cache
+    """
+    def store(self, key, outputFiles, metadata=None):
+        entryDir = self.createEntry(key)
+        outputs = {}
+
+        for output, outputFile in outputFiles.iteritems():
+            outputs[output] = output + os.path.splitext(outputFile)[1]
+            shutil.copyfile(outputFile, os.path.join(entryDir, outputs[output]))
+
+        self.commitEntry(key, outputs, metadata)
+        self._logger.info("Stored Marlin outputs in cache entry {0}".format(key))
+
+    """ Get the directory of a cache entry
+    """
+    def entryDir(self, key):
+        return os.path.join(self._cacheDir, key)
+
+    """ Create an empty (not yet valid) cache entry and return its directory.
+        The files of the entry must be written in this directory before calling commitEntry()
+    """
+    def createEntry(self, key):
+        self.invalidate(key)
+        os.makedirs(self.entryDir(key))
+        return self.entryDir(key)
+
+    """ Validate a cache entry created with createEntry() by writing its metadata.
+        outputs is a dictionary of output name -> file name in the entry directory
+    """
+    def commitEntry(self, key, outputs, metadata=None):
+        entry = dict(metadata) if metadata else {}
+        entry.update({"key" : key, "created" : time.time(), "outputs" : outputs})
+
+        # write metadata last : an entry without metadata is not valid
+        with open(os.path.join(self.entryDir(key), "metadata.json"), 'w') as f:
+            json.dump(entry, f, indent=2, sort_keys=True)
+
+    """ Remove a cache entry
+    """
+    def invalidate(self, key):
+        entryDir = os.path.join(self._cacheDir, key)
+
+        if os.path.isdir(entryDir):
+            shutil.rmtree(entryDir)
+            self._logger.info("Invalidated Marlin cache entry {0}".format(key))
+
+    """ Remove all the cache entries
+    """
+    def clear(self):
+        for key in os.listdir(self._cacheDir):
+            if os.path.isdir(os.path.join(self._cacheDir, key)):
+                self.invalidate(key)
+
+    """ Replace the tokens of a parameter value referring to existing files by their fingerprint
+    """
+    def _fingerprintValue(self, value):
+        tokens = value.split()
+
+        for index, token in enumerate(tokens):
+            if os.path.isfile(token):
+                tokens[index] = self._fingerprint(token)
+
+        return " ".join(tokens)
+
+    def _fingerprint(self, fname):
+        path = os.path.realpath(fname)
+        stat = os.stat(path)
+        cacheKey = (path, stat.st_size, stat.st_mtime)
+
+        if cacheKey not in self._fingerprints:
+            self._fingerprints[cacheKey] = fileFingerprint(path)
+
+        return self._fingerprints[cacheKey]
+
+    """ Fingerprint of the Marlin binary and of the processor libraries
+    """
+    def _marlinVersion(self):
+        from distutils.spawn import find_executable
+        files = [find_executable("Marlin")]
+        files.extend(os.environ.get("MARLIN_DLL", "").split(":"))
+        return " ".join([self._fingerprint(f) for f in files if f and os.path.isfile(f)])
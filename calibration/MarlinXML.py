@@ -1,29 +1,233 @@
 
 import os
+import copy
+from collections import OrderedDict
 from calibration.XmlTools import *
-import tempfile
 import subprocess
+from calibration.Workspace import getWorkspace
 
 
+""" MarlinXML class.
+    Wrap a Marlin steering file. The steering files are parsed once per process : 
+    the loaded trees are shared templates and the parameter values set on a shared 
+    template are kept aside (copy on write at the parameter level). Turning processors off
+    only modifies a private copy of the <execute> element, the rest of the template is still
+    shared. The tree is copied only on the first modification of the processor definitions 
+    (processors inserted, cloned, removed, new global parameter)
+"""
 class MarlinXML(object):    
+    # (file path, size, modification time) -> (tree, index)
+    _templates = {}
+    # output file parameters per processor type : (parameter, extension parameter, default extension)
+    _outputFileParameters = {
+        "LCIOOutputProcessor" : [("LCIOOutputFile", None, None)],
+        "AIDAProcessor" : [("FileName", "FileType", "root")]}
+    # output collection parameters per processor type, used for the steering files 
+    # without typed parameters (lcioOutType attributes)
+    _outputCollectionParameters = {
+        "ILDCaloDigi" : ["ECALOutputCollection0", "ECALOutputCollection1", "ECALOutputCollection2", "ECALOutputCollection3",
+                         "HCALOutputCollection0", "HCALOutputCollection1", "HCALOutputCollection2", "RelationOutputCollection"],
+        "DDCaloDigi" : ["ECALOutputCollection0", "ECALOutputCollection1", "ECALOutputCollection2", "ECALOutputCollection3",
+                        "HCALOutputCollection0", "HCALOutputCollection1", "HCALOutputCollection2", "RelationOutputCollection"],
+        "RealisticCaloDigiSilicon" : ["outputHitCollections", "outputRelationCollections"],
+        "RealisticCaloDigiScinPpd" : ["outputHitCollections", "outputRelationCollections"],
+        "RealisticCaloRecoSilicon" : ["outputHitCollections", "outputRelationCollections"],
+        "RealisticCaloRecoScinPpd" : ["outputHitCollections", "outputRelationCollections"],
+        "SimDigital" : ["outputHitCollections", "outputRelationCollections"],
+        "DDSimpleMuonDigi" : ["MUONOutputCollection", "RelationOutputCollection"],
+        "MergeCollections" : ["OutputCollection"],
+        "DDPandoraPFANewProcessor" : ["ClusterCollectionName", "PFOCollectionName", "StartVertexCollectionName"],
+        "PandoraPFANewProcessor" : ["ClusterCollectionName", "PFOCollectionName", "StartVertexCollectionName"],
+        "PfoAnalysis" : [],
+        "LCIOOutputProcessor" : [],
+        "AIDAProcessor" : [],
+        "InitializeDD4hep" : []}
+
     def __init__(self, steeringFile=None):
         self._steeringFile = steeringFile
         self._xmlTree = None
+        self._index = None
+        self._shared = False
+        self._overrides = {}
+        self._globalOverrides = {}
+        # private <execute> element of a shared template, see _getModifiableExecuteElement
+        self._execute = None
+        self._modifiedParameters = set()
+        self._structureVersion = 0
+        # processor name -> names of its clones (see cloneProcessorChain)
+        self._processorClones = {}
         
 
     def setSteeringFile(self, steeringFile, load=False):
         self._steeringFile = steeringFile
         self._xmlTree = None
+        self._index = None
+        self._shared = False
+        self._overrides = {}
+        self._globalOverrides = {}
+        self._execute = None
+        self._modifiedParameters = set()
+        self._processorClones = {}
+        self._structureVersion += 1
 
         if self._steeringFile and load:
             self.loadSteeringFile()
 
+    def getSteeringFile(self):
+        return self._steeringFile
+
     def loadSteeringFile(self):
         if not self._steeringFile:
             raise RuntimeError("MarlinXML.loadSteeringfile: steering file not set !")
         
-        xmlParser = createXMLParser()
-        self._xmlTree = etree.parse(self._steeringFile, xmlParser)
+        self._xmlTree, self._index = MarlinXML._getTemplate(self._steeringFile)
+        self._shared = True
+        self._overrides = {}
+        self._globalOverrides = {}
+        self._execute = None
+        self._modifiedParameters = set()
+        self._processorClones = {}
+        self._structureVersion += 1
+
+    """ Get the shared template (tree, index) of a steering file, parsed on first use
+    """
+    @staticmethod
+    def _getTemplate(steeringFile):
+        path = os.path.realpath(steeringFile)
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+
+        if key not in MarlinXML._templates:
+            xmlParser = createXMLParser()
+            tree = etree.parse(steeringFile, xmlParser)
+            # expand the group references once, the templates are never modified afterwards
+            MarlinXML._expandGroupReferences(tree)
+            MarlinXML._templates[key] = (tree, MarlinXML._buildIndex(tree))
+
+        return MarlinXML._templates[key]
+
+    """ Remove the cached steering file templates
+    """
+    @staticmethod
+    def clearTemplates():
+        MarlinXML._templates = {}
+
+    """ Make the tree private (copy of the shared template with the parameter values and the 
+        private <execute> element applied). Must be called before any modification of the 
+        processor definitions
+    """
+    def _materialize(self):
+        if not self._shared:
+            return
+
+        self._xmlTree = copy.deepcopy(self._xmlTree)
+        self._index = MarlinXML._buildIndex(self._xmlTree)
+        self._shared = False
+
+        if self._execute is not None:
+            execute = self._xmlTree.xpath("//marlin/execute")[0]
+            execute.getparent().replace(execute, self._execute)
+            self._execute = None
+
+        for (processor, parameter), value in self._overrides.iteritems():
+            self._setElementValue(self._index["parameters"][(processor, parameter)], value)
+
+        for name, value in self._globalOverrides.iteritems():
+            self._setElementValue(self._index["globals"][name], value)
+
+        self._overrides = {}
+        self._globalOverrides = {}
+
+    """ Get a private copy of the tree with the parameter values applied
+    """
+    def _copyTree(self):
+        if not self._shared:
+            return copy.deepcopy(self._xmlTree)
+
+        marlinXML = self.clone()
+        marlinXML._materialize()
+        return marlinXML._xmlTree
+
+    def _setElementValue(self, element, value):
+        if element.get("value") is not None:
+            del element.attrib["value"]
+        element.text = value
+
+    """ Mark the current steering as base of the parameter overlays : the modified parameters
+        are tracked from now on (see getModifiedParameters). Returns the structure version of the base
+    """
+    def markBase(self):
+        self._modifiedParameters = set()
+        return self._structureVersion
+
+    """ The structure version changes on every modification other than a parameter value change 
+        of an existing parameter (processors turned off, inserted, cloned, new global parameter, ...)
+    """
+    def getStructureVersion(self):
+        return self._structureVersion
+
+    """ Get the parameters modified since the last call to markBase(), as a sorted list of 
+        (processor, parameter, value). The global parameters have the processor name "global"
+    """
+    def getModifiedParameters(self):
+        modified = []
+
+        for processor, parameter in sorted(self._modifiedParameters):
+            if processor == "global":
+                value = self.getGlobalParameter(parameter)
+            else:
+                value = self.getProcessorParameter(processor, parameter)
+            modified.append((processor, parameter, value.strip() if value else ""))
+
+        return modified
+
+    """ Get the index of the steering file elements, built on first use :
+         - "processors" : processor name -> processor definition element
+         - "parameters" : (processor name, parameter name) -> parameter element
+         - "globals" : global parameter name -> parameter element
+        As with the xpath queries it replaces, the first definition of a processor 
+        (top level definitions first, then the group definitions) is indexed
+    """
+    def _getIndex(self):
+        if self._index is None:
+            self._index = MarlinXML._buildIndex(self._xmlTree)
+
+        return self._index
+
+    @staticmethod
+    def _buildIndex(tree):
+        index = {"processors" : {}, "parameters" : {}, "globals" : {}}
+        definitions = tree.xpath("//marlin/processor")
+        definitions.extend(tree.xpath("//marlin/group/processor"))
+
+        for definition in definitions:
+            MarlinXML._indexProcessor(index, definition)
+
+        for parameter in tree.xpath("//marlin/global/parameter"):
+            index["globals"].setdefault(parameter.get("name"), parameter)
+
+        return index
+
+    @staticmethod
+    def _indexProcessor(index, definition):
+        name = definition.get("name")
+
+        if name in index["processors"]:
+            return
+
+        index["processors"][name] = definition
+
+        for parameter in definition.findall("parameter"):
+            index["parameters"].setdefault((name, parameter.get("name")), parameter)
+
+    def _unindexProcessor(self, name):
+        if self._index is None or name not in self._index["processors"]:
+            return
+
+        del self._index["processors"][name]
+
+        for key in [key for key in self._index["parameters"] if key[0] == name]:
+            del self._index["parameters"][key]
 
     """ Load processor parameters from a calibration xml tree
         Usage : loadParameter(xmlTree, "//input")
@@ -35,6 +239,20 @@ class MarlinXML(object):
                 name = parameter.get("name")
                 value = parameter.text
                 self.setProcessorParameter(processor, name, value)
+
+    """ Set several processor parameters at once.
+        The mapping is a dictionary (processor, parameter) -> value or processor -> {parameter : value}
+    """
+    def setProcessorParameters(self, mapping):
+        if not self._xmlTree:
+            raise RuntimeError("MarlinXML.setProcessorParameters: Steering file not loaded, couldn't set parameters")
+
+        for key, value in mapping.iteritems():
+            if isinstance(key, tuple):
+                self.setProcessorParameter(key[0], key[1], value)
+            else:
+                for parameter, parameterValue in value.iteritems():
+                    self.setProcessorParameter(key, parameter, parameterValue)
                 
     """ Load step output parameters
     """
@@ -52,21 +270,20 @@ class MarlinXML(object):
         if not self._xmlTree:
             raise RuntimeError("MarlinXML.setProcessorParameter: Steering file not loaded, couldn't set parameter")
 
-        element = self._xmlTree.xpath("//marlin/processor[@name='{0}']/parameter[@name='{1}']".format(processor, parameter))
-        element.extend( self._xmlTree.xpath("//marlin/group/processor[@name='{0}']/parameter[@name='{1}']".format(processor, parameter)) )
-        if element:
-            element = element[0]
-        else:
+        element = self._getIndex()["parameters"].get((processor, parameter))
+
+        if element is None:
             print "WARNING: MarlinXML.setProcessorParameter: processor/parameter doesn't exists ({0}, {1}) !!!".format(processor, parameter)
             return
 
-        if element.get("value") is not None:
-            del element.attrib["value"]
+        value = ("".join(value)).strip() if type(value) is list else str(value).strip()
 
-        if type(value) is list:
-            element.text = ("".join(value)).strip()
+        if self._shared:
+            self._overrides[(processor, parameter)] = value
         else:
-            element.text = str(value).strip()
+            self._setElementValue(element, value)
+
+        self._modifiedParameters.add((processor, parameter))
 
     """ Get a processor parameter.
     """
@@ -74,15 +291,12 @@ class MarlinXML(object):
         if not self._xmlTree:
             raise RuntimeError("MarlinXML.getProcessorParameter: Steering file not loaded, couldn't get parameter")
 
-        element = self._xmlTree.xpath("//marlin/processor[@name='{0}']/parameter[@name='{1}']".format(processor, parameter))
-        element.extend(self._xmlTree.xpath("//marlin/group/processor[@name='{0}']/parameter[@name='{1}']".format(processor, parameter)))
+        element = self._getIndex()["parameters"].get((processor, parameter))
         
-        if element:
-            element = element[0]
-        else:
+        if element is None:
             raise KeyError("MarlinXML.getProcessorParameter: processor/parameter doesn't exists ({0}, {1})".format(processor, parameter))
 
-        return element.text
+        return self._overrides.get((processor, parameter), element.text)
 
     """
     """
@@ -90,20 +304,44 @@ class MarlinXML(object):
         if not self._xmlTree:
             raise RuntimeError("MarlinXML.setGlobalParameter: Steering file not loaded, couldn't set parameter")
 
-        element = self._xmlTree.xpath("//marlin/global/parameter[@name='{0}']".format(name))
-        if element:
-            element = element[0]
-        else:
-            print "WARNING: MarlinXML.setGlobalParameter: global parameter doesn't exists ({0}) !!!".format(name)
-            return
+        element = self._getIndex()["globals"].get(name)
 
-        if element.get("value") is not None:
-            del element.attrib["value"]
+        if element is None:
+            # optional global parameters (SkipNEvents, MaxRecordNumber, ...) may be absent from the steering file
+            self._materialize()
+            globalElt = self._xmlTree.xpath("//marlin/global")
+            if not globalElt:
+                print "WARNING: MarlinXML.setGlobalParameter: no <global> section, couldn't set parameter ({0}) !!!".format(name)
+                return
+            element = etree.SubElement(globalElt[0], "parameter", name=name)
+            self._getIndex()["globals"][name] = element
+            self._structureVersion += 1
+
+        value = ("".join(value)).strip() if type(value) is list else str(value).strip()
 
-        if type(value) is list:
-            element.text = ("".join(value)).strip()
+        if self._shared:
+            self._globalOverrides[name] = value
         else:
-            element.text = str(value).strip()
+            self._setElementValue(element, value)
+
+        self._modifiedParameters.add(("global", name))
+
+    """ Get a global parameter.
+    """
+    def getGlobalParameter(self, name):
+        if not self._xmlTree:
+            raise RuntimeError("MarlinXML.getGlobalParameter: Steering file not loaded, couldn't get parameter")
+
+        element = self._getIndex()["globals"].get(name)
+
+        if element is None:
+            raise KeyError("MarlinXML.getGlobalParameter: global parameter doesn't exists ({0})".format(name))
+
+        if name in self._globalOverrides:
+            return self._globalOverrides[name]
+
+        value = element.get("value")
+        return value if value is not None else element.text
 
     """ Set the lcio input file(s)
         String list or string accepted
@@ -132,7 +370,7 @@ class MarlinXML(object):
     """ Set the number of events to skip
     """
     def setSkipNEvents(self, nEvents) :
-        self.setGlobalParameter("LCIOInputFiles", inputFiles)
+        self.setGlobalParameter("SkipNEvents", nEvents)
 
     """ Set the global verbosity
     """
@@ -149,14 +387,389 @@ class MarlinXML(object):
     def setRandomSeed(self, randomSeed) :
         self.setGlobalParameter("RandomSeed", randomSeed)
     
+    """ Get the <execute> element. The group references were expanded when the steering file was loaded
+    """
+    def _getExecuteElement(self):
+        if self._execute is not None:
+            return self._execute
+
+        return self._xmlTree.xpath("//marlin/execute")[0]
+
+    """ Get the <execute> element to modify. For a shared template, the <execute> element 
+        is copied on first call and the rest of the template stays shared
+    """
+    def _getModifiableExecuteElement(self):
+        if self._shared and self._execute is None:
+            self._execute = copy.deepcopy(self._xmlTree.xpath("//marlin/execute")[0])
+
+        return self._getExecuteElement()
+
+    """ Replace the group references of the <execute> element by the processors of the groups.
+        Called once, when a steering file is parsed
+    """
+    @staticmethod
+    def _expandGroupReferences(tree):
+        execute = tree.xpath("//marlin/execute")[0]
+
+        for groupRef in list(execute.iter("group")):
+            group = tree.xpath("//marlin/group[@name='{0}']".format(groupRef.get("name")))
+            processors = group[0].findall("processor") if group else []
+
+            for processor in processors:
+                entry = etree.Element("processor", name=processor.get("name"))
+                groupRef.addprevious(entry)
+
+            groupRef.getparent().remove(groupRef)
+
+        return execute
+
     def _getExecuteProcessors(self, element):
-        processors = element.findall("processor")
-        ifelements = element.findall("if")
-        for elt in ifelements:
-            processors.extend( self._getExecuteProcessors(elt) )
+        processors = []
+        # keep the execution order
+        for elt in element:
+            if elt.tag == "processor":
+                processors.append(elt)
+            elif elt.tag == "if":
+                processors.extend( self._getExecuteProcessors(elt) )
         return processors
         
 
+    """ Get the names of the processors registered in the <execute> marlin xml element
+    """
+    def getExecuteProcessors(self):
+        if not self._xmlTree:
+            raise RuntimeError("MarlinXML.getExecuteProcessors: Steering file not loaded, couldn't get processors")
+
+        execute = self._getExecuteElement()
+        return [proc.get("name") for proc in self._getExecuteProcessors(execute)]
+
+    """ Get the type of a processor
+    """
+    def getProcessorType(self, processor):
+        if not self._xmlTree:
+            raise RuntimeError("MarlinXML.getProcessorType: Steering file not loaded, couldn't get processor type")
+
+        element = self._getIndex()["processors"].get(processor)
+
+        if element is None:
+            raise KeyError("MarlinXML.getProcessorType: processor doesn't exists ({0})".format(processor))
+
+        return element.get("type")
+
+    """ Get the processor element and its parameter elements (processor name -> element).
+        The parameters of the enclosing group are included, unless overriden by the processor
+    """
+    def _getProcessorElement(self, processor):
+        # the parameter elements of a shared template don't hold the values set on this object
+        if self._shared and any([key[0] == processor for key in self._overrides]):
+            self._materialize()
+
+        element = self._getIndex()["processors"].get(processor)
+
+        if element is None:
+            raise KeyError("MarlinXML: processor doesn't exists ({0})".format(processor))
+
+        parameters = OrderedDict()
+
+        if element.getparent().tag == "group":
+            for parameter in element.getparent().findall("parameter"):
+                parameters[parameter.get("name")] = parameter
+
+        for parameter in element.findall("parameter"):
+            parameters[parameter.get("name")] = parameter
+
+        return element, parameters
+
+    """ Get the value of a parameter element (value attribute or text)
+    """
+    def _getParameterValue(self, parameter):
+        value = parameter.get("value")
+        if value is None:
+            value = parameter.text
+        return value.strip() if value else ""
+
+    """ Get the lcio collections read and written by a processor, as a tuple (inputs, outputs).
+        The typed parameters (lcioInType/lcioOutType attributes, as written by Marlin -x) are used
+        if any. Otherwise the output collections are the parameters listed for the processor type
+        in _outputCollectionParameters and the other parameters containing 'collection' are inputs.
+        For the processor types not listed, the collection parameters are classified from their
+        names : output collections contain 'output' or end with 'CollectionName'
+    """
+    def getProcessorCollections(self, processor):
+        if not self._xmlTree:
+            raise RuntimeError("MarlinXML.getProcessorCollections: Steering file not loaded, couldn't get collections")
+
+        inputs, outputs = self._getProcessorCollectionParameters(processor)
+        return ([c for p in inputs for c in self._getParameterValue(p).split()], 
+                [c for p in outputs for c in self._getParameterValue(p).split()])
+
+    """ Whether the output collection parameters of a processor are declared : typed parameters 
+        or processor type listed in _outputCollectionParameters
+    """
+    def hasDeclaredOutputCollections(self, processor):
+        element, parameters = self._getProcessorElement(processor)
+        return element.get("type") in MarlinXML._outputCollectionParameters or any([p.get("lcioOutType") is not None or p.get("lcioInType") is not None for p in parameters.values()])
+
+    def _getProcessorCollectionParameters(self, processor):
+        element, parameters = self._getProcessorElement(processor)
+        typed = [p for p in parameters.values() if p.get("lcioInType") is not None or p.get("lcioOutType") is not None]
+        inputs, outputs = [], []
+
+        if typed:
+            inputs = [p for p in typed if p.get("lcioInType") is not None]
+            outputs = [p for p in typed if p.get("lcioOutType") is not None]
+        elif element.get("type") in MarlinXML._outputCollectionParameters:
+            outputNames = MarlinXML._outputCollectionParameters[element.get("type")]
+            for name, parameter in parameters.iteritems():
+                if name in outputNames:
+                    outputs.append(parameter)
+                elif "collection" in name.lower():
+                    inputs.append(parameter)
+        else:
+            for name, parameter in parameters.iteritems():
+                lname = name.lower()
+                if "output" in lname or lname.endswith("collectionname"):
+                    outputs.append(parameter)
+                elif "collection" in lname:
+                    inputs.append(parameter)
+
+        return inputs, outputs
+
+    """ Whether the processor is a service processor, i.e it doesn't read nor write collections
+        (geometry or AIDA initialization, ...)
+    """
+    def isServiceProcessor(self, processor):
+        inputs, outputs = self.getProcessorCollections(processor)
+        return not inputs and not outputs
+
+    """ Add a processor before an executed processor (or at the end of the <execute> section if None)
+    """
+    def insertProcessor(self, name, processorType, parameters, before=None):
+        if not self._xmlTree:
+            raise RuntimeError("MarlinXML.insertProcessor: Steering file not loaded, couldn't insert processor")
+
+        self._materialize()
+        execute = self._getExecuteElement()
+        element = etree.SubElement(self._xmlTree.getroot(), "processor", name=name, type=processorType)
+
+        for parameter, value in parameters.iteritems():
+            etree.SubElement(element, "parameter", name=parameter).text = str(value)
+
+        self._indexProcessor(self._getIndex(), element)
+        self._structureVersion += 1
+
+        entry = etree.Element("processor", name=name)
+        beforeEntries = [elt for elt in self._getExecuteProcessors(execute) if elt.get("name") == before]
+
+        if beforeEntries:
+            beforeEntries[0].addprevious(entry)
+        else:
+            execute.append(entry)
+
+    """ Remove the definitions of the processors not registered in the <execute> section
+    """
+    def removeInactiveProcessors(self):
+        if not self._xmlTree:
+            raise RuntimeError("MarlinXML.removeInactiveProcessors: Steering file not loaded, couldn't remove processors")
+
+        self._materialize()
+        executed = set(self.getExecuteProcessors())
+        definitions = self._xmlTree.xpath("//marlin/processor")
+        definitions.extend(self._xmlTree.xpath("//marlin/group/processor"))
+
+        for definition in definitions:
+            if definition.get("name") not in executed:
+                definition.getparent().remove(definition)
+                self._unindexProcessor(definition.get("name"))
+
+        self._structureVersion += 1
+
+    """ Get the executed processors depending (directly or not) on the collections written by
+        the given processors, in execution order. The given processors are included
+    """
+    def getDownstreamProcessors(self, processors):
+        executed = self.getExecuteProcessors()
+        downstream = []
+        collections = set()
+
+        for processor in executed:
+            inputs, outputs = self.getProcessorCollections(processor)
+            if processor in processors or collections.intersection(inputs):
+                downstream.append(processor)
+                collections.update(outputs)
+
+        return downstream
+
+    """ Get the dataflow dependencies of the executed processors : processor name -> list of
+        processors executed before it and writing a collection it reads 
+    """
+    def getProcessorDependencies(self):
+        if not self._xmlTree:
+            raise RuntimeError("MarlinXML.getProcessorDependencies: Steering file not loaded, couldn't get dependencies")
+
+        producers = {}
+        dependencies = OrderedDict()
+
+        for processor in self.getExecuteProcessors():
+            inputs, outputs = self.getProcessorCollections(processor)
+            dependencies[processor] = []
+
+            for collection in inputs:
+                for producer in producers.get(collection, []):
+                    if producer not in dependencies[processor]:
+                        dependencies[processor].append(producer)
+
+            for collection in outputs:
+                producers.setdefault(collection, []).append(processor)
+
+        return dependencies
+
+    """ Get the minimal list of executed processors needed to run the target processors : the
+        targets, the processors producing (directly or not) the collections they read and the 
+        service processors (no input nor output collection, i.e geometry or AIDA initialization).
+        The list is ordered as in the <execute> section
+    """
+    def getRequiredProcessors(self, targets):
+        dependencies = self.getProcessorDependencies()
+        required = set()
+        toVisit = [target for target in targets if target in dependencies]
+
+        while toVisit:
+            processor = toVisit.pop()
+            if processor not in required:
+                required.add(processor)
+                toVisit.extend(dependencies[processor])
+
+        for processor in dependencies:
+            if self.isServiceProcessor(processor):
+                required.add(processor)
+
+        return [processor for processor in dependencies if processor in required]
+
+    """ Turn off all the processors not needed to run the target processors (see getRequiredProcessors()).
+        Returns the list of turned off processors
+    """
+    def pruneProcessors(self, targets):
+        executed = self.getExecuteProcessors()
+        required = self.getRequiredProcessors(targets)
+        self.turnOffProcessorsExcept(required)
+        return [processor for processor in executed if processor not in required]
+
+    """ Clone a chain of processors, i.e to evaluate several calibration hypotheses in a single Marlin job.
+        Each processor of the chain is copied as <processor><suffix>, its output collections
+        are renamed <collection><suffix> and the inputs produced by the chain processors are
+        renamed accordingly. Root files are renamed <file><suffix>.root.
+        The copies are executed after the last processor of the chain.
+        The processor definitions are copied from the source MarlinXML (default self), which 
+        must share the same processors, allowing to clone a chain with different parameter values.
+        Returns the dictionary of processor names to cloned processor names
+    """
+    def cloneProcessorChain(self, processors, suffix, source=None):
+        if not self._xmlTree:
+            raise RuntimeError("MarlinXML.cloneProcessorChain: Steering file not loaded, couldn't clone processors")
+
+        source = source if source is not None else self
+        undeclared = [processor for processor in processors if not source.hasDeclaredOutputCollections(processor)]
+
+        if undeclared:
+            raise RuntimeError("MarlinXML.cloneProcessorChain: output collections of processor(s) {0} unknown, add their type to MarlinXML._outputCollectionParameters".format(", ".join(undeclared)))
+
+        self._materialize()
+        execute = self._getExecuteElement()
+        # the chain and its previous clones
+        chainNames = set(processors)
+        for processor in processors:
+            chainNames.update(self._processorClones.get(processor, []))
+        chainEntries = [elt for elt in self._getExecuteProcessors(execute) if elt.get("name") in chainNames]
+        renamedCollections = {}
+        clones = {}
+
+        for processor in processors:
+            element, parameters = source._getProcessorElement(processor)
+            inputs, outputs = [set([p.get("name") for p in params]) for params in source._getProcessorCollectionParameters(processor)]
+            clone = etree.Element("processor", name=processor + suffix, type=element.get("type"))
+
+            for name, parameter in parameters.iteritems():
+                parameterClone = copy.deepcopy(parameter)
+                value = self._getParameterValue(parameter)
+
+                if name in outputs:
+                    collections = value.split()
+                    renamedCollections.update({c : c + suffix for c in collections})
+                    value = " ".join([c + suffix for c in collections])
+                elif name in inputs:
+                    value = " ".join([renamedCollections.get(c, c) for c in value.split()])
+                elif name == "RootFile" and value:
+                    value = "{0}{1}{2}".format(os.path.splitext(value)[0], suffix, os.path.splitext(value)[1])
+                else:
+                    clone.append(parameterClone)
+                    continue
+
+                if parameterClone.get("value") is not None:
+                    del parameterClone.attrib["value"]
+                parameterClone.text = value
+                clone.append(parameterClone)
+
+            self._xmlTree.getroot().append(clone)
+            self._indexProcessor(self._getIndex(), clone)
+            clones[processor] = processor + suffix
+            self._processorClones.setdefault(processor, []).append(clones[processor])
+
+        # execute the clones after the chain
+        insertAfter = chainEntries[-1] if chainEntries else None
+        
+        for processor in processors:
+            entry = etree.Element("processor", name=clones[processor])
+            if insertAfter is None:
+                execute.append(entry)
+            else:
+                insertAfter.addnext(entry)
+            insertAfter = entry
+
+        self._structureVersion += 1
+        return clones
+
+    """ Get the root files written by the executed processors (processor name -> file name)
+    """
+    def getRootFileOutputs(self):
+        outputs = {}
+        for processor in self.getExecuteProcessors():
+            try:
+                rootFile = self.getProcessorParameter(processor, "RootFile")
+            except KeyError:
+                continue
+            if rootFile:
+                outputs[processor] = rootFile.strip()
+        return outputs
+
+    """ Get all the files written by the executed processors (output name -> file name).
+        The output name is <processor>.<parameter>. The declared outputs are the
+        RootFile parameter of any processor and the output file parameters listed
+        per processor type in _outputFileParameters. Files written by other means are not listed
+    """
+    def getOutputFiles(self):
+        outputs = {}
+        for processor in self.getExecuteProcessors():
+            declared = [("RootFile", None, None)] + MarlinXML._outputFileParameters.get(self.getProcessorType(processor), [])
+            for parameter, extensionParameter, defaultExtension in declared:
+                try:
+                    fileName = self.getProcessorParameter(processor, parameter)
+                except KeyError:
+                    continue
+                if not fileName or not fileName.strip():
+                    continue
+                fileName = fileName.strip()
+                if extensionParameter is not None:
+                    try:
+                        extension = self.getProcessorParameter(processor, extensionParameter)
+                    except KeyError:
+                        extension = None
+                    extension = extension.strip() if extension and extension.strip() else defaultExtension
+                    if not fileName.endswith("." + extension):
+                        fileName = "{0}.{1}".format(fileName, extension)
+                outputs["{0}.{1}".format(processor, parameter)] = fileName
+        return outputs
+
     """ Turn off the target list of processors
         This method removes entries in the <execute> marlin xml element
     """
@@ -167,7 +780,7 @@ class MarlinXML(object):
         if not self._xmlTree:
             raise RuntimeError("MarlinXML.turnOffProcessors: Steering file not loaded, couldn't turn off processors")
 
-        execute = self._xmlTree.xpath("//marlin/execute")[0]
+        execute = self._getModifiableExecuteElement()
         registeredProcessors = self._getExecuteProcessors(execute)
         processorsToRemove = []
 
@@ -183,6 +796,8 @@ class MarlinXML(object):
         for proc in processorsToRemove:
             proc.getparent().remove(proc)
 
+        self._structureVersion += 1
+
     """ Turn off all processors except the ones ine the spcified list
         This method removes entries in the <execute> marlin xml element
     """
@@ -193,7 +808,7 @@ class MarlinXML(object):
         if not self._xmlTree:
             raise RuntimeError("MarlinXML.turnOffProcessorsExcept: Steering file not loaded, couldn't turn off processors")
 
-        execute = self._xmlTree.xpath("//marlin/execute")[0]
+        execute = self._getModifiableExecuteElement()
         registeredProcessors = self._getExecuteProcessors(execute)
         processorsToRemove = []
 
@@ -209,19 +824,58 @@ class MarlinXML(object):
         for proc in processorsToRemove:
             proc.getparent().remove(proc)
 
+        self._structureVersion += 1
+
+    """ Create an independent copy of this object. A shared template is not copied, 
+        the copy keeps its own parameter values and <execute> element until its first 
+        modification of the processor definitions
+    """
+    def clone(self):
+        marlinXML = MarlinXML(self._steeringFile)
+        if self._shared:
+            marlinXML._xmlTree, marlinXML._index = self._xmlTree, self._index
+            marlinXML._shared = True
+            marlinXML._overrides = dict(self._overrides)
+            marlinXML._globalOverrides = dict(self._globalOverrides)
+            marlinXML._execute = copy.deepcopy(self._execute) if self._execute is not None else None
+        elif self._xmlTree:
+            marlinXML._xmlTree = copy.deepcopy(self._xmlTree)
+        marlinXML._modifiedParameters = set(self._modifiedParameters)
+        marlinXML._processorClones = {processor : list(clones) for processor, clones in self._processorClones.iteritems()}
+        marlinXML._structureVersion = self._structureVersion
+        return marlinXML
+
+    """ Get a canonical (c14n, without comments) string of the steering file.
+        The optional valueFilter function is applied on all the parameter values
+    """
+    def toCanonicalString(self, valueFilter=None):
+        if not self._xmlTree:
+            raise RuntimeError("MarlinXML.toCanonicalString: no steering file loaded")
+
+        tree = self._copyTree()
+
+        if valueFilter:
+            for element in tree.iter("parameter"):
+                if element.get("value") is not None:
+                    element.set("value", valueFilter(element.get("value")))
+                if element.text:
+                    element.text = valueFilter(element.text)
+
+        return etree.tostring(tree, method="c14n", with_comments=False)
+
     """ Write the current loaded steering file to the specified file location
     """
     def write(self, filen, pretty_print=True):
         if not self._xmlTree:
             raise RuntimeError("MarlinXML.write: no steering file loaded, couldn't write to file")
 
-        self._xmlTree.write(filen, pretty_print=pretty_print)
+        tree = self._copyTree() if self._shared else self._xmlTree
+        tree.write(filen, pretty_print=pretty_print)
 
-    """ Write the current loaded steering file in a temporary file.
-        The created file name is returned. The user has the responsability to delete it
+    """ Write the current loaded steering file in a temporary file of the workspace scratch directory.
+        The created file name is returned. The file is removed on workspace cleanup at the latest
     """
     def writeTmp(self, pretty_print=True):
-        fhandle, fileName = tempfile.mkstemp(suffix=".xml")
-        # print type(fhandle)
+        fileName = getWorkspace().mkstemp(suffix=".xml", prefix="marlin_")
         self.write(fileName, pretty_print)
         return fileName
@@ -0,0 +1,210 @@
+import math
+import logging
+import multiprocessing
+
+""" MipExtractor class.
+
+    Extract the mip values of the calorimeters directly from the
+    SimCalorimeterHit collections of muon lcio files, without Marlin pass
+    (in-process replacement of the SimCaloHitEnergyDistribution binary).
+    The hit energies are direction corrected as in the binary : scaled by the cosine
+    of the angle between the hit direction from the interaction point and the normal
+    of the calorimeter layers (radial in the barrel, along z in the endcaps).
+    The input files are shared among a pool of worker processes, each filling
+    the hit energy histograms of its files. The histograms have logarithmic bins over 
+    several orders of magnitude, so that the same binning fits all the calorimeter
+    technologies. The histograms are summed and the mip peak of each subdetector is 
+    searched on the distribution of log(energy), where the low energy hits (partial 
+    cell crossings, delta rays) don't make a peak. The mip value is the maximum of the 
+    energy distribution around this peak, refined with a gaussian fit (parabola on 
+    the log of the bin densities).
+    Requires pyLCIO and numpy.
+"""
+class MipExtractor(object):
+    def __init__(self):
+        self._inputFiles = []
+        self._collections = {}
+        self._maxNEvents = 0
+        self._nWorkers = 1
+        self._nBins = 1600
+        self._minEnergy = 1e-8
+        self._maxEnergy = 1.
+        self._mips = {}
+        self._logger = logging.getLogger("mipExtractor")
+
+    """ Whether the dependencies (pyLCIO and numpy) are available
+    """
+    @staticmethod
+    def isAvailable():
+        try:
+            import numpy
+            import pyLCIO
+        except ImportError:
+            return False
+        return True
+
+    """ Set the lcio input file(s)
+    """
+    def setInputFiles(self, inputFiles):
+        self._inputFiles = list(inputFiles) if isinstance(inputFiles, list) else [inputFiles]
+
+    """ Set the SimCalorimeterHit collections of a subdetector, in the barrel and in the endcaps
+        (the direction correction depends on the layers orientation)
+    """
+    def setCollections(self, subDetector, barrelCollections, endcapCollections):
+        self._collections[subDetector] = (list(barrelCollections), list(endcapCollections))
+
+    """ Set the maximum number of events to process (0 for all events)
+    """
+    def setMaxNEvents(self, maxNEvents):
+        self._maxNEvents = int(maxNEvents) if maxNEvents else 0
+
+    def setNWorkers(self, nWorkers):
+        self._nWorkers = max(1, int(nWorkers))
+
+    """ Set the hit energy histogram binning : number of logarithmic bins 
+        between minEnergy and maxEnergy (unit GeV)
+    """
+    def setHistogram(self, nBins, minEnergy, maxEnergy):
+        if not 0. < minEnergy < maxEnergy:
+            raise ValueError("MipExtractor: invalid histogram range [{0}, {1}]".format(minEnergy, maxEnergy))
+        self._nBins = int(nBins)
+        self._minEnergy = float(minEnergy)
+        self._maxEnergy = float(maxEnergy)
+
+    """ Get the mip value of a subdetector after run()
+    """
+    def getMip(self, subDetector):
+        if subDetector not in self._mips:
+            raise RuntimeError("MipExtractor: no mip value for '{0}'".format(subDetector))
+        return self._mips[subDetector]
+
+    """ Histogram the hit energies of all the input files and extract the mip values.
+        Returns a dictionary of subdetector -> mip value
+    """
+    def run(self):
+        import numpy
+
+        if not self._inputFiles:
+            raise RuntimeError("MipExtractor: no input file")
+
+        if not self._collections:
+            raise RuntimeError("MipExtractor: no SimCalorimeterHit collection")
+
+        binEdges = numpy.logspace(math.log10(self._minEnergy), math.log10(self._maxEnergy), self._nBins+1)
+        tasks = [(inputFile, maxNEvents, self._collections, binEdges) for inputFile, maxNEvents in self._distributeEvents()]
+        nWorkers = min(self._nWorkers, len(tasks))
+        self._logger.info("Histogramming sim calo hit energies of {0} file(s) with {1} worker(s)".format(len(tasks), nWorkers))
+
+        if nWorkers > 1:
+            pool = multiprocessing.Pool(nWorkers)
+            try:
+                results = pool.map(_histogramFile, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_histogramFile, tasks)
+
+        self._mips = {}
+
+        for subDetector in self._collections:
+            histogram = numpy.sum([result[subDetector] for result in results], axis=0)
+            self._mips[subDetector] = self._findPeak(numpy, histogram, binEdges)
+            self._logger.info("{0} mip : {1} GeV ({2} hits)".format(subDetector, self._mips[subDetector], int(histogram.sum())))
+
+        return dict(self._mips)
+
+    """ The maximum number of events to process per input file, from the lcio file event counts
+    """
+    def _distributeEvents(self):
+        if self._maxNEvents <= 0:
+            return [(inputFile, 0) for inputFile in self._inputFiles]
+
+        from pyLCIO import IOIMPL
+        remaining = self._maxNEvents
+        tasks = []
+
+        for inputFile in self._inputFiles:
+            if remaining <= 0:
+                break
+            reader = IOIMPL.LCFactory.getInstance().createLCReader()
+            reader.open(inputFile)
+            nEvents = reader.getNumberOfEvents()
+            reader.close()
+            tasks.append((inputFile, min(nEvents, remaining)))
+            remaining -= nEvents
+
+        return tasks
+
+    """ Find the mip peak of a log binned hit energy histogram
+    """
+    def _findPeak(self, numpy, histogram, binEdges):
+        if histogram.max() <= 0.:
+            raise RuntimeError("MipExtractor: empty hit energy histogram")
+
+        # log bins : the bin contents are the distribution of log(energy),
+        # the bin contents divided by the bin widths the distribution of energy
+        peak = int(numpy.argmax(histogram))
+        centers = numpy.sqrt(binEdges[:-1] * binEdges[1:])
+        densities = histogram / numpy.diff(binEdges)
+        # +- 10% around the log(energy) peak
+        halfWidth = max(2, int(round(math.log(1.1) / math.log(binEdges[1] / binEdges[0]))))
+        window = slice(max(0, peak-halfWidth), min(len(histogram), peak+halfWidth+1))
+        x, y = centers[window], densities[window]
+        maximum = int(numpy.argmax(y))
+        selection = y > 0.
+
+        if selection.sum() < 3:
+            return float(x[maximum])
+
+        a, b, c = numpy.polyfit(x[selection], numpy.log(y[selection]), 2)
+
+        if a >= 0.:
+            return float(x[maximum])
+
+        position = -b / (2.*a)
+        # keep the fitted position only if it lies in the fit window
+        return float(position) if x[0] <= position <= x[-1] else float(x[maximum])
+
+
+""" The direction correction of a hit : cosine of the angle between the hit direction
+    from the interaction point and the layer normal (radial in the barrel, along z in the endcaps)
+"""
+def _directionCorrection(position, barrel):
+    x, y, z = position[0], position[1], position[2]
+    r = math.sqrt(x*x + y*y + z*z)
+
+    if r <= 0.:
+        return 1.
+
+    return math.sqrt(x*x + y*y) / r if barrel else abs(z) / r
+
+""" Fill the direction corrected hit energy histograms (one per subdetector) of an input file
+"""
+def _histogramFile(task):
+    import numpy
+    from pyLCIO import IOIMPL
+
+    inputFile, maxNEvents, collections, binEdges = task
+    energies = {subDetector : [] for subDetector in collections}
+    reader = IOIMPL.LCFactory.getInstance().createLCReader()
+    reader.open(inputFile)
+    nEvents = 0
+
+    try:
+        for event in reader:
+            if maxNEvents > 0 and nEvents >= maxNEvents:
+                break
+            nEvents += 1
+            collectionNames = set(event.getCollectionNames())
+
+            for subDetector, (barrelNames, endcapNames) in collections.iteritems():
+                for names, barrel in [(barrelNames, True), (endcapNames, False)]:
+                    for name in names:
+                        if name in collectionNames:
+                            energies[subDetector].extend([hit.getEnergy() * _directionCorrection(hit.getPosition(), barrel) for hit in event.getCollection(name)])
+    finally:
+        reader.close()
+
+    return {subDetector : numpy.histogram(values, bins=binEdges)[0] for subDetector, values in energies.iteritems()}
@@ -5,6 +5,7 @@ from calibration.CalibrationStep import CalibrationStep
 from calibration.Marlin import Marlin
 from calibration.PandoraAnalysis import *
 from calibration.FileTools import *
+from calibration.ProcessExecutor import getExecutor
 import os, sys
 from calibration.XmlTools import etree
 from subprocess import call
@@ -16,12 +17,15 @@ class MipScaleStep(CalibrationStep) :
     def __init__(self) :
         CalibrationStep.__init__(self, "MipScale")
         self._marlin = None
-        self._pfoOutputFile = "./PfoAnalysis_" + self._name + ".root"
+        self._pfoOutputFile = ""
         self._hcalBarrelMip = 0.
         self._hcalEndcapMip = 0.
         self._hcalRingMip = 0.
         self._ecalMip = 0.
         self._muonEnergy = 0
+        self._muonFiles = []
+        self._maxRecordNumber = 0
+        self._simCaloHitCollections = None
         
         # set requirements
         self._requireMuonFile()
@@ -41,8 +45,36 @@ class MipScaleStep(CalibrationStep) :
         self._marlin.setCompactFile(parsed.compactFile)
         self._marlin.setMaxRecordNumber(parsed.maxRecordNumber)
         self._marlin.setInputFiles(self._extractFileList(parsed.lcioMuonFile, "slcio"))
+        self._pfoOutputFile = self._workspacePath("PfoAnalysis_" + self._name + ".root")
         self._marlin.setProcessorParameter(self._pfoAnalysisProcessor, "RootFile", self._pfoOutputFile)
         self._muonEnergy = parsed.muonEnergy
+        self._muonFiles = self._extractFileList(parsed.lcioMuonFile, "slcio")
+        self._maxRecordNumber = int(parsed.maxRecordNumber) if parsed.maxRecordNumber else 0
+
+    """ The native mip extraction runs a multiprocessing pool
+    """
+    def usesProcessPool(self):
+        return MipCalibrator().usesNativeBackend()
+
+    """ Set the SimCalorimeterHit collections read by the native mip extraction : subdetector 
+        ("ECal", "HCalBarrel", "HCalEndcap" or "HCalRing") -> (barrel collections, endcap collections).
+        By default, the collections are the inputs of the digitizers in the steering file (see _getDigitizerCollections)
+    """
+    def setSimCaloHitCollections(self, collections):
+        self._simCaloHitCollections = dict(collections)
+
+    """ The SimCalorimeterHit collections read by the native mip extraction, None if unknown
+    """
+    def _getSimCaloHitCollections(self):
+        if self._simCaloHitCollections:
+            return self._simCaloHitCollections
+        return self._getDigitizerCollections()
+
+    """ The SimCalorimeterHit collections of the subdetectors read from the digitizer inputs
+        in the steering file, None if unknown (can be overriden in daughter classes)
+    """
+    def _getDigitizerCollections(self):
+        return None
 
     """ Initialize the step
     """
@@ -54,27 +86,62 @@ class MipScaleStep(CalibrationStep) :
     """ Run the calibration step
     """
     def run(self, config) :
-        self._marlin.loadInputParameters(config)
-        self._loadStepOutputs(config)
-                
-        if len(self._runProcessors):
-            self._marlin.turnOffProcessorsExcept(self._runProcessors)
-
-        if len(self._turnoffProcessors):
-            self._marlin.turnOffProcessors(self._turnoffProcessors)
-            
-        self._marlin.run()
-
         mipCalibrator = MipCalibrator()
-        mipCalibrator.setRootFile(self._pfoOutputFile)
         mipCalibrator.setMuonEnergy(self._muonEnergy)
-        mipCalibrator.run()
+
+        # the native backend reads the sim calo hits from the lcio files, no Marlin pass needed
+        if not self._runNativeMipCalibrator(mipCalibrator):
+            mipCalibrator.setBackend("binary")
+            self._marlin.loadInputParameters(config)
+            self._loadStepOutputs(config)
+                    
+            if len(self._runProcessors):
+                self._marlin.turnOffProcessorsExcept(self._runProcessors)
+
+            if len(self._turnoffProcessors):
+                self._marlin.turnOffProcessors(self._turnoffProcessors)
+
+            self._pruneMarlinProcessors(self._marlin)
+                
+            self._marlin.run()
+            mipCalibrator.setRootFile(self._pfoOutputFile)
+            mipCalibrator.run()
         
         self._hcalBarrelMip = mipCalibrator.getHcalBarrelMip()
         self._hcalEndcapMip = mipCalibrator.getHcalEndcapMip()
         self._hcalRingMip = mipCalibrator.getHcalRingMip()
         self._ecalMip = mipCalibrator.getEcalMip()
 
+    """ Run the native backend of the mip calibrator if selected. Returns False if the 
+        binary must be run instead : native backend not selected, collections unknown or failed extraction
+    """
+    def _runNativeMipCalibrator(self, mipCalibrator):
+        if not mipCalibrator.usesNativeBackend():
+            return False
+
+        try:
+            collections = self._getSimCaloHitCollections()
+        except KeyError as e:
+            # digitizer missing in the steering file
+            self._logger.warning("{0}: {1}".format(self._name, str(e)))
+            collections = None
+
+        if not collections:
+            self._logger.warning("{0}: SimCalorimeterHit collections unknown, running the SimCaloHitEnergyDistribution binary".format(self._name))
+            return False
+
+        mipCalibrator.setLcioFiles(self._muonFiles, self._maxRecordNumber)
+        mipCalibrator.setNWorkers(getExecutor().maxNProcesses())
+        mipCalibrator.setSimCaloHitCollections(collections)
+
+        try:
+            mipCalibrator.run()
+        except RuntimeError as e:
+            self._logger.warning("{0}: native mip extraction failed ({1}), running the SimCaloHitEnergyDistribution binary".format(self._name, str(e)))
+            return False
+
+        return True
+
     """ Write step output (must be overriden in daughter classes)
     """ 
     def writeOutput(self, config) :
@@ -104,6 +171,24 @@ class SplitDigiMipScaleStep(MipScaleStep):
         self._hcalDigiNames[1] = endcapDigi if isinstance(endcapDigi, str) else None
         self._hcalDigiNames[2] = ringDigi if isinstance(ringDigi, str) else None
     
+    """ The digitizers written in the step output
+    """
+    def outputProcessors(self):
+        return [name for name in self._ecalDigiNames + self._hcalDigiNames if name]
+
+    """ The SimCalorimeterHit collections of the subdetectors : input collections of the barrel,
+        endcap and ring digitizers. The ecal ring is an endcap region of the ecal subdetector
+    """
+    def _getDigitizerCollections(self):
+        ecalBarrel, ecalEndcap, ecalRing = [self._getInputCollections(name) for name in self._ecalDigiNames]
+        hcalBarrel, hcalEndcap, hcalRing = [self._getInputCollections(name) for name in self._hcalDigiNames]
+        collections = {"ECal" : (ecalBarrel, ecalEndcap + ecalRing), "HCalBarrel" : (hcalBarrel, []), 
+            "HCalEndcap" : ([], hcalEndcap), "HCalRing" : ([], hcalRing)}
+        return {subDetector : names for subDetector, names in collections.iteritems() if names[0] or names[1]}
+
+    def _getInputCollections(self, digitizer):
+        return self._marlin.getProcessorCollections(digitizer)[0] if digitizer else []
+    
     """ Write calibration step output
     """ 
     def writeOutput(self, config):
@@ -142,6 +227,11 @@ class ILDCaloDigiMipScaleStep(MipScaleStep):
     def setILDCaloDigiName(self, name):
         self._ildCaloDigiName = str(name)
     
+    """ The ILDCaloDigi processor written in the step output
+    """
+    def outputProcessors(self):
+        return [self._ildCaloDigiName]
+    
     """ Write step output
     """
     def writeOutput(self, config):
@@ -1,20 +1,143 @@
 
 
 import os
-import subprocess
-import linecache
+import itertools
+from calibration.ProcessExecutor import getExecutor
+from calibration.Workspace import getWorkspace
+from calibration.FileTools import parseCalibrationFile, getCalibrationEntryValue, getSoftwareCompensationEntryWeights
+from calibration.PfoAnalysisTree import PfoAnalysisTree, ContainedEventsAnalysis, HadronicScaleFit, windowMean
+from calibration.SoftCompMinimizer import SoftCompMinimizer
+from calibration.MipExtractor import MipExtractor
 
 ############################################################
 ############################################################
 class PandoraAnalysisBinary(object) :
+    _defaultBackend = "binary"
+    _defaultResultCache = None
+    _outputCounter = itertools.count()
+    backends = ["auto", "native", "binary"]
+    # calibrator attribute -> value name in the calibration file (see FileTools.calibrationKeys and calibrationPositions)
+    _outputKeys = {}
+    # additional calibrator attributes stored in the result cache
+    _cachedOutputs = []
+    # whether the "auto" backend may select the native backend. False for the native backends
+    # not yet checked against the binary on reference files : they run only if requested explicitly
+    _autoSelectsNative = True
+
     def __init__(self, name) :
-        self._pandoraAnalysisDir = os.environ["PANDORA_ANALYSIS_DIR"]
+        self._pandoraAnalysisDir = os.environ.get("PANDORA_ANALYSIS_DIR", "")
         self._name = name
         self._executable = os.path.join(self._pandoraAnalysisDir, "bin", self._name)
         self._arguments = {}
         self._calibrationFile = ""
         self._outputPath = ""
+        self._outputPathArgument = None
+        self._uniqueOutputPath = True
         self._deleteOutputFile = True
+        self._backend = PandoraAnalysisBinary._defaultBackend
+        self._hasNativeBackend = False
+        self._resultCache = PandoraAnalysisBinary._defaultResultCache
+        self._cacheKey = None
+        self._job = None
+
+    """ Set the default analysis backend of the calibrators :
+         - "binary" : run the LCPandoraAnalysis binary (default)
+         - "native" : in-process analysis of the root file (see calibration.PfoAnalysisTree)
+         - "auto" : native if available (numpy and uproot installed), else binary.
+           The calibrators whose native backend wasn't checked against the binary run the binary
+        Calibrators without native implementation always run the binary.
+        The native results are checked against the binary ones by tests/testAnalysisBackends.py,
+        on reference files given by the environment
+    """
+    @staticmethod
+    def setDefaultBackend(backend):
+        if backend not in PandoraAnalysisBinary.backends:
+            raise ValueError("Unknown analysis backend '{0}'. Available : {1}".format(backend, ", ".join(PandoraAnalysisBinary.backends)))
+        PandoraAnalysisBinary._defaultBackend = backend
+
+    def setBackend(self, backend):
+        if backend not in PandoraAnalysisBinary.backends:
+            raise ValueError("Unknown analysis backend '{0}'. Available : {1}".format(backend, ", ".join(PandoraAnalysisBinary.backends)))
+        self._backend = backend
+
+    """ Whether the native backend is used on run()
+    """
+    def usesNativeBackend(self):
+        return self._useNativeBackend()
+
+    def _useNativeBackend(self):
+        if not self._hasNativeBackend or self._backend == "binary":
+            return False
+        if self._backend == "native":
+            return True
+        return self._autoSelectsNative and self._isNativeBackendAvailable()
+
+    def _isNativeBackendAvailable(self):
+        return PfoAnalysisTree.isAvailable()
+
+    """ Set the default result cache (AnalysisCache) of the calibrators created afterwards
+    """
+    @staticmethod
+    def setDefaultResultCache(cache):
+        PandoraAnalysisBinary._defaultResultCache = cache
+
+    """ Set the result cache (AnalysisCache). Use None to disable caching
+    """
+    def setResultCache(self, cache):
+        self._resultCache = cache
+
+    """ Whether the results of the analysis can be stored in the result cache
+    """
+    def _isCacheable(self):
+        return True
+
+    """ The input files of the analysis, the cache key depends on their content
+    """
+    def _cacheInputFiles(self):
+        return [self._arguments["-a"]] if "-a" in self._arguments else []
+
+    """ The parameters of the analysis, in addition to the arguments, the cache key depends on
+    """
+    def _cacheParameters(self):
+        return {}
+
+    def _createCacheKey(self):
+        arguments = dict(self._arguments)
+        arguments.pop("-a", None)
+        arguments.pop(self._outputPathArgument, None)
+        arguments.update(self._cacheParameters())
+        backend = "native" if self._useNativeBackend() else "binary"
+        executable = self._executable if backend == "binary" else None
+        return self._resultCache.createKey(self._name, backend, self._cacheInputFiles(), arguments, executable)
+
+    """ Restore the outputs from the result cache. Returns False if not cached
+    """
+    def _restoreCachedOutputs(self):
+        self._cacheKey = None
+
+        if self._resultCache is None or not self._isCacheable():
+            return False
+
+        self._cacheKey = self._createCacheKey()
+        outputs = self._resultCache.get(self._cacheKey)
+
+        if outputs is None:
+            return False
+
+        for attribute, value in outputs.iteritems():
+            setattr(self, attribute, value)
+
+        print "PandoraAnalysisBinary '{0}': outputs restored from the result cache".format(self._name)
+        self._cacheKey = None
+        return True
+
+    def _storeCachedOutputs(self):
+        if self._cacheKey is None:
+            return
+
+        attributes = list(self._outputKeys.keys()) + self._cachedOutputs
+        self._resultCache.store(self._cacheKey, {attribute : getattr(self, attribute) for attribute in attributes}, {"name" : self._name})
+        self._cacheKey = None
 
     def _createProcessArgs(self) :
         args = [self._executable]
@@ -37,35 +160,163 @@ class PandoraAnalysisBinary(object) :
         except OSError:
             pass
     
-    def _getFileContent(self, fname, lid, tokenid):
-        line = linecache.getline(fname, lid)
-        lineTokens = line.split()
-        linecache.clearcache()
-        return lineTokens[tokenid]
+    """ Parse the calibration file and set the calibrator outputs from their keys (see _outputKeys).
+        A value without matching key is read at its position in the file. Raise an exception if a key is ambiguous
+    """
+    def _readCalibrationFile(self):
+        entries = parseCalibrationFile(self._calibrationFile)
+
+        for attribute, name in self._outputKeys.iteritems():
+            setattr(self, attribute, getCalibrationEntryValue(entries, name, self._calibrationFile))
+
+        return entries
 
     def _setOutputPath(self, arg, path):
         self._outputPath = path
+        self._outputPathArgument = arg
         self._calibrationFile = path + "Calibration.txt"
         self._setArgument(arg, self._outputPath)
     
     def setDeleteOutputFile(self, deleteFile):
         self._deleteOutputFile = deleteFile
 
+    """ Whether each invocation writes its outputs with a unique path prefix (default). 
+        Required to run several instances of the same binary concurrently
+    """
+    def setUniqueOutputPath(self, unique):
+        self._uniqueOutputPath = bool(unique)
+
+    """ The output path prefix of an invocation in the workspace run directory. 
+        The check plots written by the binaries are kept according to the workspace keep patterns
+    """
+    def _resolveOutputPath(self):
+        outputPath = getWorkspace().path(self._outputPath)
+
+        if self._uniqueOutputPath:
+            outputPath = "{0}{1}_{2}_".format(outputPath, os.getpid(), next(PandoraAnalysisBinary._outputCounter))
+
+        return outputPath
+
+    """ The calibration output file of the last invocation
+    """
+    def calibrationFile(self):
+        return self._calibrationFile
+
+    """ Run the analysis and wait for its outputs
+    """
     def run(self) :
+        self.start()
+        self.wait()
+
+    """ Start the analysis without waiting for its end. The outputs are available after wait().
+        The native backend runs synchronously
+    """
+    def start(self) :
+        if self._job is not None:
+            raise RuntimeError("PandoraAnalysisBinary '{0}': already started".format(self._name))
+
+        if self._restoreCachedOutputs():
+            return
+
+        if self._useNativeBackend():
+            self._runNative()
+            self._storeCachedOutputs()
+            return
+
+        if not self._pandoraAnalysisDir:
+            raise RuntimeError("PandoraAnalysisBinary '{0}': PANDORA_ANALYSIS_DIR is not set".format(self._name))
+
+        if self._outputPathArgument:
+            outputPath = self._resolveOutputPath()
+            self._calibrationFile = outputPath + "Calibration.txt"
+            self._setArgument(self._outputPathArgument, outputPath)
+
+        self._removeFile(self._calibrationFile)
         args = self._createProcessArgs()
         print "Running: {0}".format(" ".join(args))
-        process = subprocess.Popen(args = args)#, stdin = None, stdout = None, stderr = None)
-        if process.wait() :
-            raise RuntimeError
+        self._job = getExecutor().submit(args, self._name)
+
+    """ Wait for the end of the analysis started with start() and read its outputs
+    """
+    def wait(self) :
+        if self._job is None:
+            return
+
+        job, self._job = self._job, None
+        getExecutor().wait([job])
+
+        if not job.succeeded() :
+            raise RuntimeError("PandoraAnalysisBinary '{0}' ended with status {1}".format(self._name, job.returnCode()))
+
         print "PandoraAnalysisBinary '" + self._name + "' ended with status 0"
+        self._readOutputs()
+        self._storeCachedOutputs()
+
+        if self._deleteOutputFile:
+            self._removeFile(self._calibrationFile)
+
+    """ Read the outputs of the binary from the calibration file. 
+        By default, reads the values of the keys listed in _outputKeys
+    """
+    def _readOutputs(self):
+        self._readCalibrationFile()
+
+    """ Run the native backend (must be reimplemented by the calibrators having a native backend)
+    """
+    def _runNative(self):
+        raise NotImplementedError("PandoraAnalysisBinary._runNative: method not implemented !")
+
+    """ Run the native contained events analysis on the root file and the cos(theta) range of the arguments,
+        with the branches set by the calibrator. Returns the (mean, error) of the calorimeter energy
+    """
+    def _runContainedEventsAnalysis(self):
+        region = self._arguments.get("-g", "All")
+        mean, error, nEvents = self._analyseContainedEvents(region)
+        print "Native '{0}' analysis, region {1} : mean {2} +- {3} ({4} events)".format(self._name, region, mean, error, nEvents)
+        return mean, error
+
+    def _analyseContainedEvents(self, region):
+        analysis = ContainedEventsAnalysis(self._energyBranch, self._vetoBranches)
+        analysis.setVetoFraction(self._vetoFraction)
+        analysis.addRegion(region, float(self._arguments["-i"]), float(self._arguments["-j"]))
+        analysis.run(self._arguments["-a"])
+        return analysis.getResult(region)
+
+    """ Compute the statistical error of an output of the binary, which doesn't write it, from the
+        PfoAnalysis tree of the root file. Returns None if the tree can't be read (numpy and uproot
+        not installed) or if the error computation fails
+    """
+    def _computeTreeError(self, computeError):
+        if not PfoAnalysisTree.isAvailable():
+            return None
+
+        try:
+            return computeError()
+        except RuntimeError as e:
+            print "PandoraAnalysisBinary '{0}': couldn't compute the statistical error from the PfoAnalysis tree : {1}".format(self._name, str(e))
+            return None
+
+    """ The statistical error of the contained events mean of the region, from the PfoAnalysis tree (see _computeTreeError)
+    """
+    def _containedEventsMeanError(self):
+        return self._computeTreeError(lambda: self._analyseContainedEvents(self._arguments.get("-g", "All"))[1])
 
 ############################################################
 ############################################################
 """ MipCalibrator class
     Implements the interface to the SimCaloHitEnergyDistribution binary
     from LCPandoraAnalysis package
+    The native backend reads the SimCalorimeterHit collections of the lcio files
+    directly (no Marlin pass needed), see MipExtractor. It requires the collections 
+    of the subdetectors (setSimCaloHitCollections) and runs only if requested explicitly
 """
 class MipCalibrator(PandoraAnalysisBinary):
+    _outputKeys = {"_ecalMip" : "ecalMip", "_hcalBarrelMip" : "hcalBarrelMip",
+        "_hcalEndcapMip" : "hcalEndcapMip", "_hcalRingMip" : "hcalRingMip"}
+    _autoSelectsNative = False
+    # subdetector -> calibrator attribute
+    _subDetectorOutputs = {"ECal" : "_ecalMip", "HCalBarrel" : "_hcalBarrelMip", "HCalEndcap" : "_hcalEndcapMip", "HCalRing" : "_hcalRingMip"}
+
     def __init__(self):
         PandoraAnalysisBinary.__init__(self, "SimCaloHitEnergyDistribution")
         
@@ -73,10 +324,17 @@ class MipCalibrator(PandoraAnalysisBinary):
         self._hcalEndcapMip = 0
         self._hcalRingMip = 0
         self._ecalMip = 0
+
+        # native backend
+        self._hasNativeBackend = True
+        self._lcioFiles = []
+        self._maxNEvents = 0
+        self._nWorkers = 1
+        self._simCaloHitCollections = {}
         
         # default settings
         self.setMuonEnergy(10)
-        self._setOutputPath("-c", "./SimCaloHitEnergyDistribution_")
+        self._setOutputPath("-c", "SimCaloHitEnergyDistribution_")
     
     def getEcalMip(self):
         return self._ecalMip
@@ -95,38 +353,82 @@ class MipCalibrator(PandoraAnalysisBinary):
         
     def setMuonEnergy(self, energy):
         self._setArgument("-b", energy)    
+
+    """ Set the muon lcio files and the maximum number of events to process (native backend)
+    """
+    def setLcioFiles(self, lcioFiles, maxNEvents=0):
+        self._lcioFiles = list(lcioFiles)
+        self._maxNEvents = maxNEvents
+
+    """ Set the SimCalorimeterHit collections of the subdetectors (native backend) : 
+        subdetector ("ECal", "HCalBarrel", "HCalEndcap" or "HCalRing") -> (barrel collections, endcap collections).
+        The mip values of the subdetectors not set are not computed
+    """
+    def setSimCaloHitCollections(self, collections):
+        unknown = [subDetector for subDetector in collections if subDetector not in MipCalibrator._subDetectorOutputs]
+        if unknown:
+            raise ValueError("MipCalibrator: unknown subdetector(s) {0}".format(", ".join(unknown)))
+        self._simCaloHitCollections = {subDetector : (list(barrel), list(endcap)) for subDetector, (barrel, endcap) in collections.iteritems()}
+
+    """ Set the number of processes reading the lcio files (native backend)
+    """
+    def setNWorkers(self, nWorkers):
+        self._nWorkers = int(nWorkers)
+
+    def _isNativeBackendAvailable(self):
+        return MipExtractor.isAvailable()
     
-    def run(self):
-        # cleanup file
-        self._removeFile(self._calibrationFile)
-        # run binary
-        super(MipCalibrator, self).run()
-        # extract variables
-        self._hcalBarrelMip = float(self._getFileContent(self._calibrationFile, 7, 5))
-        self._hcalEndcapMip = float(self._getFileContent(self._calibrationFile, 8, 5))
-        self._hcalRingMip = float(self._getFileContent(self._calibrationFile, 9, 5))
-        self._ecalMip = float(self._getFileContent(self._calibrationFile, 10, 4))
-        # cleanup again
-        if self._deleteOutputFile:
-            self._removeFile(self._calibrationFile)
+    def _cacheInputFiles(self):
+        return list(self._lcioFiles) if self._useNativeBackend() else PandoraAnalysisBinary._cacheInputFiles(self)
+
+    def _cacheParameters(self):
+        if not self._useNativeBackend():
+            return {}
+        return {"maxNEvents" : self._maxNEvents, "collections" : self._simCaloHitCollections}
+
+    def _runNative(self):
+        extractor = MipExtractor()
+        extractor.setInputFiles(self._lcioFiles)
+        extractor.setMaxNEvents(self._maxNEvents)
+        extractor.setNWorkers(self._nWorkers)
+        if not self._simCaloHitCollections:
+            raise RuntimeError("MipCalibrator: SimCalorimeterHit collections not set, can't run the native backend")
+        for subDetector, (barrel, endcap) in self._simCaloHitCollections.iteritems():
+            extractor.setCollections(subDetector, barrel, endcap)
+        extractor.run()
+        for subDetector in self._simCaloHitCollections:
+            setattr(self, MipCalibrator._subDetectorOutputs[subDetector], extractor.getMip(subDetector))
         
 ############################################################
 ############################################################
 """ EcalCalibrator class
     Implements the interface to the ECalDigitisation_ContainedEvents binary
     from LCPandoraAnalysis package
+    The native backend analyses the PfoAnalysis tree in-process, see ContainedEventsAnalysis.
+    It was not checked against the binary : it is only used with the "native" backend, "auto" runs the binary
 """
 class EcalCalibrator(PandoraAnalysisBinary):
+    _outputKeys = {"_ecalDigiMean" : "ecalDigiMean"}
+    _cachedOutputs = ["_ecalDigiMeanError"]
+    _autoSelectsNative = False
+
     def __init__(self):
         PandoraAnalysisBinary.__init__(self, "ECalDigitisation_ContainedEvents")
         
         # set default values
         self.setPhotonEnergy(10)
-        self._setOutputPath("-d", "./EcalEnergyCalibration_")
+        self._setOutputPath("-d", "EcalEnergyCalibration_")
         self.setCosThetaRange(0, 1)
         
+        # native backend
+        self._hasNativeBackend = True
+        self._energyBranch = "ECalTotalCaloHitEnergy"
+        self._vetoBranches = ["HCalTotalCaloHitEnergy", "MuonTotalCaloHitEnergy"]
+        self._vetoFraction = 0.05
+
         # outputs
         self._ecalDigiMean = 0.
+        self._ecalDigiMeanError = None
 
     def setRootFile(self, rootFile):
         self._setArgument("-a", rootFile)
@@ -143,17 +445,36 @@ class EcalCalibrator(PandoraAnalysisBinary):
     
     def getEcalDigiMean(self):
         return self._ecalDigiMean
+
+    """ The statistical error on the ecal digi mean. With the binary backend, it is computed from 
+        the PfoAnalysis tree (None if the tree can't be read, see PfoAnalysisTree.isAvailable)
+    """
+    def getEcalDigiMeanError(self):
+        return self._ecalDigiMeanError
         
-    def run(self):
-        # cleanup file
-        self._removeFile(self._calibrationFile)
-        # run
-        super(EcalCalibrator, self).run()
-        # extract variables
-        self._ecalDigiMean = float(self._getFileContent(self._calibrationFile, 11, 4))
-        # cleanup again
-        if self._deleteOutputFile:
-            self._removeFile(self._calibrationFile)
+    """ Set the PfoAnalysis tree branches used by the native backend : the calorimeter energy
+        and the energies of the calorimeters vetoed for the containment
+    """
+    def setNativeBranches(self, energyBranch, vetoBranches):
+        self._energyBranch = str(energyBranch)
+        self._vetoBranches = list(vetoBranches)
+
+    """ Set the maximum fraction of the energy in the vetoed calorimeters for contained events (native backend)
+    """
+    def setVetoFraction(self, fraction):
+        self._vetoFraction = float(fraction)
+
+    def _cacheParameters(self):
+        if not self._useNativeBackend():
+            return {}
+        return {"energyBranch" : self._energyBranch, "vetoBranches" : self._vetoBranches, "vetoFraction" : self._vetoFraction}
+
+    def _readOutputs(self):
+        self._readCalibrationFile()
+        self._ecalDigiMeanError = self._containedEventsMeanError()
+
+    def _runNative(self):
+        self._ecalDigiMean, self._ecalDigiMeanError = self._runContainedEventsAnalysis()
 
 
 
@@ -166,12 +487,14 @@ class EcalCalibrator(PandoraAnalysisBinary):
     from LCPandoraAnalysis package
 """
 class EcalRingCalibrator(PandoraAnalysisBinary):
+    _outputKeys = {"_endcapMeanDirectionCorrection" : "meanDirCorrEndcap", "_ringMeanDirectionCorrection" : "meanDirCorrRing"}
+
     def __init__(self):
         PandoraAnalysisBinary.__init__(self, "ECalDigitisation_DirectionCorrectionDistribution")
         
         # set default values
         self.setPhotonEnergy(10)
-        self._setOutputPath("-c", "./EcalRingEnergyCalibration_")
+        self._setOutputPath("-c", "EcalRingEnergyCalibration_")
         
         # outputs
         self._endcapMeanDirectionCorrection = 0.
@@ -188,18 +511,6 @@ class EcalRingCalibrator(PandoraAnalysisBinary):
         
     def getRingMeanDirectionCorrection(self):
         return self._ringMeanDirectionCorrection
-
-    def run(self):
-        # cleanup file
-        self._removeFile(self._calibrationFile)
-        # run
-        super(EcalRingCalibrator, self).run()
-        # extract variables
-        self._endcapMeanDirectionCorrection = float(self._getFileContent(self._calibrationFile, 4, 5))
-        self._ringMeanDirectionCorrection = float(self._getFileContent(self._calibrationFile, 9, 5))
-        # cleanup again
-        if self._deleteOutputFile:
-            self._removeFile(self._calibrationFile)
     
 
 
@@ -208,18 +519,31 @@ class EcalRingCalibrator(PandoraAnalysisBinary):
 """ HcalCalibrator class
     Implements the interface to the HCalDigitisation_ContainedEvents binary
     from LCPandoraAnalysis package
+    The native backend analyses the PfoAnalysis tree in-process, see ContainedEventsAnalysis.
+    It was not checked against the binary : it is only used with the "native" backend, "auto" runs the binary
 """
 class HcalCalibrator(PandoraAnalysisBinary):
+    _outputKeys = {"_hcalDigiMean" : "hcalDigiMean"}
+    _cachedOutputs = ["_hcalDigiMeanError"]
+    _autoSelectsNative = False
+
     def __init__(self):
         PandoraAnalysisBinary.__init__(self, "HCalDigitisation_ContainedEvents")
         
         # set default values
         self.setKaon0LEnergy(20)
-        self._setOutputPath("-d", "./HcalEnergyCalibration_")
+        self._setOutputPath("-d", "HcalEnergyCalibration_")
         self.setCosThetaRange(0, 1)
         
+        # native backend
+        self._hasNativeBackend = True
+        self._energyBranch = "HCalTotalCaloHitEnergy"
+        self._vetoBranches = ["ECalTotalCaloHitEnergy", "MuonTotalCaloHitEnergy"]
+        self._vetoFraction = 0.05
+
         # outputs
         self._hcalDigiMean = 0.
+        self._hcalDigiMeanError = None
 
     def setRootFile(self, rootFile):
         self._setArgument("-a", rootFile)
@@ -236,17 +560,36 @@ class HcalCalibrator(PandoraAnalysisBinary):
     
     def getHcalDigiMean(self):
         return self._hcalDigiMean
+
+    """ The statistical error on the hcal digi mean. With the binary backend, it is computed from 
+        the PfoAnalysis tree (None if the tree can't be read, see PfoAnalysisTree.isAvailable)
+    """
+    def getHcalDigiMeanError(self):
+        return self._hcalDigiMeanError
         
-    def run(self):
-        # cleanup file
-        self._removeFile(self._calibrationFile)
-        # run
-        super(HcalCalibrator, self).run()
-        # extract variables
-        self._hcalDigiMean = float(self._getFileContent(self._calibrationFile, 9, 5))
-        # cleanup again
-        if self._deleteOutputFile:
-            self._removeFile(self._calibrationFile)
+    """ Set the PfoAnalysis tree branches used by the native backend : the calorimeter energy
+        and the energies of the calorimeters vetoed for the containment
+    """
+    def setNativeBranches(self, energyBranch, vetoBranches):
+        self._energyBranch = str(energyBranch)
+        self._vetoBranches = list(vetoBranches)
+
+    """ Set the maximum fraction of the energy in the vetoed calorimeters for contained events (native backend)
+    """
+    def setVetoFraction(self, fraction):
+        self._vetoFraction = float(fraction)
+
+    def _cacheParameters(self):
+        if not self._useNativeBackend():
+            return {}
+        return {"energyBranch" : self._energyBranch, "vetoBranches" : self._vetoBranches, "vetoFraction" : self._vetoFraction}
+
+    def _readOutputs(self):
+        self._readCalibrationFile()
+        self._hcalDigiMeanError = self._containedEventsMeanError()
+
+    def _runNative(self):
+        self._hcalDigiMean, self._hcalDigiMeanError = self._runContainedEventsAnalysis()
         
 
 ############################################################
@@ -256,12 +599,14 @@ class HcalCalibrator(PandoraAnalysisBinary):
     from LCPandoraAnalysis package
 """
 class HcalRingCalibrator(PandoraAnalysisBinary):
+    _outputKeys = {"_endcapMeanDirectionCorrection" : "meanDirCorrEndcap", "_ringMeanDirectionCorrection" : "meanDirCorrRing"}
+
     def __init__(self):
         PandoraAnalysisBinary.__init__(self, "HCalDigitisation_DirectionCorrectionDistribution")
         
         # set default values
         self.setKaon0LEnergy(20)
-        self._setOutputPath("-c", "./HcalRingEnergyCalibration_")
+        self._setOutputPath("-c", "HcalRingEnergyCalibration_")
         
         # outputs
         self._endcapMeanDirectionCorrection = 0.
@@ -279,18 +624,6 @@ class HcalRingCalibrator(PandoraAnalysisBinary):
     def getRingMeanDirectionCorrection(self):
         return self._ringMeanDirectionCorrection
 
-    def run(self):
-        # cleanup file
-        self._removeFile(self._calibrationFile)
-        # run
-        super(HcalRingCalibrator, self).run()
-        # extract variables
-        self._endcapMeanDirectionCorrection = float(self._getFileContent(self._calibrationFile, 4, 5))
-        self._ringMeanDirectionCorrection = float(self._getFileContent(self._calibrationFile, 9, 5))
-        # cleanup again
-        if self._deleteOutputFile:
-            self._removeFile(self._calibrationFile)    
-
 ############################################################
 ############################################################
 """ PandoraMipScaleCalibrator class
@@ -298,12 +631,15 @@ class HcalRingCalibrator(PandoraAnalysisBinary):
     from LCPandoraAnalysis package
 """
 class PandoraMipScaleCalibrator(PandoraAnalysisBinary):
+    _outputKeys = {"_ecalToGeVMip" : "ecalToGeVMip", "_hcalToGeVMip" : "hcalToGeVMip",
+        "_muonToGeVMip" : "muonToGeVMip"}
+
     def __init__(self):
         PandoraAnalysisBinary.__init__(self, "PandoraPFACalibrate_MipResponse")
         
         # set default values
         self.setMuonEnergy(10)
-        self._setOutputPath("-c", "./PandoraMipScale_")
+        self._setOutputPath("-c", "PandoraMipScale_")
         
         # outputs
         self._ecalToHadGeV = 0.
@@ -323,36 +659,30 @@ class PandoraMipScaleCalibrator(PandoraAnalysisBinary):
     def getMuonToGeVMip(self):
         return self._muonToGeVMip 
 
-    def run(self):
-        # cleanup file
-        self._removeFile(self._calibrationFile)
-        # run
-        super(PandoraMipScaleCalibrator, self).run()
-        # extract variables
-        self._ecalToGeVMip = float(self._getFileContent(self._calibrationFile, 8, 2))
-        self._hcalToGeVMip = float(self._getFileContent(self._calibrationFile, 16, 2))
-        self._muonToGeVMip = float(self._getFileContent(self._calibrationFile, 24, 2))
-        # cleanup again
-        if self._deleteOutputFile:
-            self._removeFile(self._calibrationFile)  
-        
-
 ############################################################
 ############################################################
 """ PandoraEMScaleCalibrator class
     Implements the interface to the PandoraPFACalibrate_EMScale binary
     from LCPandoraAnalysis package
+    The statistical error of the mean is computed from the PfoAnalysis tree, see windowMean
 """
 class PandoraEMScaleCalibrator(PandoraAnalysisBinary):
+    _outputKeys = {"_ecalEMMean" : "ecalToEMMean"}
+    _cachedOutputs = ["_ecalEMMeanError"]
+
     def __init__(self):
         PandoraAnalysisBinary.__init__(self, "PandoraPFACalibrate_EMScale")
         
         # set default values
         self.setPhotonEnergy(10)
-        self._setOutputPath("-d", "./PandoraEMScale_")
+        self._setOutputPath("-d", "PandoraEMScale_")
         
+        # branches summed for the statistical error of the mean
+        self._energyBranches = ["pfoECalToEmEnergy", "pfoHCalToEmEnergy"]
+
         # outputs
         self._ecalEMMean = 0.
+        self._ecalEMMeanError = None
 
     def setRootFile(self, rootFile):
         self._setArgument("-a", rootFile)
@@ -363,35 +693,61 @@ class PandoraEMScaleCalibrator(PandoraAnalysisBinary):
     def getEcalToEMMean(self):
         return self._ecalEMMean
 
-    def run(self):
-        # cleanup file
-        self._removeFile(self._calibrationFile)
-        # run
-        super(PandoraEMScaleCalibrator, self).run()
-        # extract variables
-        self._ecalEMMean = float(self._getFileContent(self._calibrationFile, 9, 3))
-        # cleanup again
-        if self._deleteOutputFile:
-            self._removeFile(self._calibrationFile)  
-
+    """ The statistical error on the ecal to EM mean, computed from the PfoAnalysis tree 
+        (None if the tree can't be read, see PfoAnalysisTree.isAvailable)
+    """
+    def getEcalToEMMeanError(self):
+        return self._ecalEMMeanError
+
+    """ Set the PfoAnalysis tree branches summed to compute the statistical error of the mean
+    """
+    def setEnergyBranches(self, branches):
+        self._energyBranches = list(branches)
+
+    def _readOutputs(self):
+        self._readCalibrationFile()
+        self._ecalEMMeanError = self._computeTreeError(self._computeMeanError)
+
+    """ The error of the mean of the EM energy of the events with a non zero EM energy, in the
+        smallest window containing 90% of them
+    """
+    def _computeMeanError(self):
+        columns = PfoAnalysisTree(self._arguments["-a"]).getColumns(self._energyBranches)
+        energy = sum([columns[branch] for branch in self._energyBranches])
+        return windowMean(energy[energy > 0.])[1]
 
 ############################################################
 ############################################################
 """ PandoraHadScaleCalibrator class
     Implements the interface to the PandoraPFACalibrate_HadronicScale_ChiSquareMethod binary
     from LCPandoraAnalysis package
+    The native backend solves the chi square fit in closed form, see HadronicScaleFit.
+    Its event selection was not checked against the binary : it is only used with the 
+    "native" backend, "auto" runs the binary
 """
 class PandoraHadScaleCalibrator(PandoraAnalysisBinary):
+    _outputKeys = {"_ecalToHadGeV" : "ecalToHadMean", "_hcalToHadGeV" : "hcalToHadMean"}
+    _cachedOutputs = ["_ecalToHadGeVError", "_hcalToHadGeVError"]
+    _autoSelectsNative = False
+
     def __init__(self):
         PandoraAnalysisBinary.__init__(self, "PandoraPFACalibrate_HadronicScale_ChiSquareMethod")
         
         # set default values
         self.setKaon0LEnergy(10)
-        self._setOutputPath("-d", "./PandoraHadScale_")
+        self._setOutputPath("-d", "PandoraHadScale_")
         
+        # native backend
+        self._hasNativeBackend = True
+        self._ecalBranch = "pfoECalToHadEnergy"
+        self._hcalBranch = "pfoHCalToHadEnergy"
+        self._fit = None
+
         # outputs
         self._ecalToHadGeV = 0.
         self._hcalToHadGeV = 0.
+        self._ecalToHadGeVError = None
+        self._hcalToHadGeVError = None
 
     def setRootFile(self, rootFile):
         self._setArgument("-a", rootFile)
@@ -401,21 +757,52 @@ class PandoraHadScaleCalibrator(PandoraAnalysisBinary):
     
     def getEcalToHad(self):
         return self._ecalToHadGeV
+
+    """ The statistical error on the ecal to had mean (native backend only, None otherwise)
+    """
+    def getEcalToHadError(self):
+        return self._ecalToHadGeVError
     
     def getHcalToHad(self):
         return self._hcalToHadGeV
 
-    def run(self):
-        # cleanup file
-        self._removeFile(self._calibrationFile)
-        # run
-        super(PandoraHadScaleCalibrator, self).run()
-        # extract variables
-        self._ecalToHadGeV = float(self._getFileContent(self._calibrationFile, 5, 2))
-        self._hcalToHadGeV = float(self._getFileContent(self._calibrationFile, 6, 2))
-        # cleanup again
-        if self._deleteOutputFile:
-            self._removeFile(self._calibrationFile)  
+    """ The statistical error on the hcal to had mean (native backend only, None otherwise)
+    """
+    def getHcalToHadError(self):
+        return self._hcalToHadGeVError
+
+    """ The covariance matrix of the fitted ecal and hcal corrections (native backend only, None otherwise)
+    """
+    def getCovariance(self):
+        return self._fit.getCovariance() if self._fit else None
+
+    """ Predict the ecal and hcal to had responses for the ecal and hcal constants scaled by the given factors,
+        without new reconstruction (native backend only, None otherwise). See HadronicScaleFit.predict()
+    """
+    def predict(self, ecalScale, hcalScale):
+        return self._fit.predict(ecalScale, hcalScale) if self._fit else None
+
+    """ Set the PfoAnalysis tree branches of the per-event ecal and hcal energies at hadronic scale (native backend)
+    """
+    def setNativeBranches(self, ecalBranch, hcalBranch):
+        self._ecalBranch = str(ecalBranch)
+        self._hcalBranch = str(hcalBranch)
+
+    def start(self):
+        self._fit = None
+        super(PandoraHadScaleCalibrator, self).start()
+
+    """ The native fit is not cached : the steps use it to predict the responses of the next iteration
+    """
+    def _isCacheable(self):
+        return not self._useNativeBackend()
+
+    def _runNative(self):
+        self._fit = HadronicScaleFit(self._ecalBranch, self._hcalBranch)
+        self._ecalToHadGeV, self._hcalToHadGeV = self._fit.run(self._arguments["-a"], float(self._arguments["-b"]))
+        self._ecalToHadGeVError, self._hcalToHadGeVError = self._fit.getResponseErrors()
+        print "Native '{0}' fit : ecal to had {1} +- {2}, hcal to had {3} +- {4} ({5} events)".format(self._name, 
+            self._ecalToHadGeV, self._ecalToHadGeVError, self._hcalToHadGeV, self._hcalToHadGeVError, self._fit.getNEvents())
 
 
 ############################################################
@@ -423,29 +810,57 @@ class PandoraHadScaleCalibrator(PandoraAnalysisBinary):
 """ PandoraSoftCompCalibrator class
     Implements the interface to the PandoraPFACalibrate_SoftwareCompensation binary
     from LCPandoraAnalysis package
+    The native backend runs a multicore minimization with warm start, see SoftCompMinimizer.
+    It is only used with the "native" backend : "auto" runs the binary
 """
 class PandoraSoftCompCalibrator(PandoraAnalysisBinary):
+    _cachedOutputs = ["_softCompWeights"]
+    _autoSelectsNative = False
+
     def __init__(self):
         PandoraAnalysisBinary.__init__(self, "PandoraPFACalibrate_SoftwareCompensation")
         
         # set default values
-        self._setOutputPath("-d", "./PandoraSoftComp_")
+        self._setOutputPath("-d", "PandoraSoftComp_")
+        self.setUniqueOutputPath(False)
         self._runWithClusterEnergy = False
         
+        # native backend
+        self._hasNativeBackend = True
+        self._initialWeights = None
+        self._nWorkers = 1
+        self._energies = []
+        self._rootFilePattern = ""
+        self._rootTreeName = "SoftwareCompensationTrainingTree"
+
         # outputs
         self._softCompWeights = []
 
     def setEnergies(self, energies):
         if isinstance(energies, str):
             self._setArgument("-e", energies)
+            self._energies = energies.split(":")
         elif isinstance(energies, list):
             self._setArgument("-e", ":".join(energies))
+            self._energies = list(energies)
 
     def setRootFilePattern(self, pattern):
         self._setArgument("-f", pattern)
+        self._rootFilePattern = pattern
 
     def setRootTreeName(self, tree):
         self._setArgument("-t", tree)
+        self._rootTreeName = tree
+
+    """ Set the weights the minimization starts from (native backend), i.e the weights of a previous calibration
+    """
+    def setInitialWeights(self, weights):
+        self._initialWeights = [float(w) for w in weights] if weights else None
+
+    """ Set the number of processes evaluating the chi2 (native backend)
+    """
+    def setNWorkers(self, nWorkers):
+        self._nWorkers = int(nWorkers)
     
     def getSoftCompWeights(self):
         return self._softCompWeights
@@ -453,22 +868,34 @@ class PandoraSoftCompCalibrator(PandoraAnalysisBinary):
     def setRunWithClusterEnergy(self, runWithCluster):
         self._runWithClusterEnergy = runWithCluster
 
-    def run(self):
-        # cleanup file
-        self._removeFile(self._calibrationFile)
+    def start(self):
         # last argument added on the fly ...
         if self._runWithClusterEnergy:
             self._setArgument("-g")
-        # run            
-        super(PandoraSoftCompCalibrator, self).run()
-        # extract variables
-        self._softCompWeights  = []
-        for w in range(0, 9):
-            weight = float(self._getFileContent(self._calibrationFile, 8+w, 3))
-            self._softCompWeights.append(weight)
-        # cleanup again
-        if self._deleteOutputFile:
-            self._removeFile(self._calibrationFile)  
+        super(PandoraSoftCompCalibrator, self).start()
+
+    def _cacheInputFiles(self):
+        return [self._rootFilePattern.replace("%{energy}", str(energy)) for energy in self._energies]
+
+    def _cacheParameters(self):
+        if not self._useNativeBackend():
+            return {}
+        return {"initialWeights" : self._initialWeights}
+
+    def _readOutputs(self):
+        entries = self._readCalibrationFile()
+        self._softCompWeights = getSoftwareCompensationEntryWeights(entries, self._calibrationFile)
+
+    def _runNative(self):
+        minimizer = SoftCompMinimizer()
+        minimizer.setTreeName(self._rootTreeName)
+        minimizer.setNWorkers(self._nWorkers)
+        if self._initialWeights:
+            minimizer.setInitialWeights(self._initialWeights)
+        if self._runWithClusterEnergy:
+            minimizer.setClusterEnergyBranch("ClusterEnergy")
+        minimizer.load({float(energy) : self._rootFilePattern.replace("%{energy}", str(energy)) for energy in self._energies})
+        self._softCompWeights = minimizer.run()
         
         
         
@@ -40,6 +40,11 @@ class PandoraEMScaleStep(CalibrationStep) :
     def description(self):
         return "Calibrate the electromagnetic scale of the ecal and the hcal. Outputs the constants ECalToEMGeVCalibration and HCalToEMGeVCalibration"
 
+    """ The pandora processor written in the step output
+    """
+    def outputProcessors(self):
+        return [self._marlinPandoraProcessor]
+
     def readCmdLine(self, parsed) :
         # setup marlin
         self._marlin = Marlin(parsed.steeringFile)
@@ -50,6 +55,10 @@ class PandoraEMScaleStep(CalibrationStep) :
         self._maxNIterations = int(parsed.maxNIterations)
         self._energyScaleAccuracy = float(parsed.ecalCalibrationAccuracy)
         self._photonEnergy = parsed.photonEnergy
+        self._convergenceStrategy = parsed.convergenceStrategy
+        self.setBracketScales([scale for scale in parsed.bracketScales.split(",") if scale])
+        self.setBracketSinglePass(parsed.bracketSinglePass)
+        self.setEventSchedule([nEvents for nEvents in parsed.eventSchedule.split(",") if nEvents])
         
         # setup pandora settings
         pandora = PandoraXML(parsed.pandoraSettings)
@@ -68,6 +77,9 @@ class PandoraEMScaleStep(CalibrationStep) :
         
         if len(self._turnoffProcessors):
             self._marlin.turnOffProcessors(self._turnoffProcessors)
+
+        self._pruneMarlinProcessors(self._marlin)
+        self._marlin.setCheckpointProcessors(self._modifiedProcessors())
             
         self._inputEcalToEMGeV = float(self._marlin.getProcessorParameter(self._marlinPandoraProcessor, "ECalToEMGeVCalibration"))
         self._inputHcalToEMGeV = float(self._marlin.getProcessorParameter(self._marlinPandoraProcessor, "HCalToEMGeVCalibration"))
@@ -78,23 +90,63 @@ class PandoraEMScaleStep(CalibrationStep) :
         # loop variables
         currentPrecision = 0.
         calibrationRescaleFactor = 1.
-        calibrationRescaleFactorCumul = 1.
         accuracyReached = False
 
         ecalToEMGeV = self._inputEcalToEMGeV
         hcalToEMGeV = self._inputHcalToEMGeV
+
+        # scale of the input constants, driven by the convergence strategy
+        convergence = self._createConvergenceStrategy([self._photonEnergy])
         
         emScaleCalibrator = PandoraEMScaleCalibrator()
         emScaleCalibrator.setPhotonEnergy(self._photonEnergy)
 
+        # event schedule : the first iterations may use a reduced statistics
+        fullNEvents = self._getMarlinIntGlobalParameter("MaxRecordNumber")
+        scheduleStage = 0
+
+        # bracket mode : run the candidate scales concurrently and fit the response
+        if self._bracketScales:
+            def configureBracketPass(scale, rootFile):
+                self._marlin.setProcessorParameter(self._marlinPandoraProcessor, "ECalToEMGeVCalibration", str(self._inputEcalToEMGeV*scale))
+                self._marlin.setProcessorParameter(self._marlinPandoraProcessor, "HCalToEMGeVCalibration", str(self._inputHcalToEMGeV*scale))
+                self._marlin.setProcessorParameter(self._pfoAnalysisProcessor  , "RootFile", rootFile)
+
+            responses = []
+            errors = []
+            fullStatistics = self._setScheduledStatistics(scheduleStage, fullNEvents)
+
+            for index, rootFile in enumerate(self._runBracketPasses(configureBracketPass)):
+                emScaleCalibrator.setRootFile(rootFile)
+                emScaleCalibrator.run()
+                responses.append([emScaleCalibrator.getEcalToEMMean()])
+                errors.append([emScaleCalibrator.getEcalToEMMeanError()])
+                self._writeIterationOutput(config, "bracket{0}".format(index), {"scale" : self._bracketScales[index], "nEvents" : self._marlin.getGlobalParameter("MaxRecordNumber"),
+                    "newPhotonEnergy" : responses[-1][0], "statisticalError" : errors[-1][0]})
+
+            convergence.addMeasurements([[scale] for scale in self._bracketScales], responses, errors)
+
+            if convergence.checkConvergence(self._energyScaleAccuracy, fullStatistics) :
+                accuracyReached = True
+                self._outputEcalToEMGeV = self._inputEcalToEMGeV*convergence.convergedScales()[0]
+                self._outputHcalToEMGeV = self._inputHcalToEMGeV*convergence.convergedScales()[0]
+
+            scheduleStage = self._nextScheduleStage(scheduleStage, fullStatistics, convergence.isStatisticallyResolved(self._energyScaleAccuracy),
+                convergence.isNextPassPredictedConverged(self._energyScaleAccuracy))
+
         for iteration in range(self._maxNIterations) :
 
+            if accuracyReached :
+                break
+
             # readjust iteration parameters
-            ecalToEMGeV = ecalToEMGeV*calibrationRescaleFactor
-            hcalToEMGeV = hcalToEMGeV*calibrationRescaleFactor
-            pfoAnalysisFile = "./PfoAnalysis_{0}_iter{1}.root".format(self._name, iteration)
+            scale = convergence.nextScales()[0]
+            ecalToEMGeV = self._inputEcalToEMGeV*scale
+            hcalToEMGeV = self._inputHcalToEMGeV*scale
+            pfoAnalysisFile = self._workspacePath("PfoAnalysis_{0}_iter{1}.root".format(self._name, iteration), iteration)
 
             # run marlin ...
+            fullStatistics = self._setScheduledStatistics(scheduleStage, fullNEvents)
             self._marlin.setProcessorParameter(self._marlinPandoraProcessor, "ECalToEMGeVCalibration", str(ecalToEMGeV))
             self._marlin.setProcessorParameter(self._marlinPandoraProcessor, "HCalToEMGeVCalibration", str(hcalToEMGeV))
             self._marlin.setProcessorParameter(self._pfoAnalysisProcessor  , "RootFile", pfoAnalysisFile)
@@ -106,28 +158,36 @@ class PandoraEMScaleStep(CalibrationStep) :
             emScaleCalibrator.run()
 
             newPhotonEnergy = emScaleCalibrator.getEcalToEMMean()
+            statisticalError = emScaleCalibrator.getEcalToEMMeanError()
+            convergence.addMeasurement([scale], [newPhotonEnergy], [statisticalError])
             calibrationRescaleFactor = float(self._photonEnergy) / newPhotonEnergy
-            calibrationRescaleFactorCumul = calibrationRescaleFactorCumul*calibrationRescaleFactor
-            currentPrecision = abs(1 - 1. / calibrationRescaleFactor)
+            currentPrecision = convergence.precisions()[0]
 
             # write down iteration results
-            self._writeIterationOutput(config, iteration, {"precision" : currentPrecision, "rescale" : calibrationRescaleFactor, "newPhotonEnergy" : newPhotonEnergy})
+            self._writeIterationOutput(config, iteration, {"nEvents" : self._marlin.getGlobalParameter("MaxRecordNumber"), "precision" : currentPrecision, "rescale" : calibrationRescaleFactor,
+                "newPhotonEnergy" : newPhotonEnergy, "statisticalError" : statisticalError}, self._marlin.getOverlay())
 
             # are we accurate enough ??
-            if currentPrecision < self._energyScaleAccuracy :
+            if convergence.checkConvergence(self._energyScaleAccuracy, fullStatistics) :
 
                 print "{0}: ecal energy accuracy reached !".format(self._name)
                 accuracyReached = True
 
-                self._outputEcalToEMGeV = ecalToEMGeV
-                self._outputHcalToEMGeV = hcalToEMGeV
+                self._outputEcalToEMGeV = self._inputEcalToEMGeV*convergence.convergedScales()[0]
+                self._outputHcalToEMGeV = self._inputHcalToEMGeV*convergence.convergedScales()[0]
 
                 break
 
+            scheduleStage = self._nextScheduleStage(scheduleStage, fullStatistics, convergence.isStatisticallyResolved(self._energyScaleAccuracy),
+                convergence.isNextPassPredictedConverged(self._energyScaleAccuracy))
+
         if not accuracyReached :
             raise RuntimeError("{0}: Couldn't reach the user accuracy ({1})".format(self._name, self._energyScaleAccuracy))
 
 
+    def _modifiedProcessors(self):
+        return [self._marlinPandoraProcessor]
+
     def writeOutput(self, config) :
 
         output = self._getXMLStepOutput(config, create=True)
@@ -45,6 +45,11 @@ class PandoraHadScaleStep(CalibrationStep) :
     def description(self):
         return "Calibrate the hadronic scale of the ecal and the hcal. Outputs the constants ECalToHadGeVCalibrationBarrel, ECalToHadGeVCalibrationEndCap and HCalToHadGeVCalibration"
 
+    """ The pandora processor written in the step output
+    """
+    def outputProcessors(self):
+        return [self._marlinPandoraProcessor]
+
     def readCmdLine(self, parsed) :
         # setup marlin
         self._marlin = Marlin(parsed.steeringFile)
@@ -56,6 +61,10 @@ class PandoraHadScaleStep(CalibrationStep) :
         self._ecalEnergyScaleAccuracy = float(parsed.ecalCalibrationAccuracy)
         self._hcalEnergyScaleAccuracy = float(parsed.hcalCalibrationAccuracy)
         self._kaon0LEnergy = parsed.kaon0LEnergy
+        self._convergenceStrategy = parsed.convergenceStrategy
+        self.setBracketScales([scale for scale in parsed.bracketScales.split(",") if scale])
+        self.setBracketSinglePass(parsed.bracketSinglePass)
+        self.setEventSchedule([nEvents for nEvents in parsed.eventSchedule.split(",") if nEvents])
         
         # setup pandora settings
         pandora = PandoraXML(parsed.pandoraSettings)
@@ -74,6 +83,9 @@ class PandoraHadScaleStep(CalibrationStep) :
 
         if len(self._turnoffProcessors):
             self._marlin.turnOffProcessors(self._turnoffProcessors)
+
+        self._pruneMarlinProcessors(self._marlin)
+        self._marlin.setCheckpointProcessors(self._modifiedProcessors())
             
     def run(self, config) :
         # loop variables
@@ -83,32 +95,84 @@ class PandoraHadScaleStep(CalibrationStep) :
         ecalRescaleFactor = 1.
         hcalRescaleFactor = 1.
         
-        ecalRescaleFactorCumul = 1.
-        hcalRescaleFactorCumul = 1.
-        
         ecalAccuracyReached = False
         hcalAccuracyReached = False
 
-        ecalToHadGeVBarrel = float(self._marlin.getProcessorParameter(self._marlinPandoraProcessor, "ECalToHadGeVCalibrationBarrel"))
-        ecalToHadGeVEndcap = float(self._marlin.getProcessorParameter(self._marlinPandoraProcessor, "ECalToHadGeVCalibrationEndCap"))
-        hcalToHadGeV = float(self._marlin.getProcessorParameter(self._marlinPandoraProcessor, "HCalToHadGeVCalibration"))
+        inputEcalToHadGeVBarrel = float(self._marlin.getProcessorParameter(self._marlinPandoraProcessor, "ECalToHadGeVCalibrationBarrel"))
+        inputEcalToHadGeVEndcap = float(self._marlin.getProcessorParameter(self._marlinPandoraProcessor, "ECalToHadGeVCalibrationEndCap"))
+        inputHcalToHadGeV = float(self._marlin.getProcessorParameter(self._marlinPandoraProcessor, "HCalToHadGeVCalibration"))
+
+        # ecal and hcal scales of the input constants, driven by the convergence strategy.
+        # Both responses are measured in the same reconstruction pass, hence a 2D problem
+        convergence = self._createConvergenceStrategy([self._kaon0LEnergy, self._kaon0LEnergy])
+        accuracies = [self._ecalEnergyScaleAccuracy, self._hcalEnergyScaleAccuracy]
         
         hadScaleCalibrator = PandoraHadScaleCalibrator()
         hadScaleCalibrator.setKaon0LEnergy(self._kaon0LEnergy)
-        
+
+        # event schedule : the first iterations may use a reduced statistics
+        fullNEvents = self._getMarlinIntGlobalParameter("MaxRecordNumber")
+        scheduleStage = 0
+
+        # bracket mode : run the candidate scales concurrently and fit the response.
+        # The ecal and hcal scales are bracketed independently (see _bracketCandidates)
+        if self._bracketScales:
+            def configureBracketPass(candidate, rootFile):
+                ecalScale, hcalScale = candidate
+                self._marlin.setProcessorParameter(self._marlinPandoraProcessor, "ECalToHadGeVCalibrationBarrel", str(inputEcalToHadGeVBarrel*ecalScale))
+                self._marlin.setProcessorParameter(self._marlinPandoraProcessor, "ECalToHadGeVCalibrationEndCap", str(inputEcalToHadGeVEndcap*ecalScale))
+                self._marlin.setProcessorParameter(self._marlinPandoraProcessor, "HCalToHadGeVCalibration", str(inputHcalToHadGeV*hcalScale))
+                self._marlin.setProcessorParameter(self._pfoAnalysisProcessor  , "RootFile", rootFile)
+
+            responses = []
+            errors = []
+            candidates = self._bracketCandidates()
+            fullStatistics = self._setScheduledStatistics(scheduleStage, fullNEvents)
+
+            for index, rootFile in enumerate(self._runBracketPasses(configureBracketPass, candidates)):
+                hadScaleCalibrator.setRootFile(rootFile)
+                hadScaleCalibrator.run()
+                responses.append([hadScaleCalibrator.getEcalToHad(), hadScaleCalibrator.getHcalToHad()])
+                errors.append([hadScaleCalibrator.getEcalToHadError(), hadScaleCalibrator.getHcalToHadError()])
+                self._writeIterationOutput(config, "bracket{0}".format(index), 
+                    {"ecalScale" : candidates[index][0],
+                     "hcalScale" : candidates[index][1],
+                     "nEvents" : self._marlin.getGlobalParameter("MaxRecordNumber"),
+                     "newEcalKaon0LEnergy" : responses[-1][0],
+                     "ecalStatisticalError" : errors[-1][0],
+                     "newHcalKaon0LEnergy" : responses[-1][1],
+                     "hcalStatisticalError" : errors[-1][1]})
+
+            convergence.addMeasurements([list(candidate) for candidate in candidates], responses, errors)
+            convergence.checkConvergence(accuracies, fullStatistics)
+
+            if convergence.isFrozen(0) :
+                ecalAccuracyReached = True
+                self._outputEcalToHadGeVBarrel = inputEcalToHadGeVBarrel*convergence.convergedScales()[0]
+                self._outputEcalToHadGeVEndcap = inputEcalToHadGeVEndcap*convergence.convergedScales()[0]
+
+            if convergence.isFrozen(1) :
+                hcalAccuracyReached = True
+                self._outputHcalToHadGeV = inputHcalToHadGeV*convergence.convergedScales()[1]
+
+            scheduleStage = self._nextScheduleStage(scheduleStage, fullStatistics, convergence.isStatisticallyResolved(accuracies),
+                convergence.isNextPassPredictedConverged(accuracies))
+
         for iteration in range(self._maxNIterations) :
 
+            if ecalAccuracyReached and hcalAccuracyReached :
+                break
+
             # readjust iteration parameters
-            if not ecalAccuracyReached:
-                ecalToHadGeVBarrel = ecalToHadGeVBarrel*ecalRescaleFactor
-                ecalToHadGeVEndcap = ecalToHadGeVEndcap*ecalRescaleFactor
-            
-            if not hcalAccuracyReached:
-                hcalToHadGeV = hcalToHadGeV*hcalRescaleFactor
+            ecalScale, hcalScale = convergence.nextScales()
+            ecalToHadGeVBarrel = inputEcalToHadGeVBarrel*ecalScale
+            ecalToHadGeVEndcap = inputEcalToHadGeVEndcap*ecalScale
+            hcalToHadGeV = inputHcalToHadGeV*hcalScale
                 
-            pfoAnalysisFile = "./PfoAnalysis_{0}_iter{1}.root".format(self._name, iteration)
+            pfoAnalysisFile = self._workspacePath("PfoAnalysis_{0}_iter{1}.root".format(self._name, iteration), iteration)
 
             # run marlin ...
+            fullStatistics = self._setScheduledStatistics(scheduleStage, fullNEvents)
             self._marlin.setProcessorParameter(self._marlinPandoraProcessor, "ECalToHadGeVCalibrationBarrel", str(ecalToHadGeVBarrel))
             self._marlin.setProcessorParameter(self._marlinPandoraProcessor, "ECalToHadGeVCalibrationEndCap", str(ecalToHadGeVEndcap))
             self._marlin.setProcessorParameter(self._marlinPandoraProcessor, "HCalToHadGeVCalibration", str(hcalToHadGeV))
@@ -119,45 +183,80 @@ class PandoraHadScaleStep(CalibrationStep) :
             hadScaleCalibrator.setRootFile(pfoAnalysisFile)
             hadScaleCalibrator.run()
 
-            if not ecalAccuracyReached :
-                newEcalKaon0LEnergy = hadScaleCalibrator.getEcalToHad()    
-                ecalRescaleFactor = float(self._kaon0LEnergy) / newEcalKaon0LEnergy
-                ecalRescaleFactorCumul = ecalRescaleFactorCumul*ecalRescaleFactor
-                currentEcalPrecision = abs(1 - 1. / ecalRescaleFactor)
-                
-            if not hcalAccuracyReached :
-                newHcalKaon0LEnergy = hadScaleCalibrator.getHcalToHad()
-                hcalRescaleFactor = float(self._kaon0LEnergy) / newHcalKaon0LEnergy
-                hcalRescaleFactorCumul = hcalRescaleFactorCumul*hcalRescaleFactor
-                currentHcalPrecision = abs(1 - 1. / hcalRescaleFactor)
+            newEcalKaon0LEnergy = hadScaleCalibrator.getEcalToHad()
+            newHcalKaon0LEnergy = hadScaleCalibrator.getHcalToHad()
+            ecalStatisticalError = hadScaleCalibrator.getEcalToHadError()
+            hcalStatisticalError = hadScaleCalibrator.getHcalToHadError()
+            convergence.addMeasurement([ecalScale, hcalScale], [newEcalKaon0LEnergy, newHcalKaon0LEnergy], [ecalStatisticalError, hcalStatisticalError])
+            ecalRescaleFactor = float(self._kaon0LEnergy) / newEcalKaon0LEnergy
+            hcalRescaleFactor = float(self._kaon0LEnergy) / newHcalKaon0LEnergy
+            currentEcalPrecision, currentHcalPrecision = convergence.precisions()
 
             # write down iteration results
             self._writeIterationOutput(config, iteration, 
-                {"ecalPrecision" : currentEcalPrecision, 
+                {"nEvents" : self._marlin.getGlobalParameter("MaxRecordNumber"),
+                 "ecalPrecision" : currentEcalPrecision, 
                  "ecalRescale" : ecalRescaleFactor, 
                  "newEcalKaon0LEnergy" : newEcalKaon0LEnergy,
+                 "ecalStatisticalError" : ecalStatisticalError,
                  "hcalPrecision" : currentHcalPrecision, 
                  "hcalRescale" : hcalRescaleFactor, 
-                 "newHcalKaon0LEnergy" : newHcalKaon0LEnergy})
+                 "newHcalKaon0LEnergy" : newHcalKaon0LEnergy,
+                 "hcalStatisticalError" : hcalStatisticalError}, self._marlin.getOverlay())
 
             # are we accurate enough ??
-            if currentEcalPrecision < self._ecalEnergyScaleAccuracy :
+            convergence.checkConvergence(accuracies, fullStatistics)
+
+            if not ecalAccuracyReached and convergence.isFrozen(0) :
                 ecalAccuracyReached = True
-                self._outputEcalToHadGeVBarrel = ecalToHadGeVBarrel
-                self._outputEcalToHadGeVEndcap = ecalToHadGeVEndcap
+                self._outputEcalToHadGeVBarrel = inputEcalToHadGeVBarrel*convergence.convergedScales()[0]
+                self._outputEcalToHadGeVEndcap = inputEcalToHadGeVEndcap*convergence.convergedScales()[0]
 
-            # are we accurate enough ??
-            if currentHcalPrecision < self._hcalEnergyScaleAccuracy :
+            if not hcalAccuracyReached and convergence.isFrozen(1) :
                 hcalAccuracyReached = True
-                self._outputHcalToHadGeV = hcalToHadGeV
-            
-            if ecalAccuracyReached and hcalAccuracyReached :
-                break
+                self._outputHcalToHadGeV = inputHcalToHadGeV*convergence.convergedScales()[1]
 
+            scheduleStage = self._nextScheduleStage(scheduleStage, fullStatistics, convergence.isStatisticallyResolved(accuracies),
+                self._isNextPassPredictedConverged(convergence, hadScaleCalibrator, accuracies))
+            
         if not ecalAccuracyReached or not hcalAccuracyReached :
             raise RuntimeError("{0}: Couldn't reach the user accuracy".format(self._name))
 
 
+    """ Whether the next pass is predicted to reach the accuracy, by the convergence strategy or by
+        re-evaluating the last hadronic scale fit for the next scales (native backend only).
+        The calibrator must hold the fit of the last measured scales (not the case in bracket mode).
+        Nothing is frozen on the prediction : the next pass is the confirming pass
+    """
+    def _isNextPassPredictedConverged(self, convergence, hadScaleCalibrator, accuracies):
+        if convergence.isNextPassPredictedConverged(accuracies):
+            return True
+
+        if all(convergence.isFrozen(i) for i in range(convergence.dimension())):
+            return False
+
+        currentScales = convergence.currentScales()
+        nextScales = convergence.nextScales()
+        predictedResponses = hadScaleCalibrator.predict(nextScales[0] / currentScales[0], nextScales[1] / currentScales[1])
+
+        if predictedResponses is None:
+            return False
+
+        self._logger.info("{0}: responses {1} predicted at scales {2} by the hadronic scale fit".format(self._name, list(predictedResponses), nextScales))
+        return all(convergence.isFrozen(i) or abs(1. - predictedResponses[i] / self._kaon0LEnergy) < accuracies[i] for i in range(convergence.dimension()))
+
+    """ The (ecal scale, hcal scale) bracket candidates. Each dimension takes all the bracket scales,
+        the hcal scales being rotated by one candidate : the ecal and hcal scale differences between 
+        candidates are not collinear, so the responses of both dimensions are bracketed independently
+        and the 2D convergence strategies (e.g newton) can separate the ecal and hcal dependencies
+    """
+    def _bracketCandidates(self):
+        nScales = len(self._bracketScales)
+        return [(self._bracketScales[index], self._bracketScales[(index + 1) % nScales]) for index in range(nScales)]
+
+    def _modifiedProcessors(self):
+        return [self._marlinPandoraProcessor]
+
     def writeOutput(self, config) :
         output = self._getXMLStepOutput(config, create=True)
         self._writeProcessorParameter(output, self._marlinPandoraProcessor, "ECalToHadGeVCalibrationBarrel", self._outputEcalToHadGeVBarrel)
@@ -17,7 +17,7 @@ class PandoraMipScaleStep(CalibrationStep) :
         self._marlin = None
         self._muonEnergy = 0
 
-        self._pfoOutputFile = "./PfoAnalysis_" + self._name + ".root"
+        self._pfoOutputFile = ""
 
         # step output
         self._outputEcalToGeVMip = None
@@ -32,12 +32,18 @@ class PandoraMipScaleStep(CalibrationStep) :
     def description(self):
         return "Calculate the EcalToGeVMip, HcalToGeVMip and MuonToGeVMip that correspond to the mean reconstructed energy of mip calorimeter hit in the respective detectors"
 
+    """ The pandora processor written in the step output
+    """
+    def outputProcessors(self):
+        return [self._marlinPandoraProcessor]
+
     def readCmdLine(self, parsed) :
         # setup marlin
         self._marlin = Marlin(parsed.steeringFile)
         self._marlin.setCompactFile(parsed.compactFile)
         self._marlin.setMaxRecordNumber(parsed.maxRecordNumber)
         self._marlin.setInputFiles(self._extractFileList(parsed.lcioMuonFile, "slcio"))
+        self._pfoOutputFile = self._workspacePath("PfoAnalysis_" + self._name + ".root")
         self._marlin.setProcessorParameter(self._pfoAnalysisProcessor, "RootFile", self._pfoOutputFile)
         
         self._muonEnergy = parsed.muonEnergy
@@ -49,6 +55,8 @@ class PandoraMipScaleStep(CalibrationStep) :
         
         if len(self._runProcessors):
             self._marlin.turnOffProcessorsExcept(self._runProcessors)
+
+        self._pruneMarlinProcessors(self._marlin)
         
     def run(self, config) :
         self._marlin.run()
@@ -10,6 +10,7 @@ from calibration.FileTools import *
 from calibration.PandoraXML import *
 import os, sys
 from calibration.XmlTools import etree
+from calibration.ProcessExecutor import getExecutor
 from subprocess import call
 
 
@@ -39,6 +40,21 @@ class PandoraSoftCompStep(CalibrationStep) :
     def description(self):
         return "Calibrate the PandoraPFA software compensation energy correction weights"
 
+    """ The pandora processor written in the step output
+    """
+    def outputProcessors(self):
+        return [self._marlinPandoraProcessor]
+
+    """ The step runs the full reconstruction chain (if it runs Marlin)
+    """
+    def inputProcessors(self):
+        return None
+
+    """ The native minimizer runs a multiprocessing pool
+    """
+    def usesProcessPool(self):
+        return self._runMinimizer and self._calibrator is not None and self._calibrator.usesNativeBackend()
+
     def readCmdLine(self, parsed) :
         self._runMarlin = parsed.runMarlin
         self._runMinimizer = parsed.runMinimizer
@@ -88,6 +104,8 @@ class PandoraSoftCompStep(CalibrationStep) :
                 if len(self._turnoffProcessors):
                     marlin.turnOffProcessors(self._turnoffProcessors)
 
+                self._pruneMarlinProcessors(marlin)
+
                 try:
                     marlin.setProcessorParameter(self._pfoAnalysisProcessor, "RootFile", str(pfoAnalysisFile))
                 except:
@@ -102,8 +120,18 @@ class PandoraSoftCompStep(CalibrationStep) :
             self._calibrator.setRootFilePattern(parsed.rootFilePattern)
             self._calibrator.setRootTreeName("SoftwareCompensationTrainingTree")
             self._calibrator.setRunWithClusterEnergy(False)
+            self._calibrator.setNWorkers(getExecutor().maxNProcesses())
+
+    """ Pandora writes the software compensation training tree
+    """
+    def _pruneTargets(self):
+        return [self._marlinPandoraProcessor, self._pfoAnalysisProcessor]
 
     def init(self, config) :
+        # warm start the minimization from the weights of a previous calibration
+        if self._runMinimizer:
+            self._calibrator.setInitialWeights(self._getPreviousSoftCompWeights(config))
+
         self._cleanupElement(config)
         if self._runMarlin:
             self._marlin.loadInputParameters(config)
@@ -129,6 +157,27 @@ class PandoraSoftCompStep(CalibrationStep) :
             weights = self._calibrator.getSoftCompWeights()
             self._outputSoftCompWeights = " ".join([str(w) for w in weights])
 
+    """ Get the software compensation weights of a previous run of the step or of the user input (None if not found)
+    """
+    def _getPreviousSoftCompWeights(self, config):
+        xpath = "{0}/parameter[@processor='{1}' and @name='SoftwareCompensationWeights']"
+        elements = config.xpath(xpath.format("//step[@name='{0}']/output".format(self._name), self._marlinPandoraProcessor))
+
+        if not elements:
+            elements = config.xpath(xpath.format("//input", self._marlinPandoraProcessor))
+
+        if not elements or not elements[-1].text:
+            return None
+
+        weights = elements[-1].text.split()
+
+        if len(weights) != 9:
+            self._logger.warning("{0}: ignoring previous software compensation weights '{1}'".format(self._name, elements[-1].text))
+            return None
+
+        self._logger.info("{0}: minimization starting from the previous weights {1}".format(self._name, " ".join(weights)))
+        return weights
+
     def writeOutput(self, config) :
         if self._runMinimizer:
             output = self._getXMLStepOutput(config, create=True)
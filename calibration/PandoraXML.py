@@ -2,16 +2,21 @@
 
 from calibration.XmlTools import *
 import os
+import copy
 import subprocess
-import tempfile
+from calibration.Workspace import getWorkspace
 
 ############################################################
 ############################################################
 """ PandoraXML class.
     Wrap a pandora XML settings file with special methods
-    to activate/de-activated some features
+    to activate/de-activated some features.
+    A settings file is parsed once per process
 """
 class PandoraXML(object) :
+    # (file path, size, modification time) -> parsed tree
+    _parsedFiles = {}
+
     def __init__(self, fileName=None):
         self._fileName = fileName
         self._xmlTree = None
@@ -57,7 +62,7 @@ class PandoraXML(object) :
         if self._runSoftCompTraining:
             self._addSoftCompTrainingAlgorithm()
         
-        fhandle, fileName = tempfile.mkstemp(suffix=".xml")
+        fileName = getWorkspace().mkstemp(suffix=".xml", prefix="pandora_")
 
         self._xmlTree.write(fileName, pretty_print=True)
         return fileName
@@ -90,9 +95,17 @@ class PandoraXML(object) :
     """ Load the pandora xml file
     """ 
     def _loadXmlFile(self) :
-        xmlParser = createXMLParser()
         self._fileName = self._fileName.strip()
-        self._xmlTree = etree.parse(self._fileName, xmlParser)
+        path = os.path.realpath(self._fileName)
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+
+        if key not in PandoraXML._parsedFiles:
+            xmlParser = createXMLParser()
+            PandoraXML._parsedFiles[key] = etree.parse(self._fileName, xmlParser)
+
+        # the settings are modified before writing : work on a copy of the parsed file
+        self._xmlTree = copy.deepcopy(PandoraXML._parsedFiles[key])
         
     """ Remove the energy correction settings from the xml tree
     """
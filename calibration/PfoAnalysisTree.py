@@ -0,0 +1,444 @@
+import os
+import json
+import shutil
+import logging
+
+""" PfoAnalysisTree class.
+
+    Columnar reader of the PfoAnalysis root tree, written by the PfoAnalysis
+    Marlin processor. The branches are read at once (with uproot) in numpy arrays
+    and kept in memory as long as the root file is not modified, so that several
+    analyses of the same file (i.e one per detector region) read it only once.
+    The columns are also written on first access in an on-disk cache next to the
+    root file (<rootFile>.columns/), one .npy file per branch and a manifest
+    describing the root file they were extracted from. The cache is memory-mapped
+    by the later analyses, possibly in other processes, and is invalidated as soon
+    as the root file is modified or removed.
+    Requires numpy and uproot (numpy only to read a valid column cache).
+"""
+class PfoAnalysisTree(object):
+    _columnCache = {}
+    _useColumnCache = True
+
+    def __init__(self, rootFile, treeName="PfoAnalysisTree"):
+        self._rootFile = rootFile
+        self._treeName = treeName
+        self._logger = logging.getLogger("pfoAnalysisTree")
+
+    """ Whether the native analysis dependencies (numpy and uproot) are available
+    """
+    @staticmethod
+    def isAvailable():
+        try:
+            import numpy
+            import uproot
+        except ImportError:
+            return False
+        return True
+
+    """ Clear the in-memory column cache
+    """
+    @staticmethod
+    def clearCache():
+        PfoAnalysisTree._columnCache.clear()
+
+    """ Whether to use the on-disk column cache next to the root files
+    """
+    @staticmethod
+    def setUseColumnCache(use):
+        PfoAnalysisTree._useColumnCache = bool(use)
+
+    """ The directory of the column cache of a root file
+    """
+    @staticmethod
+    def columnCacheDir(rootFile):
+        return rootFile + ".columns"
+
+    """ Remove the column cache of a root file
+    """
+    @staticmethod
+    def removeColumnCache(rootFile):
+        cacheDir = PfoAnalysisTree.columnCacheDir(rootFile)
+        if os.path.isdir(cacheDir):
+            shutil.rmtree(cacheDir)
+
+    def rootFile(self):
+        return self._rootFile
+
+    """ Get the columns of the given branches as a dictionary of branch -> numpy array.
+        Variable size branches (std::vector) are returned as arrays of their first element (0 if empty)
+    """
+    def getColumns(self, branches):
+        path = os.path.realpath(self._rootFile)
+
+        if not os.path.isfile(path):
+            raise RuntimeError("PfoAnalysisTree: root file '{0}' not found".format(self._rootFile))
+
+        stat = os.stat(path)
+        fileKey = (path, self._treeName, stat.st_size, stat.st_mtime)
+
+        # drop the columns of previous versions of the file
+        for key in PfoAnalysisTree._columnCache.keys():
+            if key[0] == path and key != fileKey:
+                del PfoAnalysisTree._columnCache[key]
+
+        columns = PfoAnalysisTree._columnCache.setdefault(fileKey, {})
+        missingBranches = [branch for branch in branches if branch not in columns]
+
+        if missingBranches and PfoAnalysisTree._useColumnCache:
+            columns.update(self._loadCachedColumns(path, stat, missingBranches))
+            missingBranches = [branch for branch in branches if branch not in columns]
+
+        if missingBranches:
+            newColumns = self._readColumns(path, missingBranches)
+            columns.update(newColumns)
+
+            if PfoAnalysisTree._useColumnCache:
+                self._storeCachedColumns(path, stat, newColumns)
+
+        return {branch : columns[branch] for branch in branches}
+
+    """ The manifest describing the root file version the cached columns were extracted from
+    """
+    def _createManifest(self, path, stat):
+        return {"rootFile" : path, "tree" : self._treeName, "size" : stat.st_size, "mtime" : stat.st_mtime, "branches" : []}
+
+    def _readManifest(self, cacheDir):
+        try:
+            with open(os.path.join(cacheDir, "manifest.json")) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _isValidManifest(self, manifest, path, stat):
+        reference = self._createManifest(path, stat)
+        return manifest is not None and all(manifest.get(key) == reference[key] for key in ["rootFile", "tree", "size", "mtime"])
+
+    """ Memory-map the cached columns of the given branches (the ones available in the cache)
+    """
+    def _loadCachedColumns(self, path, stat, branches):
+        cacheDir = PfoAnalysisTree.columnCacheDir(path)
+        manifest = self._readManifest(cacheDir)
+
+        if not self._isValidManifest(manifest, path, stat):
+            return {}
+
+        import numpy
+        columns = {}
+
+        for branch in branches:
+            if branch in manifest["branches"]:
+                columns[branch] = numpy.load(os.path.join(cacheDir, branch + ".npy"), mmap_mode="r")
+
+        if columns:
+            self._logger.debug("Memory-mapped branches {0} from {1}".format(", ".join(columns.keys()), cacheDir))
+
+        return columns
+
+    """ Write the columns in the cache of the root file, replacing the cache of a previous version of the file
+    """
+    def _storeCachedColumns(self, path, stat, columns):
+        import numpy
+        cacheDir = PfoAnalysisTree.columnCacheDir(path)
+        manifest = self._readManifest(cacheDir)
+
+        try:
+            if not self._isValidManifest(manifest, path, stat):
+                PfoAnalysisTree.removeColumnCache(path)
+                os.makedirs(cacheDir)
+                manifest = self._createManifest(path, stat)
+
+            for branch, column in columns.iteritems():
+                # write then rename : readers never see partial files
+                tmpFile = os.path.join(cacheDir, "{0}.{1}.tmp.npy".format(branch, os.getpid()))
+                numpy.save(tmpFile, column)
+                os.rename(tmpFile, os.path.join(cacheDir, branch + ".npy"))
+
+            manifest["branches"] = sorted(set(manifest["branches"]) | set(columns.keys()))
+            tmpManifest = os.path.join(cacheDir, "manifest.{0}.tmp".format(os.getpid()))
+
+            with open(tmpManifest, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+
+            os.rename(tmpManifest, os.path.join(cacheDir, "manifest.json"))
+        except (IOError, OSError) as e:
+            self._logger.warning("Couldn't write the column cache {0} : {1}".format(cacheDir, str(e)))
+
+    def _readColumns(self, path, branches):
+        try:
+            import numpy
+            import uproot
+        except ImportError:
+            raise RuntimeError("PfoAnalysisTree: numpy and uproot are required to read '{0}'".format(self._rootFile))
+
+        self._logger.debug("Reading branches {0} from {1}".format(", ".join(branches), path))
+        tree = uproot.open(path)[self._treeName]
+
+        try:
+            arrays = tree.arrays(branches, library="np")
+        except TypeError:
+            # uproot 3 interface
+            arrays = tree.arrays(branches)
+
+        columns = {}
+
+        for name, array in arrays.items():
+            name = name.decode() if isinstance(name, bytes) else name
+            columns[name] = self._firstElements(numpy, array)
+
+        missingBranches = [branch for branch in branches if branch not in columns]
+
+        if missingBranches:
+            raise RuntimeError("PfoAnalysisTree: branches {0} not found in '{1}'".format(", ".join(missingBranches), self._rootFile))
+
+        return columns
+
+    """ Convert a column to a flat float array, keeping the first element of variable size entries
+    """
+    @staticmethod
+    def _firstElements(numpy, array):
+        # uproot 3 jagged array
+        if hasattr(array, "starts") and hasattr(array, "content"):
+            counts = numpy.asarray(array.counts)
+            content = numpy.asarray(array.content, dtype=float)
+            if len(content) == 0:
+                return numpy.zeros(len(counts))
+            starts = numpy.minimum(numpy.asarray(array.starts), len(content)-1)
+            return numpy.where(counts > 0, content[starts], 0.)
+
+        array = numpy.asarray(array)
+
+        if array.dtype == object:
+            return numpy.array([float(entry[0]) if len(entry) > 0 else 0. for entry in array])
+
+        return array.astype(float)
+
+
+
+""" ContainedEventsAnalysis class.
+
+    In-process analysis of the calorimeter energy of contained events, meant to
+    replace the ECalDigitisation_ContainedEvents and HCalDigitisation_ContainedEvents
+    binaries from LCPandoraAnalysis. It is NOT a port of these binaries : the
+    event selection and the mean estimation below were not taken from their sources
+    and the results were not compared with them on reference files yet (see
+    tests/testAnalysisBackends.py). The calibrators only use it with the "native" backend.
+    The energy deposited in a calorimeter is analysed for the events contained
+    in this calorimeter (the energy deposited in the veto calorimeters is below
+    a fraction of the total energy, 5% by default), in cos(theta) regions of the 
+    generated particle. The distribution mean is evaluated in the smallest window 
+    containing a fraction of the events (90% by default, as the Pandora rms90), 
+    the error is the rms in this window divided by the square root of its number of events.
+    All the regions are analysed from a single read of the PfoAnalysis tree.
+"""
+class ContainedEventsAnalysis(object):
+    def __init__(self, energyBranch, vetoBranches):
+        self._energyBranch = energyBranch
+        self._vetoBranches = list(vetoBranches)
+        self._vetoFraction = 0.05
+        self._momentumBranches = ["mcPfoPx", "mcPfoPy", "mcPfoPz"]
+        self._windowFraction = 0.9
+        self._regions = {}
+        self._results = {}
+
+    """ Set the maximum fraction of the total energy deposited in the veto calorimeters
+    """
+    def setVetoFraction(self, fraction):
+        self._vetoFraction = float(fraction)
+
+    """ Set the branches of the generated particle momentum (px, py, pz)
+    """
+    def setMomentumBranches(self, px, py, pz):
+        self._momentumBranches = [px, py, pz]
+
+    """ Set the fraction of events kept around the distribution peak to compute the mean
+    """
+    def setWindowFraction(self, fraction):
+        self._windowFraction = float(fraction)
+
+    """ Add a region with its |cos(theta)| range
+    """
+    def addRegion(self, region, minCosTheta, maxCosTheta):
+        self._regions[region] = (float(minCosTheta), float(maxCosTheta))
+
+    """ Analyse all the regions of the root file
+    """
+    def run(self, rootFile):
+        import numpy
+
+        branches = [self._energyBranch] + self._vetoBranches + self._momentumBranches
+        columns = PfoAnalysisTree(rootFile).getColumns(branches)
+
+        energy = columns[self._energyBranch]
+        vetoEnergy = sum([columns[branch] for branch in self._vetoBranches], numpy.zeros(len(energy)))
+        px, py, pz = [columns[branch] for branch in self._momentumBranches]
+        momentum = numpy.sqrt(px*px + py*py + pz*pz)
+        cosTheta = numpy.abs(pz) / numpy.where(momentum > 0., momentum, 1.)
+
+        contained = (energy > 0.) & (momentum > 0.) & (vetoEnergy <= self._vetoFraction * (energy + vetoEnergy))
+        self._results = {}
+
+        for region, (minCosTheta, maxCosTheta) in self._regions.iteritems():
+            selection = contained & (cosTheta >= minCosTheta) & (cosTheta <= maxCosTheta)
+            if not numpy.any(selection):
+                raise RuntimeError("ContainedEventsAnalysis: no contained event in region '{0}'".format(region))
+            self._results[region] = windowMean(energy[selection], self._windowFraction)
+
+        return self._results
+
+    """ Get the (mean, error, number of events) of a region after run()
+    """
+    def getResult(self, region):
+        if region not in self._results:
+            raise RuntimeError("ContainedEventsAnalysis: no result for region '{0}'".format(region))
+        return self._results[region]
+
+
+
+""" The (mean, error, number of values) of a distribution in the smallest window containing the 
+    given fraction of the values (as the Pandora rms90). The error is the rms in the window divided 
+    by the square root of its number of values
+"""
+def windowMean(values, fraction=0.9):
+    import numpy
+
+    if len(values) == 0:
+        raise RuntimeError("windowMean: empty distribution")
+
+    values = numpy.sort(values)
+    nWindow = max(1, int(numpy.ceil(fraction * len(values))))
+    # smallest window containing nWindow values
+    widths = values[nWindow-1:] - values[:len(values)-nWindow+1]
+    start = int(numpy.argmin(widths))
+    window = values[start:start+nWindow]
+    error = numpy.std(window) / numpy.sqrt(len(window)) if len(window) > 1 else 0.
+
+    return float(numpy.mean(window)), float(error), len(window)
+
+
+
+""" HadronicScaleFit class.
+
+    In-process replacement of the PandoraPFACalibrate_HadronicScale_ChiSquareMethod
+    binary from LCPandoraAnalysis. The ecal and hcal hadronic scale corrections
+    (alpha, beta) minimize the chi square :
+        sum_events (alpha*E_ecal + beta*E_hcal - E_true)^2 / E_true
+    where E_ecal and E_hcal are the per-event ecal and hcal energies at hadronic scale.
+    This is a linear least squares problem, solved in closed form. The fit results
+    are given as the energies E_true/alpha and E_true/beta, i.e the ecal and hcal
+    responses to rescale to the true energy.
+    The events are selected as single neutral hadron events : one reconstructed pfo,
+    a neutral hadron, with a non zero calorimetric energy and without significant 
+    energy lost in neutrinos or in the forward region. This selection is built from 
+    the PfoAnalysis tree branches and was not checked against the binary.
+    The selected per-event energies are kept in memory : the fit can be re-evaluated 
+    for scaled calibration constants without new reconstruction (see predict()).
+"""
+class HadronicScaleFit(object):
+    def __init__(self, ecalBranch="pfoECalToHadEnergy", hcalBranch="pfoHCalToHadEnergy"):
+        self._ecalBranch = ecalBranch
+        self._hcalBranch = hcalBranch
+        self._nPfoBranches = {"nPfosTotal" : 1, "nPfosNeutralHadrons" : 1}
+        self._lostEnergyBranches = ["mcEnergyENu", "mcEnergyFwd"]
+        self._maxLostEnergyFraction = 0.01
+        self._trueEnergy = 0.
+        self._alpha = 0.
+        self._beta = 0.
+        self._covariance = None
+        self._nEvents = 0
+        self._ecal = None
+        self._hcal = None
+
+    """ Set the required numbers of pfos of the selected events : branch -> number of pfos
+    """
+    def setNPfoSelection(self, nPfoBranches):
+        self._nPfoBranches = dict(nPfoBranches)
+
+    """ Set the branches of the generated energy lost by the calorimeters (neutrinos, forward region)
+        and the maximum fraction of the true energy lost by the selected events
+    """
+    def setLostEnergySelection(self, branches, maxFraction):
+        self._lostEnergyBranches = list(branches)
+        self._maxLostEnergyFraction = float(maxFraction)
+
+    """ Fit the corrections on the selected events of the root file, for the given true particle energy
+    """
+    def run(self, rootFile, trueEnergy):
+        import numpy
+
+        branches = [self._ecalBranch, self._hcalBranch] + self._nPfoBranches.keys() + self._lostEnergyBranches
+        columns = PfoAnalysisTree(rootFile).getColumns(branches)
+        ecal, hcal = columns[self._ecalBranch], columns[self._hcalBranch]
+        self._trueEnergy = float(trueEnergy)
+
+        selection = (ecal + hcal) > 0.
+        for branch, nPfos in self._nPfoBranches.iteritems():
+            selection &= columns[branch] == nPfos
+        lostEnergy = sum([columns[branch] for branch in self._lostEnergyBranches], numpy.zeros(len(ecal)))
+        selection &= lostEnergy <= self._maxLostEnergyFraction * self._trueEnergy
+
+        # copies : the fit doesn't keep the column cache memory maps open
+        self._ecal, self._hcal = numpy.array(ecal[selection]), numpy.array(hcal[selection])
+        self._nEvents = len(self._ecal)
+
+        if self._nEvents < 3:
+            raise RuntimeError("HadronicScaleFit: not enough selected events in '{0}' ({1})".format(rootFile, self._nEvents))
+
+        self._alpha, self._beta, self._covariance = self._solve(self._ecal, self._hcal, rootFile)
+        return self.getResponses()
+
+    """ Solve the normal equations of the chi square for the given per-event energies.
+        Returns alpha, beta and their covariance matrix
+    """
+    def _solve(self, ecal, hcal, rootFile):
+        import numpy
+
+        # the weight 1/E_true is common to all the events
+        matrix = numpy.array([[numpy.dot(ecal, ecal), numpy.dot(ecal, hcal)], [numpy.dot(ecal, hcal), numpy.dot(hcal, hcal)]])
+        vector = self._trueEnergy * numpy.array([numpy.sum(ecal), numpy.sum(hcal)])
+
+        if abs(numpy.linalg.det(matrix)) <= 1e-12 * matrix[0][0] * matrix[1][1]:
+            raise RuntimeError("HadronicScaleFit: degenerated ecal/hcal energies in '{0}'".format(rootFile))
+
+        inverse = numpy.linalg.inv(matrix)
+        alpha, beta = numpy.dot(inverse, vector)
+
+        # covariance scaled with the residual variance
+        residuals = alpha*ecal + beta*hcal - self._trueEnergy
+        variance = numpy.dot(residuals, residuals) / (len(ecal) - 2)
+
+        return float(alpha), float(beta), (variance * inverse).tolist()
+
+    """ Predict the ecal and hcal responses if the ecal and hcal calibration constants were scaled 
+        by the given factors. The energies at hadronic scale are proportional to the constants :
+        the fit is re-evaluated on the scaled energies of the selected events, without reading
+        the root file again
+    """
+    def predict(self, ecalScale, hcalScale):
+        if self._ecal is None:
+            raise RuntimeError("HadronicScaleFit: predict() called before run()")
+
+        alpha, beta, covariance = self._solve(self._ecal * ecalScale, self._hcal * hcalScale, "prediction")
+        return self._trueEnergy / alpha, self._trueEnergy / beta
+
+    def getNEvents(self):
+        return self._nEvents
+
+    """ The fitted (alpha, beta) corrections and their covariance matrix
+    """
+    def getCorrections(self):
+        return self._alpha, self._beta
+
+    def getCovariance(self):
+        return self._covariance
+
+    """ The ecal and hcal responses (E_true/alpha, E_true/beta)
+    """
+    def getResponses(self):
+        return self._trueEnergy / self._alpha, self._trueEnergy / self._beta
+
+    """ The errors of the ecal and hcal responses, propagated from the covariance
+    """
+    def getResponseErrors(self):
+        return (self._trueEnergy * self._covariance[0][0]**0.5 / self._alpha**2,
+                self._trueEnergy * self._covariance[1][1]**0.5 / self._beta**2)
@@ -0,0 +1,194 @@
+import os
+import errno
+import subprocess
+import logging
+import multiprocessing
+import threading
+import time
+
+""" ProcessJob class.
+    Status of an external process submitted to the process executor
+"""
+class ProcessJob(object):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+    def __init__(self, args, name=None, stdout=None):
+        self._args = [str(arg) for arg in args]
+        self._name = name if name else os.path.basename(self._args[0])
+        self._stdout = stdout
+        self._status = ProcessJob.QUEUED
+        self._returnCode = None
+        self._process = None
+        self._startTime = None
+        self._endTime = None
+
+    def name(self):
+        return self._name
+
+    def args(self):
+        return self._args
+
+    def status(self):
+        return self._status
+
+    def returnCode(self):
+        return self._returnCode
+
+    def pid(self):
+        return self._process.pid if self._process else None
+
+    """ Whether the job is finished (succeeded or failed)
+    """
+    def done(self):
+        return self._status in (ProcessJob.SUCCEEDED, ProcessJob.FAILED)
+
+    def succeeded(self):
+        return self._status == ProcessJob.SUCCEEDED
+
+    """ The job running time in seconds (None if not started)
+    """
+    def duration(self):
+        if self._startTime is None:
+            return None
+        endTime = self._endTime if self._endTime is not None else time.time()
+        return endTime - self._startTime
+
+    def _start(self, process):
+        self._process = process
+        self._status = ProcessJob.RUNNING
+        self._startTime = time.time()
+
+    def _finish(self, returnCode):
+        self._returnCode = returnCode
+        self._status = ProcessJob.SUCCEEDED if returnCode == 0 else ProcessJob.FAILED
+        self._endTime = time.time()
+        # the child has already been reaped, prevent Popen from waiting for it
+        if self._process:
+            self._process.returncode = returnCode
+
+    def __str__(self):
+        return "{0} (pid {1}) : {2}, status {3}".format(self._name, self.pid(), self._status, self._returnCode)
+
+
+################################################################################
+
+""" ProcessExecutor class.
+
+    Runs external processes (Marlin, ddsim, calibration binaries, ...) under a
+    global concurrency budget. Jobs are queued with submit() and started as soon
+    as a slot is available. Each started process has a waiter thread blocked in
+    waitpid on its pid : when the process ends, the waiter updates the job, starts
+    the queued jobs and wakes up the waiting threads. Only the pids started by the
+    executor are waited for : the other child processes (e.g multiprocessing pool
+    workers) are never reaped by the executor.
+    All the wrappers of this package submit their processes to the same executor,
+    use getExecutor() to access it. The executor can be used from several threads
+    (e.g calibration steps running concurrently).
+"""
+class ProcessExecutor(object):
+    def __init__(self, maxNProcesses=None):
+        self._maxNProcesses = maxNProcesses if maxNProcesses else multiprocessing.cpu_count()
+        self._queuedJobs = []
+        self._runningJobs = {}
+        self._logger = logging.getLogger("executor")
+        self._condition = threading.Condition()
+
+    """ Set the maximum number of processes running at the same time
+    """
+    def setMaxNProcesses(self, maxNProcesses):
+        if int(maxNProcesses) > 0:
+            self._maxNProcesses = int(maxNProcesses)
+
+    def maxNProcesses(self):
+        return self._maxNProcesses
+
+    """ Submit a process to run. Returns the corresponding job.
+        The optional stdout argument is passed to subprocess.Popen
+    """
+    def submit(self, args, name=None, stdout=None):
+        job = ProcessJob(args, name, stdout)
+        with self._condition:
+            self._queuedJobs.append(job)
+            self._logger.debug("Submitted job {0} : {1}".format(job.name(), " ".join(job.args())))
+            self._startQueuedJobs()
+        return job
+
+    """ Run a process and wait for its termination. Returns the corresponding job
+    """
+    def run(self, args, name=None, stdout=None):
+        job = self.submit(args, name, stdout)
+        self.wait([job])
+        return job
+
+    """ Wait for all the jobs of the list to finish. Returns the list of jobs
+    """
+    def wait(self, jobs):
+        self._waitUntil(lambda: all(job.done() for job in jobs))
+        return jobs
+
+    """ Wait for one of the jobs of the list to finish. Returns the finished job
+    """
+    def waitAny(self, jobs):
+        self._waitUntil(lambda: any(job.done() for job in jobs))
+        return [job for job in jobs if job.done()][0]
+
+    """ Wait until the condition is fulfilled. The waiting threads are woken up by the waiter
+        threads when a job ends
+    """
+    def _waitUntil(self, condition):
+        with self._condition:
+            while not condition():
+                if not self._runningJobs:
+                    raise RuntimeError("ProcessExecutor: waiting for jobs that are neither running nor queued")
+                self._condition.wait()
+
+    def _startQueuedJobs(self):
+        while self._queuedJobs and len(self._runningJobs) < self._maxNProcesses:
+            job = self._queuedJobs.pop(0)
+            try:
+                process = subprocess.Popen(args = job.args(), stdout = job._stdout)
+            except OSError as e:
+                self._logger.error("Couldn't start job {0} : {1}".format(job.name(), str(e)))
+                job._finish(127)
+                continue
+            job._start(process)
+            self._runningJobs[process.pid] = job
+            waiter = threading.Thread(target=self._waitForJob, args=(process.pid,), name="waiter_{0}".format(process.pid))
+            waiter.daemon = True
+            waiter.start()
+            self._logger.info("Started job {0} (pid {1}, {2}/{3} running)".format(job.name(), process.pid, len(self._runningJobs), self._maxNProcesses))
+
+    """ Waiter thread of a started process : block until the process ends, then update its job,
+        start the queued jobs and wake up the waiting threads
+    """
+    def _waitForJob(self, pid):
+        while True:
+            try:
+                endedPid, status = os.waitpid(pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
+        returnCode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+        with self._condition:
+            job = self._runningJobs.pop(pid)
+            job._finish(returnCode)
+            self._logger.info("Job ended : {0} ({1:.1f} s)".format(job, job.duration()))
+            self._startQueuedJobs()
+            self._condition.notify_all()
+
+
+_executor = None
+
+""" Get the process executor shared by all the process wrappers
+"""
+def getExecutor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessExecutor()
+    return _executor
@@ -0,0 +1,197 @@
+import os
+import json
+import logging
+from math import sqrt
+from calibration.FileTools import fileFingerprint
+
+""" RegionSkimmer class.
+
+    Split lcio files in detector regions, based on the cos(theta) of the
+    generated MC particle (single particle samples). Each event is written to
+    the file of the first region whose |cos(theta)| range contains it, or to
+    the "Other" region file. The skim is processed once : an index file
+    describing the inputs and the regions is written next to the region files
+    and the skim is reused as long as it matches.
+    Requires pyLCIO.
+"""
+class RegionSkimmer(object):
+    OTHER = "Other"
+
+    def __init__(self, name):
+        self._name = name
+        self._inputFiles = []
+        self._outputDirectory = "."
+        self._regions = []
+        self._skipNEvents = 0
+        self._maxNEvents = 0
+        self._mcParticleCollection = "MCParticle"
+        self._logger = logging.getLogger("skimmer")
+
+    """ Set the lcio input file(s)
+    """
+    def setInputFiles(self, inputFiles):
+        self._inputFiles = list(inputFiles) if isinstance(inputFiles, list) else [inputFiles]
+
+    def setOutputDirectory(self, directory):
+        self._outputDirectory = directory
+
+    """ Add a region with its |cos(theta)| range
+    """
+    def addRegion(self, region, minCosTheta, maxCosTheta):
+        self._regions.append((region, float(minCosTheta), float(maxCosTheta)))
+
+    """ Set the event window to skim (same meaning as the Marlin SkipNEvents and MaxRecordNumber parameters)
+    """
+    def setEventRange(self, skipNEvents, maxNEvents):
+        self._skipNEvents = int(skipNEvents) if skipNEvents else 0
+        self._maxNEvents = int(maxNEvents) if maxNEvents else 0
+
+    def setMCParticleCollection(self, collection):
+        self._mcParticleCollection = str(collection)
+
+    """ Get the name of the skim file of a region
+    """
+    def regionFile(self, region):
+        return os.path.join(self._outputDirectory, "{0}_{1}.slcio".format(self._name, region))
+
+    """ Get a file holding the first nEvents events of a region skim file (reduced statistics of the region).
+        The file is written on first use and reused while it is more recent than the region file
+    """
+    def headFile(self, region, nEvents):
+        regionFile = self.regionFile(region)
+        headFile = os.path.join(self._outputDirectory, "{0}_{1}_first{2}.slcio".format(self._name, region, nEvents))
+
+        if os.path.isfile(headFile) and os.path.getmtime(headFile) >= os.path.getmtime(regionFile):
+            return headFile
+
+        try:
+            from pyLCIO import IOIMPL, EVENT
+        except ImportError:
+            raise RuntimeError("RegionSkimmer: pyLCIO is required to skim the input files")
+
+        # write then rename : a partial file is never reused
+        tmpFile = os.path.join(self._outputDirectory, "{0}_{1}_first{2}.tmp.slcio".format(self._name, region, nEvents))
+        factory = IOIMPL.LCFactory.getInstance()
+        reader = factory.createLCReader()
+        writer = factory.createLCWriter()
+        reader.open(regionFile)
+        writer.open(tmpFile, EVENT.LCIO.WRITE_NEW)
+        count = 0
+
+        try:
+            for event in reader:
+                if count >= nEvents:
+                    break
+                writer.writeEvent(event)
+                count += 1
+        finally:
+            writer.close()
+            reader.close()
+
+        os.rename(tmpFile, headFile)
+        self._logger.info("{0}: wrote the first {1} events of region {2} in {3}".format(self._name, count, region, headFile))
+        return headFile
+
+    """ Process the skim (if not already done). Returns a dictionary of region -> number of events
+    """
+    def run(self):
+        index = self._createIndex()
+        indexFile = os.path.join(self._outputDirectory, "{0}_index.json".format(self._name))
+
+        if os.path.isfile(indexFile):
+            with open(indexFile) as f:
+                previousIndex = json.load(f)
+            if previousIndex.get("inputs") == index["inputs"] and all(os.path.isfile(self.regionFile(r)) for r in previousIndex["counts"]):
+                self._logger.info("{0}: reusing region skim {1}".format(self._name, indexFile))
+                return previousIndex["counts"]
+
+        try:
+            from pyLCIO import IOIMPL, EVENT
+        except ImportError:
+            raise RuntimeError("RegionSkimmer: pyLCIO is required to skim the input files")
+
+        if not os.path.isdir(self._outputDirectory):
+            os.makedirs(self._outputDirectory)
+
+        factory = IOIMPL.LCFactory.getInstance()
+        regions = [region for region, minCosTheta, maxCosTheta in self._regions] + [RegionSkimmer.OTHER]
+        writers = {}
+        counts = {region : 0 for region in regions}
+
+        for region in regions:
+            writers[region] = factory.createLCWriter()
+            writers[region].open(self.regionFile(region), EVENT.LCIO.WRITE_NEW)
+
+        nEvents = 0
+
+        try:
+            for inputFile in self._inputFiles:
+                reader = factory.createLCReader()
+                reader.open(inputFile)
+
+                for event in reader:
+                    nEvents += 1
+                    if nEvents <= self._skipNEvents:
+                        continue
+                    if self._maxNEvents > 0 and nEvents > self._skipNEvents + self._maxNEvents:
+                        break
+
+                    region = self._getRegion(event)
+                    writers[region].writeEvent(event)
+                    counts[region] += 1
+
+                reader.close()
+
+                if self._maxNEvents > 0 and nEvents > self._skipNEvents + self._maxNEvents:
+                    break
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        index["counts"] = counts
+
+        with open(indexFile, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+
+        self._logger.info("{0}: region skim done : {1}".format(self._name, ", ".join(["{0} {1}".format(r, counts[r]) for r in regions])))
+        return counts
+
+    def _createIndex(self):
+        return {"inputs" : {
+            "files" : [fileFingerprint(f) for f in self._inputFiles],
+            "regions" : [list(region) for region in self._regions],
+            "skipNEvents" : self._skipNEvents,
+            "maxNEvents" : self._maxNEvents,
+            "mcParticleCollection" : self._mcParticleCollection}}
+
+    """ Get the region of an event from the generated particle direction
+    """
+    def _getRegion(self, event):
+        try:
+            mcParticles = event.getCollection(self._mcParticleCollection)
+        except Exception:
+            return RegionSkimmer.OTHER
+
+        particle = None
+
+        for mcParticle in mcParticles:
+            if len(mcParticle.getParents()) == 0:
+                particle = mcParticle
+                break
+
+        if particle is None:
+            return RegionSkimmer.OTHER
+
+        px, py, pz = particle.getMomentum()[0], particle.getMomentum()[1], particle.getMomentum()[2]
+        momentum = sqrt(px*px + py*py + pz*pz)
+
+        if momentum == 0.:
+            return RegionSkimmer.OTHER
+
+        cosTheta = abs(pz) / momentum
+
+        for region, minCosTheta, maxCosTheta in self._regions:
+            if minCosTheta <= cosTheta <= maxCosTheta:
+                return region
+
+        return RegionSkimmer.OTHER
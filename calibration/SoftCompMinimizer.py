@@ -0,0 +1,249 @@
+import logging
+import multiprocessing
+
+""" SoftCompMinimizer class.
+
+    In-process replacement of the PandoraPFACalibrate_SoftwareCompensation binary
+    from LCPandoraAnalysis. The software compensation training trees of all the
+    energies are reduced once to contiguous arrays : per event, the hcal hit
+    energies are summed in hit energy density bins. The 9 weights parametrize the
+    weight of each density bin as :
+        p1 = w0 + w1*E + w2*E^2
+        p2 = w3 + w4*E + w5*E^2
+        p3 = w6 / (w7 + exp(w8*E))
+        weight(rho) = p1*exp(p2*rho) + p3
+    where E is the uncorrected energy and rho the bin density (bin center, lower
+    edge for the last bin). The ecal energy is not corrected. The minimized chi2 is :
+        sum_events (E_corrected - E_true)^2 / E_true
+    The chi2 and its gradient are computed vectorized, the events being split in
+    chunks evaluated by a pool of worker processes. The minimization (L-BFGS-B)
+    starts from user weights, i.e the weights of a previous calibration.
+    Requires numpy, uproot and scipy. Not yet compared with the binary on reference
+    training trees : PandoraSoftCompCalibrator only uses it with the "native" backend.
+"""
+class SoftCompMinimizer(object):
+    defaultWeights = [1.61741, -0.00444385, 2.29683e-05, -0.0731236, -0.00157099, -7.09546e-07, 0.868443, 1.0561, -0.0238574]
+    defaultDensityBins = [0., 2., 5., 7.5, 9.5, 13., 16., 20., 23.5, 28., 1e6]
+
+    def __init__(self):
+        self._densityBins = list(SoftCompMinimizer.defaultDensityBins)
+        self._initialWeights = list(SoftCompMinimizer.defaultWeights)
+        self._treeName = "SoftwareCompensationTrainingTree"
+        self._hitEnergyBranch = "HitEnergies"
+        self._hitTypeBranch = "HitType"
+        self._cellBranches = ["CellSize0", "CellSize1", "CellThickness"]
+        self._clusterEnergyBranch = None
+        self._hcalHitType = 2
+        self._nWorkers = 1
+        self._maxNIterations = 1000
+        self._weights = []
+        self._chi2 = None
+        self._data = None
+        self._logger = logging.getLogger("softCompMinimizer")
+
+    """ Set the weights the minimization starts from (i.e the weights of a previous calibration)
+    """
+    def setInitialWeights(self, weights):
+        if len(weights) != 9:
+            raise ValueError("SoftCompMinimizer.setInitialWeights: expected 9 weights, got {0}".format(len(weights)))
+        self._initialWeights = [float(w) for w in weights]
+
+    def setDensityBins(self, bins):
+        self._densityBins = [float(b) for b in bins]
+
+    def setTreeName(self, treeName):
+        self._treeName = str(treeName)
+
+    """ Use the given branch as uncorrected energy in the weight parametrization,
+        instead of the sum of the hit energies
+    """
+    def setClusterEnergyBranch(self, branch):
+        self._clusterEnergyBranch = branch
+
+    """ Set the number of worker processes evaluating the chi2
+    """
+    def setNWorkers(self, nWorkers):
+        self._nWorkers = max(1, int(nWorkers))
+
+    def setMaxNIterations(self, maxNIterations):
+        self._maxNIterations = int(maxNIterations)
+
+    def getWeights(self):
+        return list(self._weights)
+
+    def getChi2(self):
+        return self._chi2
+
+    """ Load the training trees. rootFiles is a dictionary of true energy -> root file
+    """
+    def load(self, rootFiles):
+        import numpy
+
+        binEnergies, ecalEnergies, energies, trueEnergies = [], [], [], []
+
+        for trueEnergy, rootFile in sorted(rootFiles.items()):
+            events = self._loadFile(numpy, rootFile)
+            binEnergies.append(events[0])
+            ecalEnergies.append(events[1])
+            energies.append(events[2])
+            trueEnergies.append(numpy.full(len(events[1]), float(trueEnergy)))
+            self._logger.info("Loaded {0} events from {1} (energy {2} GeV)".format(len(events[1]), rootFile, trueEnergy))
+
+        self._data = (numpy.ascontiguousarray(numpy.concatenate(binEnergies)), numpy.concatenate(ecalEnergies),
+            numpy.concatenate(energies), numpy.concatenate(trueEnergies), self._binDensities(numpy))
+
+    """ Minimize the chi2 starting from the initial weights. Returns the weights
+    """
+    def run(self):
+        try:
+            import numpy
+            from scipy.optimize import minimize
+        except ImportError:
+            raise RuntimeError("SoftCompMinimizer: numpy and scipy are required")
+
+        if self._data is None:
+            raise RuntimeError("SoftCompMinimizer.run: no training data loaded")
+
+        nEvents = len(self._data[1])
+        nChunks = min(self._nWorkers, nEvents)
+        bounds = numpy.linspace(0, nEvents, nChunks+1).astype(int)
+        chunks = [(bounds[i], bounds[i+1]) for i in range(nChunks)]
+        pool = None
+
+        # the workers are forked after the data are loaded, they share them
+        global _workerData
+        _workerData = self._data
+
+        if nChunks > 1:
+            pool = multiprocessing.Pool(nChunks)
+
+        def chi2AndGradient(weights):
+            tasks = [(weights, chunk) for chunk in chunks]
+            results = pool.map(_evaluateChunk, tasks) if pool else map(_evaluateChunk, tasks)
+            return sum([r[0] for r in results]), numpy.sum([r[1] for r in results], axis=0)
+
+        try:
+            self._logger.info("Minimizing the software compensation chi2 on {0} events ({1} workers), start weights {2}".format(nEvents, nChunks, self._initialWeights))
+            result = minimize(chi2AndGradient, numpy.array(self._initialWeights), jac=True, method="L-BFGS-B", options={"maxiter" : self._maxNIterations})
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            _workerData = None
+
+        if not result.success:
+            self._logger.warning("Software compensation minimization : {0}".format(result.message))
+
+        self._weights = [float(w) for w in result.x]
+        self._chi2 = float(result.fun)
+        self._logger.info("Software compensation chi2 {0} after {1} iterations".format(self._chi2, result.nit))
+
+        return self.getWeights()
+
+    """ Reduce the events of a training tree to (bin energies, ecal energy, uncorrected energy) arrays
+    """
+    def _loadFile(self, numpy, rootFile):
+        try:
+            import uproot
+        except ImportError:
+            raise RuntimeError("SoftCompMinimizer: uproot is required to read '{0}'".format(rootFile))
+
+        tree = uproot.open(rootFile)[self._treeName]
+        branches = [self._hitEnergyBranch, self._hitTypeBranch] + self._cellBranches
+        if self._clusterEnergyBranch:
+            branches.append(self._clusterEnergyBranch)
+
+        try:
+            arrays = tree.arrays(branches, library="np")
+        except TypeError:
+            # uproot 3 interface
+            arrays = tree.arrays(branches)
+
+        arrays = {(name.decode() if isinstance(name, bytes) else name) : array for name, array in arrays.items()}
+        hitEnergies, counts = _flatten(numpy, arrays[self._hitEnergyBranch])
+        hitTypes = _flatten(numpy, arrays[self._hitTypeBranch])[0]
+        cellVolumes = numpy.ones(len(hitEnergies))
+
+        for branch in self._cellBranches:
+            cellVolumes *= _flatten(numpy, arrays[branch])[0]
+
+        nEvents = len(counts)
+        eventIndices = numpy.repeat(numpy.arange(nEvents), counts)
+        # cell volume in dm3 from mm3
+        densities = hitEnergies / numpy.where(cellVolumes > 0., cellVolumes / 1e6, 1.)
+        isHcal = (hitTypes == self._hcalHitType)
+
+        nBins = len(self._densityBins) - 1
+        bins = numpy.clip(numpy.searchsorted(self._densityBins, densities, side="right") - 1, 0, nBins-1)
+        binEnergies = numpy.zeros((nEvents, nBins))
+        numpy.add.at(binEnergies, (eventIndices[isHcal], bins[isHcal]), hitEnergies[isHcal])
+        ecalEnergies = numpy.bincount(eventIndices[~isHcal], weights=hitEnergies[~isHcal], minlength=nEvents)
+
+        if self._clusterEnergyBranch:
+            energies = numpy.asarray(arrays[self._clusterEnergyBranch], dtype=float)
+        else:
+            energies = ecalEnergies + binEnergies.sum(axis=1)
+
+        selection = energies > 0.
+        return binEnergies[selection], ecalEnergies[selection], energies[selection]
+
+    def _binDensities(self, numpy):
+        bins = numpy.array(self._densityBins)
+        densities = 0.5*(bins[:-1] + bins[1:])
+        densities[-1] = bins[-2]
+        return densities
+
+
+""" Flatten a variable size column. Returns the (content, counts) arrays
+"""
+def _flatten(numpy, array):
+    # uproot 3 jagged array
+    if hasattr(array, "content") and hasattr(array, "counts"):
+        return numpy.asarray(array.content, dtype=float), numpy.asarray(array.counts)
+    counts = numpy.array([len(entry) for entry in array], dtype=int)
+    content = numpy.concatenate([numpy.asarray(entry, dtype=float) for entry in array]) if len(array) else numpy.zeros(0)
+    return content, counts
+
+
+_workerData = None
+
+""" Compute the chi2 and its gradient for the events of a chunk
+"""
+def _evaluateChunk(task):
+    import numpy
+
+    weights, (begin, end) = task
+    binEnergies, ecalEnergies, energies, trueEnergies, densities = _workerData
+    binEnergies = binEnergies[begin:end]
+    ecalEnergy, energy, trueEnergy = ecalEnergies[begin:end], energies[begin:end], trueEnergies[begin:end]
+    w = weights
+    energy2 = energy*energy
+
+    p1 = w[0] + w[1]*energy + w[2]*energy2
+    p2 = w[3] + w[4]*energy + w[5]*energy2
+    expTerm = numpy.exp(numpy.clip(w[8]*energy, -500., 500.))
+    denominator = w[7] + expTerm
+    p3 = w[6] / denominator
+
+    exponentials = numpy.exp(numpy.clip(numpy.outer(p2, densities), -500., 500.))
+    expSum = numpy.sum(exponentials * binEnergies, axis=1)
+    rhoExpSum = numpy.sum(exponentials * binEnergies * densities, axis=1)
+    hcalEnergy = binEnergies.sum(axis=1)
+
+    correctedEnergy = ecalEnergy + p1*expSum + p3*hcalEnergy
+    residuals = correctedEnergy - trueEnergy
+    chi2 = numpy.sum(residuals*residuals / trueEnergy)
+
+    # derivatives of the corrected energy w.r.t p1, p2, p3, then chain rule on the weights
+    factor = 2. * residuals / trueEnergy
+    dp1 = factor * expSum
+    dp2 = factor * p1 * rhoExpSum
+    dp3 = factor * hcalEnergy
+    gradient = numpy.array([
+        numpy.sum(dp1), numpy.sum(dp1*energy), numpy.sum(dp1*energy2),
+        numpy.sum(dp2), numpy.sum(dp2*energy), numpy.sum(dp2*energy2),
+        numpy.sum(dp3 / denominator),
+        numpy.sum(-dp3 * w[6] / (denominator*denominator)),
+        numpy.sum(-dp3 * w[6] * energy * expTerm / (denominator*denominator))])
+
+    return chi2, gradient
@@ -0,0 +1,198 @@
+import copy
+import Queue
+import logging
+import threading
+from calibration.XmlTools import etree
+from calibration.ProcessExecutor import getExecutor
+
+""" StepScheduler class.
+
+    Run calibration steps concurrently, following their dependencies.
+    A step depends on an earlier step if :
+     - it declares it explicitly (CalibrationStep.setDependencies), or else
+     - it loads its outputs and runs some of the processors the earlier step calibrates
+    The ready steps (all dependencies done) are run in threads, at most maxParallelSteps
+    at the same time. The external processes of all the steps share the process executor budget.
+    The steps running a multiprocessing pool (CalibrationStep.usesProcessPool) are run alone :
+    they start when the running steps ended and no other step starts before they end.
+    Each step works on a private copy of the calibration tree, made of the input tree
+    and the outputs of its (direct and indirect) dependencies. The step outputs are
+    merged in the calibration tree in the steps order, so the resulting tree doesn't
+    depend on the order in which the steps ended.
+"""
+class StepScheduler(object):
+    def __init__(self, steps, maxParallelSteps):
+        self._steps = list(steps)
+        self._maxParallelSteps = max(1, int(maxParallelSteps))
+        self._dependencies = self._computeDependencies()
+        self._doneQueue = Queue.Queue()
+        self._logger = logging.getLogger("stepScheduler")
+        # create the shared executor before the step threads
+        getExecutor()
+
+    """ The dependencies of the steps : step index -> set of step indices
+    """
+    def getDependencies(self):
+        return dict(self._dependencies)
+
+    """ Run the steps on the calibration tree. The outputs of the steps ended successfully are
+        merged in the tree. The exception of the first failed step, if any, is raised after
+        the running steps ended
+    """
+    def run(self, config):
+        self._logDependencies()
+        pending = range(len(self._steps))
+        running = set()
+        outputs = {}
+        exception = None
+        poolSteps = set([index for index, step in enumerate(self._steps) if step.usesProcessPool()])
+
+        for index in sorted(poolSteps):
+            self._logger.info("Step {0} runs a process pool, running it alone".format(self._steps[index].name()))
+
+        while pending or running:
+            if exception is None:
+                for index in list(pending):
+                    if len(running) >= self._maxParallelSteps:
+                        break
+                    if self._dependencies[index].issubset(outputs):
+                        # wait for the running steps to end, the next steps don't overtake the ready pool step
+                        if running and (index in poolSteps or poolSteps.intersection(running)):
+                            break
+                        pending.remove(index)
+                        running.add(index)
+                        self._startStep(index, self._createStepConfig(config, index, outputs))
+
+            if not running:
+                break
+
+            index, stepOutputs, stepException = self._nextDoneStep()
+            running.remove(index)
+
+            if stepException is not None:
+                self._logger.error("Step {0} failed : {1}".format(self._steps[index].name(), str(stepException)))
+                if exception is None:
+                    exception = stepException
+                    if running:
+                        self._logger.info("Waiting for the running steps to end ...")
+                continue
+
+            self._logger.info("Step {0} done".format(self._steps[index].name()))
+            outputs[index] = stepOutputs
+
+        for index in sorted(outputs):
+            self._mergeOutputs(config, outputs[index])
+
+        if exception is not None:
+            raise exception
+
+    def _computeDependencies(self):
+        dependencies = {}
+
+        for index, step in enumerate(self._steps):
+            declared = step.getDependencies()
+            dependencies[index] = set()
+
+            for previousIndex, previous in enumerate(self._steps[:index]):
+                if declared is not None:
+                    depends = previous.name() in declared
+                else:
+                    depends = previous.name() in step.getLoadStepOutputs() and self._runsOutputProcessors(step, previous)
+                if depends:
+                    dependencies[index].add(previousIndex)
+
+        return dependencies
+
+    """ Whether a step runs some of the processors calibrated by a previous step (unknown lists match everything)
+    """
+    def _runsOutputProcessors(self, step, previous):
+        inputs = step.inputProcessors()
+        outputs = previous.outputProcessors()
+
+        if inputs is None or outputs is None:
+            return True
+
+        return len(set(inputs) & set(outputs)) > 0
+
+    def _logDependencies(self):
+        for index, step in enumerate(self._steps):
+            names = [self._steps[dependency].name() for dependency in sorted(self._dependencies[index])]
+            self._logger.info("Step {0} depends on : {1}".format(step.name(), ", ".join(names) if names else "none"))
+
+    """ All the (direct and indirect) dependencies of a step
+    """
+    def _ancestors(self, index):
+        ancestors = set()
+        toVisit = list(self._dependencies[index])
+
+        while toVisit:
+            dependency = toVisit.pop()
+            if dependency not in ancestors:
+                ancestors.add(dependency)
+                toVisit.extend(self._dependencies[dependency])
+
+        return ancestors
+
+    def _createStepConfig(self, config, index, outputs):
+        stepConfig = copy.deepcopy(config)
+
+        for ancestor in sorted(self._ancestors(index)):
+            self._mergeOutputs(stepConfig, outputs[ancestor])
+
+        return stepConfig
+
+    def _startStep(self, index, config):
+        self._logger.info("Starting step {0}".format(self._steps[index].name()))
+        thread = threading.Thread(target=self._runStep, args=(index, config), name=self._steps[index].name())
+        thread.daemon = True
+        thread.start()
+
+    def _runStep(self, index, config):
+        step = self._steps[index]
+
+        try:
+            before = self._stepElementsContent(config)
+            step.init(config)
+            step.run(config)
+            step.writeOutput(config)
+            self._doneQueue.put((index, self._stepOutputs(config, before), None))
+        except Exception as e:
+            self._doneQueue.put((index, None, e))
+
+    def _nextDoneStep(self):
+        # wait with a timeout : a blocking get can't be interrupted (ctrl-c)
+        while True:
+            try:
+                return self._doneQueue.get(True, 1.)
+            except Queue.Empty:
+                continue
+
+    """ The serialized step elements of a calibration tree : step name -> list of strings
+    """
+    def _stepElementsContent(self, config):
+        content = {}
+
+        for element in config.xpath("//step"):
+            content.setdefault(element.get("name"), []).append(etree.tostring(element))
+
+        return content
+
+    """ The outputs of a step : the step elements created or modified by the step (names and copies)
+    """
+    def _stepOutputs(self, config, before):
+        after = self._stepElementsContent(config)
+        names = set([name for name in set(before) | set(after) if before.get(name) != after.get(name)])
+        elements = [copy.deepcopy(element) for element in config.xpath("//step") if element.get("name") in names]
+        return names, elements
+
+    """ Replace the step elements of a calibration tree by the ones of the step outputs
+    """
+    def _mergeOutputs(self, config, outputs):
+        names, elements = outputs
+
+        for element in config.xpath("//step"):
+            if element.get("name") in names:
+                element.getparent().remove(element)
+
+        for element in elements:
+            config.getroot().append(copy.deepcopy(element))
@@ -40,6 +40,23 @@ class SwitchStep(CalibrationStep):
 
     def writeOutput(self, config) :
         self._selectedStep.writeOutput(config)
+
+    def getDependencies(self):
+        if self._dependencies is None and self._selectedStep:
+            return self._selectedStep.getDependencies()
+        return self._dependencies
+
+    def getLoadStepOutputs(self):
+        return self._selectedStep.getLoadStepOutputs() if self._selectedStep else []
+
+    def inputProcessors(self):
+        return self._selectedStep.inputProcessors() if self._selectedStep else None
+
+    def outputProcessors(self):
+        return self._selectedStep.outputProcessors() if self._selectedStep else None
+
+    def usesProcessPool(self):
+        return self._selectedStep.usesProcessPool() if self._selectedStep else False
     
     def description(self):
         if self._selectedStep:
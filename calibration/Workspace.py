@@ -0,0 +1,155 @@
+import os
+import time
+import errno
+import shutil
+import atexit
+import fnmatch
+import logging
+import tempfile
+import threading
+
+""" Workspace class.
+
+    Directory layout of the files produced by a calibration run :
+     - a run directory <baseDirectory>/calibration_<date>_<pid>, with one
+       sub-directory per step and per step iteration, for the artifacts (root files, 
+       gear files, outputs and check plots of the analysis binaries, ...)
+     - a scratch directory for the small temporary files (steering files, pandora
+       settings), optionally on tmpfs (e.g /dev/shm)
+    On cleanup (at the latest at exit), the scratch directory is removed. The run directory
+    files are all kept, unless keep patterns are set : only the files matching them are kept.
+    The directories are created on first use.
+"""
+class Workspace(object):
+    def __init__(self, baseDirectory=".", scratchBaseDirectory=None, keepPatterns=["*"]):
+        self._baseDirectory = os.path.abspath(baseDirectory)
+        self._scratchBaseDirectory = scratchBaseDirectory
+        self._keepPatterns = list(keepPatterns)
+        self._runName = "calibration_{0}_{1}".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+        self._runDirectory = None
+        self._scratchDirectory = None
+        self._cleanedUp = False
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger("workspace")
+        atexit.register(self.cleanup)
+
+    """ Set the base directory of the run directory (default current directory)
+    """
+    def setBaseDirectory(self, baseDirectory):
+        if self._runDirectory is not None:
+            raise RuntimeError("Workspace.setBaseDirectory: run directory already created in {0}".format(self._runDirectory))
+        self._baseDirectory = os.path.abspath(baseDirectory)
+
+    """ Set the directory where the scratch directory is created (e.g a tmpfs mount point).
+        Default : the system temporary directory
+    """
+    def setScratchBaseDirectory(self, scratchBaseDirectory):
+        if self._scratchDirectory is not None:
+            raise RuntimeError("Workspace.setScratchBaseDirectory: scratch directory already created in {0}".format(self._scratchDirectory))
+        self._scratchBaseDirectory = scratchBaseDirectory
+
+    """ Set the file name patterns (fnmatch) of the run directory files kept on cleanup,
+        the other files are removed. Default ["*"] : keep all the files
+    """
+    def setKeepPatterns(self, patterns):
+        self._keepPatterns = list(patterns)
+
+    def runDirectory(self):
+        with self._lock:
+            if self._runDirectory is None:
+                self._runDirectory = self._makeDirectory(os.path.join(self._baseDirectory, self._runName))
+                self._logger.info("Workspace run directory : {0}".format(self._runDirectory))
+        return self._runDirectory
+
+    def scratchDirectory(self):
+        with self._lock:
+            if self._scratchDirectory is None:
+                if self._scratchBaseDirectory:
+                    self._makeDirectory(self._scratchBaseDirectory)
+                self._scratchDirectory = tempfile.mkdtemp(prefix=self._runName + "_", dir=self._scratchBaseDirectory)
+        return self._scratchDirectory
+
+    """ The directory of a step in the run directory
+    """
+    def stepDirectory(self, step):
+        return self._makeDirectory(os.path.join(self.runDirectory(), step))
+
+    """ The directory of a step iteration in the run directory.
+        The iteration is either an iteration number or a name (e.g "bracket0")
+    """
+    def iterationDirectory(self, step, iteration):
+        name = "iter{0}".format(iteration) if isinstance(iteration, int) else str(iteration)
+        return self._makeDirectory(os.path.join(self.stepDirectory(step), name))
+
+    """ Get the path of a file in the run directory, in the step or iteration directory if specified
+    """
+    def path(self, fileName, step=None, iteration=None):
+        if step is None:
+            return os.path.join(self.runDirectory(), fileName)
+        if iteration is None:
+            return os.path.join(self.stepDirectory(step), fileName)
+        return os.path.join(self.iterationDirectory(step, iteration), fileName)
+
+    """ Get the path of a file in the scratch directory
+    """
+    def scratchPath(self, fileName):
+        return os.path.join(self.scratchDirectory(), fileName)
+
+    """ Create a unique temporary file in the scratch directory and return its name.
+        Unlike tempfile.mkstemp, the file descriptor is closed
+    """
+    def mkstemp(self, suffix="", prefix="tmp"):
+        fd, fileName = tempfile.mkstemp(suffix=suffix, prefix=prefix, dir=self.scratchDirectory())
+        os.close(fd)
+        return fileName
+
+    """ Remove a temporary file before the workspace cleanup
+    """
+    def release(self, fileName):
+        try:
+            os.remove(fileName)
+        except OSError:
+            pass
+
+    """ Remove the scratch directory and the run directory files not matching the keep patterns.
+        Called at exit, calling it several times is harmless
+    """
+    def cleanup(self):
+        if self._cleanedUp:
+            return
+
+        self._cleanedUp = True
+
+        if self._scratchDirectory is not None:
+            shutil.rmtree(self._scratchDirectory, ignore_errors=True)
+
+        if self._runDirectory is None or not os.path.isdir(self._runDirectory) or "*" in self._keepPatterns:
+            return
+
+        for directory, subDirectories, fileNames in os.walk(self._runDirectory, topdown=False):
+            for fileName in fileNames:
+                if not any(fnmatch.fnmatch(fileName, pattern) for pattern in self._keepPatterns):
+                    os.remove(os.path.join(directory, fileName))
+            if not os.listdir(directory):
+                os.rmdir(directory)
+
+    def _makeDirectory(self, directory):
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                # created meanwhile by another step
+                if e.errno != errno.EEXIST:
+                    raise
+        return directory
+
+
+_workspace = None
+
+""" Get the workspace shared by the calibration steps and the process wrappers
+"""
+def getWorkspace():
+    global _workspace
+    if _workspace is None:
+        _workspace = Workspace()
+    return _workspace
@@ -1,37 +1,53 @@
+import logging
 
-try:
-    from lxml import etree
-    print("running with lxml.etree")
-except ImportError:
-    try:
-        # nafhh special case
-        import etree
-        print("running with etree.so lib on Python 2.5+")
-    except ImportError:    
+# ElementTree implementations, in order of preference (module, description)
+_etreeImplementations = [
+    ("lxml.etree", "lxml.etree"),
+    # nafhh special case
+    ("etree", "etree.so lib on Python 2.5+"),
+    # Python 2.5
+    ("xml.etree.ElementTree", "ElementTree on Python 2.5+"),
+    # Python 2.5
+    ("xml.etree.cElementTree", "cElementTree on Python 2.5+"),
+    # normal ElementTree install
+    ("elementtree.ElementTree", "ElementTree"),
+    # normal cElementTree install
+    ("cElementTree", "cElementTree")]
+
+""" Import the first available ElementTree implementation
+"""
+def _importEtree():
+    logger = logging.getLogger("xmlTools")
+
+    for moduleName, description in _etreeImplementations:
         try:
-            # Python 2.5
-            import xml.etree.ElementTree as etree
-            print("running with ElementTree on Python 2.5+")
+            module = __import__(moduleName, fromlist=["parse"])
         except ImportError:
-            try:
-                # Python 2.5
-                import xml.etree.cElementTree as etree
-                print("running with cElementTree on Python 2.5+")
-            except ImportError:
-                try:
-                    # normal ElementTree install
-                    import elementtree.ElementTree as etree
-                    print("running with ElementTree")
-                except ImportError:
-                    try:
-                        # normal cElementTree install
-                        import cElementTree as etree
-                        print("running with cElementTree")
-                    except ImportError:
-                        print("Failed to import ElementTree from any known place")
+            continue
+        logger.debug("running with {0}".format(description))
+        return module
+
+    raise ImportError("Failed to import ElementTree from any known place")
+
+""" _LazyEtree class.
+    Stand-in for the etree module : the implementation is imported on first use,
+    so that importing the calibration modules doesn't probe the xml libraries
+"""
+class _LazyEtree(object):
+    def __init__(self):
+        self._module = None
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if self._module is None:
+            self._module = _importEtree()
+        return getattr(self._module, name)
+
+etree = _LazyEtree()
 
 def createXMLParser():
     if etree.LXML_VERSION >= (3, 2, 1, 0):
         return etree.XMLParser(remove_blank_text=True)
     else :
-        return etree.XMLParser()
\ No newline at end of file
+        return etree.XMLParser()
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+""" Utility script that measures the start-up time of the calibration entry points :
+     - the in-process import time of the calibration modules
+     - the wall time of the calibration scripts with --showSteps and --help (import + argument parsing)
+    Each measurement runs in a fresh python process. The heavy modules (ROOT, DD4hep, numpy, ...)
+    loaded at start-up are reported. With --budget, the script exits with status 1
+    if a median time exceeds the budget (seconds)
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+scriptsDirectory = os.path.dirname(os.path.abspath(__file__))
+packageDirectory = os.path.dirname(scriptsDirectory)
+heavyModules = ["ROOT", "DD4hep", "DDRec", "numpy", "scipy", "uproot", "pyLCIO"]
+
+importProbe = """
+import sys, time, json
+start = time.time()
+import calibration.CalibrationManager
+from calibration.MipScaleStep import *
+from calibration.EcalEnergyStep import *
+from calibration.HcalEnergyStep import *
+from calibration.PandoraMipScaleStep import *
+from calibration.PandoraEMScaleStep import *
+from calibration.PandoraHadScaleStep import *
+from calibration.PandoraSoftCompStep import *
+from calibration.SwitchStep import *
+elapsed = time.time() - start
+print(json.dumps({"time" : elapsed, "modules" : [m for m in %r if m in sys.modules]}))
+""" % heavyModules
+
+parser = argparse.ArgumentParser("Measure the start-up time of the calibration entry points:",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+
+parser.add_argument("--scripts", action="store", nargs='+', default=["run-ild-calibration.py", "run-sid-calibration.py"],
+                        help="The calibration scripts to measure (default : run-ild-calibration.py run-sid-calibration.py)", required = False)
+
+parser.add_argument("--repeat", action="store", type=int, default=5,
+                        help="The number of runs per measurement (default 5)", required = False)
+
+parser.add_argument("--budget", action="store", type=float, default=0.,
+                        help="The maximum median time of a measurement in seconds (default : no budget)", required = False)
+
+parsed = parser.parse_args()
+
+environment = dict(os.environ)
+environment["PYTHONPATH"] = os.pathsep.join([packageDirectory] + [p for p in environment.get("PYTHONPATH", "").split(os.pathsep) if p])
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else 0.5*(values[middle-1] + values[middle])
+
+def runCommand(command):
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=environment, cwd=scriptsDirectory)
+    output = process.communicate()[0]
+    elapsed = time.time() - start
+
+    if process.returncode != 0:
+        print output
+        raise RuntimeError("Command '{0}' failed with status {1}".format(" ".join(command), process.returncode))
+
+    return elapsed, output
+
+measurements = []
+
+# in-process import time of the calibration modules
+importTimes = []
+loadedModules = set()
+
+for run in range(parsed.repeat):
+    elapsed, output = runCommand([sys.executable, "-c", importProbe])
+    result = json.loads(output.strip().splitlines()[-1])
+    importTimes.append(result["time"])
+    loadedModules.update(result["modules"])
+
+measurements.append(("import calibration modules", importTimes))
+
+# wall time of the entry points
+for script in parsed.scripts:
+    for option in ["--showSteps", "--help"]:
+        times = [runCommand([sys.executable, script, option])[0] for run in range(parsed.repeat)]
+        measurements.append(("{0} {1}".format(script, option), times))
+
+print "======= Start-up times ({0} runs) =======".format(parsed.repeat)
+overBudget = []
+
+for name, times in measurements:
+    medianTime = median(times)
+    print "{0:<45} median {1:.3f} s   min {2:.3f} s   max {3:.3f} s".format(name, medianTime, min(times), max(times))
+    if parsed.budget > 0 and medianTime > parsed.budget:
+        overBudget.append(name)
+
+print "Heavy modules loaded at import : {0}".format(", ".join(sorted(loadedModules)) if loadedModules else "none")
+
+if overBudget:
+    print "Start-up budget of {0} s exceeded by : {1}".format(parsed.budget, ", ".join(overBudget))
+    sys.exit(1)
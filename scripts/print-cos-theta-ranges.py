@@ -18,15 +18,23 @@ parser.add_argument("--compactFile", action="store", default="",
 parser.add_argument("--gearConverterPlugin", action="store", default="default",
                         help="The gear plugin to convert the conmpact file to gear file", required = False)
 
+parser.add_argument("--geometryCacheDir", action="store", default="",
+                        help="The directory of the geometry summaries and gear files cache (default : no cache, DD4hep is loaded)", required = False)
+
 parsed = parser.parse_args()
 
 gearConverter = GearConverter()
 gearConverter.setCompactFile(parsed.compactFile)
 gearConverter.setPluginName(parsed.gearConverterPlugin)
+if parsed.geometryCacheDir:
+    gearConverter.setCacheDirectory(parsed.geometryCacheDir)
 gearFile = gearConverter.convertToGear()
 geo = GeometryInterface(gearFile)
 
-ddgeo = DDGeometryInterface(parsed.compactFile)
+if parsed.geometryCacheDir:
+    ddgeo = CachedGeometryInterface(parsed.compactFile, parsed.geometryCacheDir)
+else:
+    ddgeo = DDGeometryInterface(parsed.compactFile)
 
 
 ebmin, ebmax = geo.getEcalBarrelCosThetaRange()
@@ -61,6 +61,7 @@ calibrationXmlTree = etree.parse(parsed.inputFile, xmlParser)
 # write output in temporary file and move it when finished
 marlinXmlRaw = open(parsed.steeringFile, 'r')
 fd, tmpname = mkstemp()
+os.close(fd)
 marlinXmlOutput = open(tmpname, 'w')
 
 # mapping line number and xml element
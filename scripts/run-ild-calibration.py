@@ -28,6 +28,10 @@ if __name__ == "__main__":
     turnoffProcessors = ["MyLCIOOutputProcessor", "DSTOutput"]
     runEcalRingCalibration = True
     runHcalRingCalibration = True
+    # no two steps can overlap : each step runs the processors calibrated by the previous one
+    # (ecal and hcal digitizers for the mip scale, ecal reconstruction for the hcal contained events veto,
+    # calorimeter reconstruction for the pandora mip scale, pandora for the em, had and soft comp. scales).
+    # The dependencies are derived from the loaded outputs and processors : keep --maxParallelSteps 1
     stepNames = []
 
     # Create the calibration manager and configure it
@@ -146,7 +150,7 @@ if __name__ == "__main__":
 
     pandoraSoftCompStep = PandoraSoftCompStep()
     pandoraSoftCompStep.setLoadStepOutputs(list(stepNames))
-    stepNames.append(pandoraHadScaleStep.name())
+    stepNames.append(pandoraSoftCompStep.name())
     pandoraSoftCompStep.setPfoAnalysisProcessor(pfoAnalysisProcessor)
     pandoraSoftCompStep.setMarlinPandoraProcessor(pandoraProcessor)
     pandoraSoftCompStep.setTurnoffProcessors(turnoffProcessors)
@@ -0,0 +1,80 @@
+import os
+import unittest
+from calibration.PfoAnalysisTree import PfoAnalysisTree
+from calibration.PandoraAnalysis import EcalCalibrator, HcalCalibrator, PandoraHadScaleCalibrator
+
+""" Compare the native and binary backends of the contained events calibrators on reference PfoAnalysis files :
+     - CALIBRATION_REFERENCE_PHOTON_FILE : PfoAnalysis root file of a photon sample (ecal calibrator)
+     - CALIBRATION_REFERENCE_KAON0L_FILE : PfoAnalysis root file of a kaon0L sample (hcal calibrator)
+    The energies of the samples are given by CALIBRATION_REFERENCE_PHOTON_ENERGY (default 10) and
+    CALIBRATION_REFERENCE_KAON0L_ENERGY (default 20). The relative difference of the means must be below
+    CALIBRATION_BACKEND_TOLERANCE (default 0.005, half the default calibration accuracy).
+    Requires PANDORA_ANALYSIS_DIR, numpy and uproot
+"""
+class AnalysisBackendsTest(unittest.TestCase):
+    regions = [("Barrel", 0.2, 0.6), ("EndCap", 0.8, 0.9)]
+
+    def setUp(self):
+        if not os.environ.get("PANDORA_ANALYSIS_DIR"):
+            self.skipTest("PANDORA_ANALYSIS_DIR not set")
+        if not PfoAnalysisTree.isAvailable():
+            self.skipTest("native backend not available (numpy and uproot)")
+        self.tolerance = float(os.environ.get("CALIBRATION_BACKEND_TOLERANCE", 0.005))
+
+    def referenceFile(self, variable):
+        fileName = os.environ.get(variable)
+        if not fileName or not os.path.isfile(fileName):
+            self.skipTest("{0} not set".format(variable))
+        return fileName
+
+    def compareBackends(self, createCalibrator, getMean):
+        for region, minCosTheta, maxCosTheta in self.regions:
+            means = {}
+            for backend in ["binary", "native"]:
+                calibrator = createCalibrator()
+                calibrator.setBackend(backend)
+                calibrator.setResultCache(None)
+                calibrator.setDetectorRegion(region)
+                calibrator.setCosThetaRange(minCosTheta, maxCosTheta)
+                calibrator.run()
+                means[backend] = getMean(calibrator)
+            self.assertTrue(abs(1. - means["native"] / means["binary"]) < self.tolerance,
+                "{0}: native mean {1}, binary mean {2}".format(region, means["native"], means["binary"]))
+
+    def testEcalCalibrator(self):
+        rootFile = self.referenceFile("CALIBRATION_REFERENCE_PHOTON_FILE")
+        def createCalibrator():
+            calibrator = EcalCalibrator()
+            calibrator.setRootFile(rootFile)
+            calibrator.setPhotonEnergy(float(os.environ.get("CALIBRATION_REFERENCE_PHOTON_ENERGY", 10)))
+            return calibrator
+        self.compareBackends(createCalibrator, lambda calibrator: calibrator.getEcalDigiMean())
+
+    def testHcalCalibrator(self):
+        rootFile = self.referenceFile("CALIBRATION_REFERENCE_KAON0L_FILE")
+        def createCalibrator():
+            calibrator = HcalCalibrator()
+            calibrator.setRootFile(rootFile)
+            calibrator.setKaon0LEnergy(float(os.environ.get("CALIBRATION_REFERENCE_KAON0L_ENERGY", 20)))
+            return calibrator
+        self.compareBackends(createCalibrator, lambda calibrator: calibrator.getHcalDigiMean())
+
+class AutoBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.isAvailable = PfoAnalysisTree.isAvailable
+        PfoAnalysisTree.isAvailable = staticmethod(lambda: True)
+
+    def tearDown(self):
+        PfoAnalysisTree.isAvailable = self.isAvailable
+
+    def testUncheckedNativeBackends(self):
+        # native backends not compared with the binaries on reference files : auto runs the binary
+        for calibratorClass in [EcalCalibrator, HcalCalibrator, PandoraHadScaleCalibrator]:
+            calibrator = calibratorClass()
+            calibrator.setBackend("auto")
+            self.assertFalse(calibrator.usesNativeBackend(), calibratorClass.__name__)
+            calibrator.setBackend("native")
+            self.assertTrue(calibrator.usesNativeBackend(), calibratorClass.__name__)
+
+if __name__ == "__main__":
+    unittest.main()
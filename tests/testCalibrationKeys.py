@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+from calibration.FileTools import *
+from calibration.AnalysisCache import AnalysisCache
+
+dataDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "calibration")
+
+""" The values read by the key getters and the line/token positions read by the positional parser : 
+    calibration file -> [(getter, line, token)].
+    The calibration files in data/calibration were written by hand, not captured from the binaries
+"""
+positions = {
+    "SimCaloHitEnergyDistribution" : [(getHcalBarrelMip, 7, 5), (getHcalEndcapMip, 8, 5), (getHcalRingMip, 9, 5), (getEcalMip, 10, 4)],
+    "ECalDigitisation_ContainedEvents" : [(getTruePhotonEnergy, 6, 4), (getEcalDigiMean, 11, 4)],
+    "HCalDigitisation_ContainedEvents" : [(getHcalDigiMean, 9, 5)],
+    "ECalDigitisation_DirectionCorrectionDistribution" : [(getMeanDirCorrEcalEndcap, 4, 5), (getMeanDirCorrEcalRing, 9, 5)],
+    "HCalDigitisation_DirectionCorrectionDistribution" : [(getMeanDirCorrHcalEndcap, 4, 5), (getMeanDirCorrHcalRing, 9, 5)],
+    "PandoraPFACalibrate_MipResponse" : [(getEcalToGeVMip, 8, 2), (getHcalToGeVMip, 16, 2), (getMuonToGeVMip, 24, 2)],
+    "PandoraPFACalibrate_EMScale" : [(getEcalToEMMean, 9, 3)],
+    "PandoraPFACalibrate_HadronicScale_ChiSquareMethod" : [(getEcalToHadMean, 5, 2), (getHcalToHadMean, 6, 2)]}
+
+class CalibrationKeysTest(unittest.TestCase):
+    def calibrationFile(self, name):
+        return os.path.join(dataDirectory, name + "_Calibration.txt")
+
+    def testKeys(self):
+        for name, getters in positions.iteritems():
+            calibFile = self.calibrationFile(name)
+            for getter, line, token in getters:
+                self.assertEqual(getter(calibFile), float(getFileContent(calibFile, line, token)), "{0} {1}".format(name, getter.__name__))
+
+    def testSoftwareCompensationWeights(self):
+        calibFile = self.calibrationFile("PandoraPFACalibrate_SoftwareCompensation")
+        weights = [float(getFileContent(calibFile, 8+w, 3)) for w in range(9)]
+        self.assertEqual(getSoftwareCompensationWeights(calibFile), weights)
+
+    def testUniqueKeys(self):
+        # each key matches a single line in the calibration files of all the binaries
+        for name in positions.keys() + ["PandoraPFACalibrate_SoftwareCompensation"]:
+            entries = parseCalibrationFile(self.calibrationFile(name))
+            for key, pattern in calibrationKeys.iteritems():
+                if key != "softCompWeight":
+                    self.assertTrue(len(getCalibrationValues(entries, pattern)) <= 1, "{0} {1}".format(name, key))
+
+    def writeUnkeyedFile(self, name):
+        # same layout with unknown keys : the values are only found at their positions
+        unkeyedFile = os.path.join(self.directory, name + "_Calibration.txt")
+        with open(self.calibrationFile(name)) as f, open(unkeyedFile, "w") as out:
+            for line in f:
+                out.write(line.replace("Mip Peak", "MIP Maximum").replace("Parameter p", "Weight "))
+        return unkeyedFile
+
+    def testPositionalFallback(self):
+        self.directory = tempfile.mkdtemp()
+        try:
+            calibFile = self.writeUnkeyedFile("SimCaloHitEnergyDistribution")
+            self.assertEqual(getCalibrationValues(parseCalibrationFile(calibFile), calibrationKeys["ecalMip"]), [])
+            self.assertEqual(getEcalMip(calibFile), float(getFileContent(calibFile, 10, 4)))
+            self.assertEqual(getHcalRingMip(calibFile), float(getFileContent(calibFile, 9, 5)))
+
+            calibFile = self.writeUnkeyedFile("PandoraPFACalibrate_SoftwareCompensation")
+            self.assertEqual(getCalibrationValues(parseCalibrationFile(calibFile), calibrationKeys["softCompWeight"]), [])
+            self.assertEqual(getSoftwareCompensationWeights(calibFile), [float(getFileContent(calibFile, 8+w, 3)) for w in range(9)])
+        finally:
+            shutil.rmtree(self.directory)
+
+    def testMissingValue(self):
+        # neither key nor numeric value at the position
+        self.assertRaises(RuntimeError, getEcalToGeVMip, self.calibrationFile("PandoraPFACalibrate_EMScale"))
+
+class AnalysisCacheKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = AnalysisCache(os.path.join(self.directory, "cache"))
+        self.executable = os.path.join(self.directory, "SimCaloHitEnergyDistribution")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeExecutable(self, content):
+        with open(self.executable, "w") as f:
+            f.write(content)
+        # distinct modification time for the fingerprint memoization
+        os.utime(self.executable, (len(content), len(content)))
+
+    def testExecutableFingerprint(self):
+        self.writeExecutable("version 1")
+        key = self.cache.createKey("SimCaloHitEnergyDistribution", "binary", [], {"-b" : "10"}, self.executable)
+        self.assertEqual(key, self.cache.createKey("SimCaloHitEnergyDistribution", "binary", [], {"-b" : "10"}, self.executable))
+        self.writeExecutable("version 2 rebuilt")
+        self.assertNotEqual(key, self.cache.createKey("SimCaloHitEnergyDistribution", "binary", [], {"-b" : "10"}, self.executable))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from calibration.Convergence import createConvergenceStrategy
+
+class ConvergenceTest(unittest.TestCase):
+    """ Run a strategy on a linear response (response = slope*scale + offset) until convergence.
+        Returns the strategy and the list of scales run
+    """
+    def converge(self, name, slope, offset, target, accuracy, maxNIterations=20):
+        convergence = createConvergenceStrategy(name, [target])
+        scales = []
+        for iteration in range(maxNIterations):
+            scale = convergence.nextScales()[0]
+            scales.append(scale)
+            convergence.addMeasurement([scale], [slope*scale + offset])
+            if convergence.checkConvergence(accuracy):
+                break
+        return convergence, scales
+
+    def testFreezeOnMeasuredPrecision(self):
+        for name in ["fixedPoint", "secant", "linearFit", "newton"]:
+            convergence, scales = self.converge(name, 0.8, 1., 10., 0.001)
+            self.assertTrue(convergence.isFrozen(0), name)
+            # the converged scale was run and measured within the accuracy
+            scale = convergence.convergedScales()[0]
+            self.assertEqual(scale, scales[-1], name)
+            self.assertTrue(abs(1. - (0.8*scale + 1.) / 10.) < 0.001, name)
+
+    def testNoFreezeOnPrediction(self):
+        convergence = createConvergenceStrategy("secant", [10.])
+        convergence.addMeasurement([1.], [9.])
+        convergence.addMeasurement([1.1], [9.9])
+        # the secant predicts the target exactly at the next scale, but the last measurement is 1% off
+        self.assertFalse(convergence.checkConvergence(0.005))
+        self.assertFalse(convergence.isFrozen(0))
+        convergence.addMeasurement(convergence.nextScales(), [10.])
+        self.assertTrue(convergence.checkConvergence(0.005))
+
+    def testLinearResponseWithinTwoPasses(self):
+        # the response models are exact on a linear response : after two passes, 
+        # the next pass is predicted to converge and confirms it
+        for name in ["secant", "linearFit", "newton"]:
+            convergence = createConvergenceStrategy(name, [10.])
+            for passIndex in range(2):
+                scale = convergence.nextScales()[0]
+                convergence.addMeasurement([scale], [0.8*scale + 1.])
+            self.assertFalse(convergence.checkConvergence(0.001), name)
+            self.assertTrue(convergence.isNextPassPredictedConverged(0.001), name)
+            self.assertFalse(convergence.isFrozen(0), name)
+            scale = convergence.nextScales()[0]
+            convergence.addMeasurement([scale], [0.8*scale + 1.])
+            self.assertTrue(convergence.checkConvergence(0.001), name)
+            self.assertFalse(convergence.isNextPassPredictedConverged(0.001), name)
+
+    def testNoPredictionWithoutModel(self):
+        convergence = createConvergenceStrategy("fixedPoint", [10.])
+        convergence.addMeasurement([1.], [9.])
+        convergence.addMeasurement([1.1], [9.9])
+        self.assertFalse(convergence.isNextPassPredictedConverged(0.005))
+        # a single pass doesn't determine the linear models
+        for name in ["secant", "linearFit", "newton"]:
+            convergence = createConvergenceStrategy(name, [10.])
+            convergence.addMeasurement([1.], [9.])
+            self.assertFalse(convergence.isNextPassPredictedConverged(0.005), name)
+
+    def testReducedStatistics(self):
+        convergence = createConvergenceStrategy("fixedPoint", [10.])
+        convergence.addMeasurement([1.], [10.])
+        self.assertFalse(convergence.checkConvergence(0.01, fullStatistics=False))
+        self.assertTrue(convergence.checkConvergence(0.01, fullStatistics=True))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+from calibration.Marlin import Marlin
+from calibration.CalibrationStep import CalibrationStep
+
+steering = """<marlin>
+  <execute>
+    <processor name="MyPfoAnalysis"/>
+  </execute>
+  <global>
+    <parameter name="LCIOInputFiles">input.slcio</parameter>
+    <parameter name="MaxRecordNumber" value="0"/>
+  </global>
+  <processor name="MyPfoAnalysis" type="PfoAnalysis">
+    <parameter name="RootFile" type="string">pfoAnalysis.root</parameter>
+  </processor>
+</marlin>
+"""
+
+""" Region skimmer writing no file : the head file of a region is named after its size
+"""
+class HeadFileSkimmer(object):
+    def headFile(self, region, nEvents):
+        return "{0}_first{1}.slcio".format(region, nEvents)
+
+class EventScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        steeringFile = os.path.join(self.directory, "steering.xml")
+        with open(steeringFile, "w") as f:
+            f.write(steering)
+        self.step = CalibrationStep("Test")
+        self.step._marlin = Marlin(steeringFile)
+        self.step.setEventSchedule([1000, 5000])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def inputFiles(self):
+        return self.step._marlin.getGlobalParameter("LCIOInputFiles").split()
+
+    def testScheduleWithoutRegions(self):
+        # events not counted : a single run header is assumed
+        self.step._marlin._countEvents = lambda inputFiles: None
+        self.assertFalse(self.step._setScheduledStatistics(0, 0))
+        self.assertEqual(self.step._marlin.getGlobalParameter("MaxRecordNumber"), "1001")
+        self.assertTrue(self.step._setScheduledStatistics(2, 0))
+
+    def testScheduleCountsRunHeaders(self):
+        marlin = self.step._marlin
+        marlin.setInputFiles(["input1.slcio", "input2.slcio"])
+        marlin._countEvents = lambda inputFiles: [600, 600]
+        marlin._getRunHeaders = lambda inputFiles, nEvents: [0, 600]
+
+        # 1000 events cross the run header of the second file
+        self.assertFalse(self.step._setScheduledStatistics(0, 0))
+        self.assertEqual(marlin.getGlobalParameter("MaxRecordNumber"), "1002")
+
+        # more events than available after the skipped ones : full statistics
+        marlin.setSkipNEvents(500)
+        self.assertTrue(self.step._setScheduledStatistics(0, 0))
+        self.assertEqual(marlin.getGlobalParameter("MaxRecordNumber"), "0")
+        self.assertTrue(self.step._setScheduledStatistics(1, 0))
+
+    def testScheduleSharedByRegions(self):
+        self.step._regionSkimmer = HeadFileSkimmer()
+        self.step._regionCounts = {"Barrel" : 20000, "EndCap" : 8000, "Other" : 300}
+        regionFiles = {"Barrel" : "Barrel.slcio", "EndCap" : "EndCap.slcio", "Other" : "Other.slcio"}
+        self.step._setRegionInputFiles(regionFiles, ["Barrel", "EndCap", "Other"])
+
+        # each region gets its share of the scheduled events, not the concatenated input
+        self.assertFalse(self.step._setScheduledStatistics(0, 0))
+        self.assertEqual(self.inputFiles(), ["Barrel_first334.slcio", "EndCap_first334.slcio", "Other.slcio"])
+        self.assertEqual(self.step._marlin.getGlobalParameter("MaxRecordNumber"), "0")
+
+        self.assertTrue(self.step._setScheduledStatistics(2, 0))
+        self.assertEqual(self.inputFiles(), ["Barrel.slcio", "EndCap.slcio", "Other.slcio"])
+
+        # converged barrel : the endcap only
+        self.step._setRegionInputFiles(regionFiles, ["EndCap"])
+        self.assertFalse(self.step._setScheduledStatistics(1, 0))
+        self.assertEqual(self.inputFiles(), ["EndCap_first5000.slcio"])
+
+if __name__ == "__main__":
+    unittest.main()
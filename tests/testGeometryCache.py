@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+from calibration.GeometryCache import GeometryCache
+from calibration.GearConverter import GearConverter
+
+class GeometryCacheKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = GeometryCache(os.path.join(self.directory, "cache"))
+        self.compactFile = os.path.join(self.directory, "compact.xml")
+        with open(self.compactFile, "w") as f:
+            f.write("<lccdd><include ref='calorimeters.xml'/></lccdd>")
+        with open(os.path.join(self.directory, "calorimeters.xml"), "w") as f:
+            f.write("<lccdd/>")
+        self.environment = dict(os.environ)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environment)
+        shutil.rmtree(self.directory)
+
+    def testIncludes(self):
+        key = self.cache.createKey(self.compactFile)
+        with open(os.path.join(self.directory, "calorimeters.xml"), "w") as f:
+            f.write("<lccdd><detectors/></lccdd>")
+        self.assertNotEqual(key, self.cache.createKey(self.compactFile))
+
+    def testToolchain(self):
+        os.environ["lcgeo_DIR"] = "/opt/lcgeo/v00-16"
+        key = self.cache.createKey(self.compactFile)
+        self.assertEqual(key, self.cache.createKey(self.compactFile))
+        os.environ["lcgeo_DIR"] = "/opt/lcgeo/v00-17"
+        self.assertNotEqual(key, self.cache.createKey(self.compactFile))
+        os.environ["LD_LIBRARY_PATH"] = "/opt/DD4hep/v01-20/lib"
+        self.assertNotEqual(key, self.cache.createKey(self.compactFile))
+
+class GearConverterKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.compactFile = os.path.join(self.directory, "compact.xml")
+        with open(self.compactFile, "w") as f:
+            f.write("<lccdd/>")
+        self.converter = GearConverter()
+        self.converter.setCompactFile(self.compactFile)
+        self.environment = dict(os.environ)
+        os.environ["PATH"] = os.pathsep.join([self.directory, os.environ.get("PATH", "")])
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environment)
+        shutil.rmtree(self.directory)
+
+    def writeConverter(self, content):
+        executable = os.path.join(self.directory, "convertToGear")
+        with open(executable, "w") as f:
+            f.write(content)
+        os.chmod(executable, 0755)
+
+    def testToolchain(self):
+        self.writeConverter("#!/bin/sh\n# v01-20\n")
+        key = self.converter._createKey()
+        self.assertEqual(key, self.converter._createKey())
+        self.writeConverter("#!/bin/sh\n# v01-21\n")
+        self.assertNotEqual(key, self.converter._createKey())
+        key = self.converter._createKey()
+        os.environ["DD4hepINSTALL"] = "/opt/DD4hep/v01-21"
+        self.assertNotEqual(key, self.converter._createKey())
+
+if __name__ == "__main__":
+    unittest.main()
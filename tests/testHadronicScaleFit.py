@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from calibration.PfoAnalysisTree import PfoAnalysisTree, HadronicScaleFit
+
+class HadronicScaleFitTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        PfoAnalysisTree.clearCache()
+
+    def tearDown(self):
+        PfoAnalysisTree.clearCache()
+        shutil.rmtree(self.directory)
+
+    """ Write a fake root file and the column cache of its branches, read instead of the root file
+    """
+    def writeColumns(self, columns):
+        rootFile = os.path.join(self.directory, "PfoAnalysis.root")
+        with open(rootFile, "w") as f:
+            f.write("not a root file")
+        path = os.path.realpath(rootFile)
+        PfoAnalysisTree(rootFile)._storeCachedColumns(path, os.stat(path), columns)
+        return rootFile
+
+    def testSelectionAndPrediction(self):
+        random = numpy.random.RandomState(1)
+        nEvents = 2000
+        ecal = random.uniform(0., 5., nEvents)
+        hcal = (10. - 1.2*ecal) / 0.9 + random.normal(0., 0.1, nEvents)
+        nPfosTotal = numpy.ones(nEvents)
+        lostEnergy = numpy.zeros(nEvents)
+        # rejected events : several pfos or energy lost in neutrinos
+        nPfosTotal[:200] = 2
+        lostEnergy[200:400] = 3.
+        hcal[:400] = 100.
+
+        rootFile = self.writeColumns({"pfoECalToHadEnergy" : ecal, "pfoHCalToHadEnergy" : hcal,
+            "nPfosTotal" : nPfosTotal, "nPfosNeutralHadrons" : numpy.ones(nEvents),
+            "mcEnergyENu" : lostEnergy, "mcEnergyFwd" : numpy.zeros(nEvents)})
+
+        fit = HadronicScaleFit()
+        ecalResponse, hcalResponse = fit.run(rootFile, 10.)
+        self.assertEqual(fit.getNEvents(), nEvents - 400)
+        alpha, beta = fit.getCorrections()
+        self.assertAlmostEqual(alpha, 1.2, delta=0.02)
+        self.assertAlmostEqual(beta, 0.9, delta=0.02)
+
+        # scaled constants : the response of the scaled calorimeter scales accordingly
+        predictedEcal, predictedHcal = fit.predict(1.1, 1.)
+        self.assertAlmostEqual(predictedEcal, 1.1*ecalResponse, places=6)
+        self.assertAlmostEqual(predictedHcal, hcalResponse, places=6)
+
+    def testPredictBeforeRun(self):
+        self.assertRaises(RuntimeError, HadronicScaleFit().predict, 1., 1.)
+
+if __name__ == "__main__":
+    unittest.main()
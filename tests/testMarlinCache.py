@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+from calibration.Marlin import Marlin
+from calibration.MarlinXML import MarlinXML
+from calibration.MarlinCache import MarlinCache
+
+steering = """<marlin>
+  <execute>
+    <processor name="MyAIDAProcessor"/>
+    <processor name="MyPfoAnalysis"/>
+    <processor name="MyLCIOOutputProcessor"/>
+  </execute>
+  <global>
+    <parameter name="LCIOInputFiles"> </parameter>
+  </global>
+  <processor name="MyAIDAProcessor" type="AIDAProcessor">
+    <parameter name="FileName" type="string">histograms</parameter>
+  </processor>
+  <processor name="MyPfoAnalysis" type="PfoAnalysis">
+    <parameter name="RootFile" type="string">pfoAnalysis.root</parameter>
+  </processor>
+  <processor name="MyLCIOOutputProcessor" type="LCIOOutputProcessor">
+    <parameter name="LCIOOutputFile" type="string">output.slcio</parameter>
+  </processor>
+</marlin>
+"""
+
+checkpointSteering = """<marlin>
+  <execute>
+    <processor name="MyEcalDigi"/>
+    <processor name="MyPandora"/>
+    <processor name="MyPfoAnalysis"/>
+  </execute>
+  <global>
+    <parameter name="LCIOInputFiles"> </parameter>
+  </global>
+  <processor name="MyEcalDigi" type="ILDCaloDigi">
+    <parameter name="ECALCollections" type="StringVec">EcalBarrelCollection</parameter>
+    <parameter name="ECALOutputCollection0" type="stringVec">ECALBarrel</parameter>
+  </processor>
+  <processor name="MyPandora" type="DDPandoraPFANewProcessor">
+    <parameter name="ECalCaloHitCollections" type="StringVec">ECALBarrel</parameter>
+    <parameter name="PFOCollectionName" type="string">PandoraPFOs</parameter>
+  </processor>
+  <processor name="MyPfoAnalysis" type="PfoAnalysis">
+    <parameter name="PfoCollection" type="string">PandoraPFOs</parameter>
+    <parameter name="RootFile" type="string">pfoAnalysis.root</parameter>
+  </processor>
+</marlin>
+"""
+
+class MarlinCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.steeringFile = os.path.join(self.directory, "steering.xml")
+        with open(self.steeringFile, "w") as f:
+            f.write(steering)
+        self.marlinXML = MarlinXML(self.steeringFile)
+        self.marlinXML.loadSteeringFile()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testOutputFiles(self):
+        self.assertEqual(self.marlinXML.getOutputFiles(), {
+            "MyAIDAProcessor.FileName" : "histograms.root",
+            "MyPfoAnalysis.RootFile" : "pfoAnalysis.root",
+            "MyLCIOOutputProcessor.LCIOOutputFile" : "output.slcio"})
+
+    def testKeyIgnoresOutputFileNames(self):
+        cache = MarlinCache(os.path.join(self.directory, "cache"))
+        key = cache.createKey(self.marlinXML)
+        renamed = self.marlinXML.clone()
+        renamed.setProcessorParameter("MyLCIOOutputProcessor", "LCIOOutputFile", "other.slcio")
+        renamed.setProcessorParameter("MyAIDAProcessor", "FileName", "other")
+        self.assertEqual(cache.createKey(renamed), key)
+
+    def testStoreRestoreAllOutputs(self):
+        cache = MarlinCache(os.path.join(self.directory, "cache"))
+        outputFiles = dict((output, os.path.join(self.directory, fileName)) for output, fileName in self.marlinXML.getOutputFiles().iteritems())
+        for output, outputFile in outputFiles.iteritems():
+            with open(outputFile, "w") as f:
+                f.write(output)
+        cache.store("key", outputFiles)
+        for outputFile in outputFiles.values():
+            os.remove(outputFile)
+        self.assertTrue(cache.restore("key", outputFiles))
+        for output, outputFile in outputFiles.iteritems():
+            with open(outputFile) as f:
+                self.assertEqual(f.read(), output)
+
+class MarlinCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.steeringFile = os.path.join(self.directory, "steering.xml")
+        with open(self.steeringFile, "w") as f:
+            f.write(checkpointSteering)
+        self.cache = MarlinCache(os.path.join(self.directory, "checkpoints"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def createMarlin(self):
+        marlin = Marlin(self.steeringFile)
+        marlin.setCheckpointCache(self.cache)
+        marlin.setCheckpointProcessors(["MyPandora"])
+        return marlin
+
+    def prepareCheckpoint(self, marlin):
+        return marlin._prepareCheckpoint(marlin._marlinXML.getRootFileOutputs())
+
+    def testConcurrentReservation(self):
+        marlins = [self.createMarlin() for index in range(8)]
+        start = threading.Event()
+        keys = []
+        def prepare(marlin):
+            start.wait()
+            keys.append(self.prepareCheckpoint(marlin)[1])
+        threads = [threading.Thread(target=prepare, args=(marlin,)) for marlin in marlins]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        # a single instance writes the checkpoint
+        producers = [key for key in keys if key is not None]
+        self.assertEqual(len(producers), 1)
+
+        # once committed, the checkpoint is read by the next instances
+        checkpointKey = producers[0]
+        open(os.path.join(self.cache.entryDir(checkpointKey), "checkpoint.slcio"), "w").close()
+        marlins[0]._commitCheckpoint(checkpointKey)
+        marlins[0]._releaseCheckpoint(checkpointKey)
+        self.assertFalse(checkpointKey in Marlin._producingCheckpoints)
+        runXML, key = self.prepareCheckpoint(self.createMarlin())
+        self.assertTrue(key is None)
+        self.assertEqual(runXML.getGlobalParameter("LCIOInputFiles"), os.path.join(self.cache.entryDir(checkpointKey), "checkpoint.slcio"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+from calibration.Marlin import Marlin
+
+""" Simulate the records read by Marlin for a shard : skip n events then read max record number records.
+    Returns the global indices of the events processed
+"""
+def readShard(inputFiles, nEvents, runHeaders, shard):
+    shardFiles, skipNEvents, maxRecordNumber = shard
+    offset = sum(nEvents[:inputFiles.index(shardFiles[0])])
+    totalEvents = offset + sum(nEvents[inputFiles.index(shardFiles[0]):inputFiles.index(shardFiles[-1])+1])
+    # records stream of the shard files : ("run", None) or ("event", index)
+    records = []
+    for event in range(offset, totalEvents):
+        records.extend([("run", None)] * runHeaders.count(event))
+        records.append(("event", event))
+    records.extend([("run", None)] * runHeaders.count(totalEvents))
+    # skip n events (the run headers are skipped with them)
+    position = 0
+    skipped = 0
+    while skipped < skipNEvents:
+        if records[position][0] == "event":
+            skipped += 1
+        position += 1
+    records = records[position:]
+    if maxRecordNumber > 0:
+        records = records[:maxRecordNumber]
+    return [index for kind, index in records if kind == "event"]
+
+class MarlinShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.marlin = Marlin()
+        self.marlin.setNShards(3)
+
+    def checkShards(self, nEvents, runHeaders, skipNEvents, maxRecordNumber, expectedEvents):
+        inputFiles = ["file{0}.slcio".format(index) for index in range(len(nEvents))]
+        shards = self.marlin._createEventWindows(inputFiles, nEvents, runHeaders, skipNEvents, maxRecordNumber)
+        processed = []
+        for shard in shards:
+            processed.extend(readShard(inputFiles, nEvents, runHeaders, shard))
+        self.assertEqual(processed, expectedEvents)
+
+    def testSingleRunFiles(self):
+        # one run header at the start of each file
+        self.checkShards([10, 10], [0, 10], 0, 0, range(20))
+
+    def testMultiRunFile(self):
+        # a single file holding 4 runs
+        self.checkShards([30], [0, 7, 15, 22], 0, 0, range(30))
+
+    def testMultiRunFileWithSkip(self):
+        self.checkShards([30], [0, 7, 15, 22], 5, 0, range(5, 30))
+
+    def testMultiRunFileWithMaxRecordNumber(self):
+        # 20 records from the start : 3 run headers (before events 0, 7, 15) and 17 events
+        self.checkShards([30], [0, 7, 15, 22], 0, 20, range(17))
+
+    def testMultiRunFilesWithWindow(self):
+        # after skipping 6 events : run headers before events 7, 12 and 15 are read
+        self.checkShards([12, 18], [0, 7, 12, 15, 22], 6, 15, range(6, 18))
+
+    def testWindowEndEvent(self):
+        self.assertEqual(Marlin._windowEndEvent([0, 7], 0, 8, 10), 7)
+        self.assertEqual(Marlin._windowEndEvent([0, 7], 0, 9, 10), 7)
+        self.assertEqual(Marlin._windowEndEvent([0, 7], 0, 10, 10), 8)
+        self.assertEqual(Marlin._windowEndEvent([0, 7], 3, 0, 10), 10)
+
+    def testShardIndexOrder(self):
+        files = ["checkpoint_shard{0}.slcio".format(index) for index in [10, 2, 1, 0, 11]]
+        self.assertEqual(sorted(files, key=Marlin._shardIndex),
+            ["checkpoint_shard0.slcio", "checkpoint_shard1.slcio", "checkpoint_shard2.slcio", "checkpoint_shard10.slcio", "checkpoint_shard11.slcio"])
+        self.assertEqual(Marlin._shardIndex("checkpoint.slcio"), -1)
+
+    def testAIDAShardFiles(self):
+        directory = tempfile.mkdtemp()
+        try:
+            steeringFile = os.path.join(directory, "steering.xml")
+            with open(steeringFile, "w") as f:
+                f.write("""<marlin>
+  <execute><processor name="MyAIDAProcessor"/></execute>
+  <global><parameter name="LCIOInputFiles"> </parameter></global>
+  <processor name="MyAIDAProcessor" type="AIDAProcessor">
+    <parameter name="FileName" type="string">/data/run/histograms</parameter>
+    <parameter name="FileType" type="string">root</parameter>
+  </processor>
+</marlin>""")
+            marlin = Marlin(steeringFile)
+            shardRootFiles = {}
+            for shardId in range(2):
+                shardXML = marlin._marlinXML.clone()
+                marlin._setAIDAShardFile(shardXML, "MyAIDAProcessor", shardId, shardRootFiles)
+                self.assertEqual(shardXML.getProcessorParameter("MyAIDAProcessor", "FileName").strip(), "/data/run/histograms_shard{0}".format(shardId))
+            # the shard files are merged in the configured output file
+            self.assertEqual(shardRootFiles, {"/data/run/histograms.root" : ["/data/run/histograms_shard0.root", "/data/run/histograms_shard1.root"]})
+        finally:
+            shutil.rmtree(directory)
+
+""" Read the run headers positions of a multi-run lcio file written with pyLCIO
+"""
+class MarlinRunHeadersTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            from pyLCIO import IOIMPL, EVENT
+        except ImportError:
+            self.skipTest("pyLCIO not available")
+        self.directory = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.directory, "multirun.slcio")
+        writer = IOIMPL.LCFactory.getInstance().createLCWriter()
+        writer.open(self.fileName, EVENT.LCIO.WRITE_NEW)
+        for runNumber, nEvents in enumerate([3, 5, 2]):
+            run = IOIMPL.LCRunHeaderIOImpl()
+            run.setRunNumber(runNumber)
+            writer.writeRunHeader(run)
+            for eventNumber in range(nEvents):
+                event = IOIMPL.LCEventIOImpl()
+                event.setRunNumber(runNumber)
+                event.setEventNumber(eventNumber)
+                writer.writeEvent(event)
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRunHeaders(self):
+        marlin = Marlin()
+        self.assertEqual(marlin._getRunHeaders([self.fileName, self.fileName], [10, 10]), [0, 3, 8, 10, 13, 18])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import unittest
+from calibration.MarlinXML import MarlinXML
+
+steering = """<marlin>
+  <execute>
+    <processor name="MyEcalDigi"/>
+    <processor name="MyPandora"/>
+    <processor name="MyEcalDigiMonitor"/>
+    <processor name="MyPfoAnalysis"/>
+  </execute>
+  <global>
+    <parameter name="LCIOInputFiles"> </parameter>
+  </global>
+  <processor name="MyEcalDigi" type="ILDCaloDigi">
+    <parameter name="ECALCollections" type="StringVec">EcalBarrelCollection</parameter>
+    <parameter name="ECALOutputCollection0" type="stringVec">ECALBarrel</parameter>
+    <parameter name="RelationOutputCollection" type="string">RelationCaloHit</parameter>
+    <parameter name="CalibrECAL" type="FloatVec">40 80</parameter>
+  </processor>
+  <processor name="MyPandora" type="DDPandoraPFANewProcessor">
+    <parameter name="ECalCaloHitCollections" type="StringVec">ECALBarrel</parameter>
+    <parameter name="RelCaloHitCollections" type="StringVec">RelationCaloHit</parameter>
+    <parameter name="PFOCollectionName" type="string">PandoraPFOs</parameter>
+    <parameter name="ClusterCollectionName" type="string">PandoraClusters</parameter>
+  </processor>
+  <processor name="MyEcalDigiMonitor" type="SomeMonitor">
+    <parameter name="InputCollection" type="string">ECALBarrel</parameter>
+  </processor>
+  <processor name="MyPfoAnalysis" type="PfoAnalysis">
+    <parameter name="PfoCollection" type="string">PandoraPFOs</parameter>
+    <parameter name="RootFile" type="string">pfoAnalysis.root</parameter>
+  </processor>
+</marlin>
+"""
+
+class MarlinXMLCloneTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.steeringFile = os.path.join(self.directory, "steering.xml")
+        with open(self.steeringFile, "w") as f:
+            f.write(steering)
+        self.marlinXML = MarlinXML(self.steeringFile)
+        self.marlinXML.loadSteeringFile()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testDeclaredOutputCollections(self):
+        self.assertEqual(self.marlinXML.getProcessorCollections("MyEcalDigi"), (["EcalBarrelCollection"], ["ECALBarrel", "RelationCaloHit"]))
+        self.assertEqual(sorted(self.marlinXML.getProcessorCollections("MyPandora")[1]), ["PandoraClusters", "PandoraPFOs"])
+
+    def testCloneChain(self):
+        chain = ["MyEcalDigi", "MyPandora", "MyPfoAnalysis"]
+        clones = self.marlinXML.cloneProcessorChain(chain, "_bracket0")
+        self.marlinXML.cloneProcessorChain(chain, "_bracket1")
+        # the clones run after the chain and its previous clones, not after the processors sharing a name prefix
+        self.assertEqual(self.marlinXML.getExecuteProcessors(), ["MyEcalDigi", "MyPandora", "MyEcalDigiMonitor", "MyPfoAnalysis",
+            "MyEcalDigi_bracket0", "MyPandora_bracket0", "MyPfoAnalysis_bracket0",
+            "MyEcalDigi_bracket1", "MyPandora_bracket1", "MyPfoAnalysis_bracket1"])
+        self.assertEqual(self.marlinXML.getProcessorCollections(clones["MyPandora"]),
+            (["ECALBarrel_bracket0", "RelationCaloHit_bracket0"], ["PandoraPFOs_bracket0", "PandoraClusters_bracket0"]))
+        self.assertEqual(self.marlinXML.getProcessorParameter(clones["MyPfoAnalysis"], "PfoCollection").strip(), "PandoraPFOs_bracket0")
+        self.assertEqual(self.marlinXML.getProcessorParameter(clones["MyPfoAnalysis"], "RootFile").strip(), "pfoAnalysis_bracket0.root")
+        self.assertEqual(self.marlinXML.getProcessorParameter(clones["MyEcalDigi"], "CalibrECAL").strip(), "40 80")
+
+    def testCloneUndeclaredProcessor(self):
+        self.assertRaises(RuntimeError, self.marlinXML.cloneProcessorChain, ["MyEcalDigiMonitor"], "_bracket0")
+
+class MarlinXMLSharedTemplateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.steeringFile = os.path.join(self.directory, "steering.xml")
+        with open(self.steeringFile, "w") as f:
+            f.write(steering)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        MarlinXML.clearTemplates()
+
+    def load(self):
+        marlinXML = MarlinXML(self.steeringFile)
+        marlinXML.loadSteeringFile()
+        return marlinXML
+
+    def testTurnOffKeepsTemplateShared(self):
+        marlinXML, other = self.load(), self.load()
+        marlinXML.setProcessorParameter("MyEcalDigi", "CalibrECAL", "50 100")
+        marlinXML.turnOffProcessors(["MyEcalDigiMonitor"])
+
+        # only the <execute> element is private, the processor definitions are still shared
+        self.assertTrue(marlinXML._shared)
+        self.assertTrue(marlinXML._xmlTree is other._xmlTree)
+        self.assertEqual(marlinXML.getExecuteProcessors(), ["MyEcalDigi", "MyPandora", "MyPfoAnalysis"])
+        self.assertEqual(other.getExecuteProcessors(), ["MyEcalDigi", "MyPandora", "MyEcalDigiMonitor", "MyPfoAnalysis"])
+
+        clone = marlinXML.clone()
+        clone.turnOffProcessorsExcept(["MyEcalDigi"])
+        self.assertEqual(marlinXML.getExecuteProcessors(), ["MyEcalDigi", "MyPandora", "MyPfoAnalysis"])
+
+        # the written steering file holds the private <execute> element and parameter values
+        fileName = os.path.join(self.directory, "written.xml")
+        marlinXML.write(fileName)
+        written = MarlinXML(fileName)
+        written.loadSteeringFile()
+        self.assertEqual(written.getExecuteProcessors(), ["MyEcalDigi", "MyPandora", "MyPfoAnalysis"])
+        self.assertEqual(written.getProcessorParameter("MyEcalDigi", "CalibrECAL").strip(), "50 100")
+
+        # a modification of the processor definitions copies the tree with the private <execute> element
+        marlinXML.insertProcessor("MyMonitor", "SomeMonitor", {}, "MyPfoAnalysis")
+        self.assertFalse(marlinXML._shared)
+        self.assertEqual(marlinXML.getExecuteProcessors(), ["MyEcalDigi", "MyPandora", "MyMonitor", "MyPfoAnalysis"])
+        self.assertEqual(other.getExecuteProcessors(), ["MyEcalDigi", "MyPandora", "MyEcalDigiMonitor", "MyPfoAnalysis"])
+
+groupSteering = """<marlin>
+  <execute>
+    <processor name="MyInit"/>
+    <group name="Reconstruction"/>
+  </execute>
+  <global>
+    <parameter name="LCIOInputFiles"> </parameter>
+  </global>
+  <processor name="MyInit" type="InitializeDD4hep"/>
+  <group name="Reconstruction">
+    <parameter name="Verbosity" type="string">MESSAGE</parameter>
+    <processor name="MyEcalDigi" type="ILDCaloDigi"/>
+    <processor name="MyPandora" type="DDPandoraPFANewProcessor"/>
+  </group>
+</marlin>
+"""
+
+class MarlinXMLGroupTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.steeringFile = os.path.join(self.directory, "steering.xml")
+        with open(self.steeringFile, "w") as f:
+            f.write(groupSteering)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        MarlinXML.clearTemplates()
+
+    def testGroupsExpandedAtLoad(self):
+        marlinXML = MarlinXML(self.steeringFile)
+        marlinXML.loadSteeringFile()
+        template = marlinXML.toCanonicalString()
+        self.assertEqual(marlinXML.getExecuteProcessors(), ["MyInit", "MyEcalDigi", "MyPandora"])
+        # reading the processors doesn't modify the tree
+        self.assertEqual(marlinXML.toCanonicalString(), template)
+        self.assertEqual(marlinXML._getExecuteElement().findall("group"), [])
+
+if __name__ == "__main__":
+    unittest.main()
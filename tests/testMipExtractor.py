@@ -0,0 +1,149 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy
+from calibration.Marlin import Marlin
+from calibration.MipExtractor import MipExtractor, _directionCorrection
+from calibration.MipScaleStep import SplitDigiMipScaleStep, ILDCaloDigiMipScaleStep
+from calibration.PandoraAnalysis import MipCalibrator
+
+steering = """<marlin>
+  <execute>
+    <processor name="ECalBarrelDigi"/>
+    <processor name="ECalEndcapDigi"/>
+    <processor name="HCalBarrelDigi"/>
+    <processor name="HCalEndcapDigi"/>
+  </execute>
+  <global>
+    <parameter name="LCIOInputFiles"> </parameter>
+  </global>
+  <processor name="ECalBarrelDigi" type="RealisticCaloDigiSilicon">
+    <parameter name="inputHitCollections" type="StringVec">ECalBarrelCollection</parameter>
+    <parameter name="outputHitCollections" type="StringVec">ECalBarrelDigiHits</parameter>
+    <parameter name="outputRelationCollections" type="StringVec">ECalBarrelRelations</parameter>
+    <parameter name="calibration_mip" type="float">0.0001</parameter>
+  </processor>
+  <processor name="ECalEndcapDigi" type="RealisticCaloDigiSilicon">
+    <parameter name="inputHitCollections" type="StringVec">ECalEndcapCollection</parameter>
+    <parameter name="outputHitCollections" type="StringVec">ECalEndcapDigiHits</parameter>
+    <parameter name="outputRelationCollections" type="StringVec">ECalEndcapRelations</parameter>
+  </processor>
+  <processor name="HCalBarrelDigi" type="RealisticCaloDigiScinPpd">
+    <parameter name="inputHitCollections" type="StringVec">HCalBarrelCollection</parameter>
+    <parameter name="outputHitCollections" type="StringVec">HCalBarrelDigiHits</parameter>
+    <parameter name="outputRelationCollections" type="StringVec">HCalBarrelRelations</parameter>
+  </processor>
+  <processor name="HCalEndcapDigi" type="RealisticCaloDigiScinPpd">
+    <parameter name="inputHitCollections" type="StringVec">HCalEndcapCollection</parameter>
+    <parameter name="outputHitCollections" type="StringVec">HCalEndcapDigiHits</parameter>
+    <parameter name="outputRelationCollections" type="StringVec">HCalEndcapRelations</parameter>
+  </processor>
+</marlin>
+"""
+
+class MipExtractorTest(unittest.TestCase):
+    def histogram(self, energies):
+        extractor = MipExtractor()
+        binEdges = numpy.logspace(numpy.log10(extractor._minEnergy), numpy.log10(extractor._maxEnergy), extractor._nBins+1)
+        return extractor, numpy.histogram(energies, bins=binEdges)[0], binEdges
+
+    def testFindPeak(self):
+        random = numpy.random.RandomState(1234)
+        # landau like mip peak (most probable value 150 keV) over a larger number of low energy hits
+        for mip in [1.5e-4, 8e-4, 5e-6]:
+            energies = numpy.concatenate([random.gumbel(mip, 0.08*mip, 200000), random.exponential(0.05*mip, 400000)])
+            extractor, histogram, binEdges = self.histogram(energies[energies > 0.])
+            self.assertAlmostEqual(extractor._findPeak(numpy, histogram, binEdges) / mip, 1., delta=0.02)
+
+    def testEmptyHistogram(self):
+        extractor, histogram, binEdges = self.histogram([])
+        self.assertRaises(RuntimeError, extractor._findPeak, numpy, histogram, binEdges)
+
+    def testDirectionCorrection(self):
+        self.assertAlmostEqual(_directionCorrection([3., 4., 0.], True), 1.)
+        self.assertAlmostEqual(_directionCorrection([3., 0., 4.], True), 0.6)
+        self.assertAlmostEqual(_directionCorrection([3., 0., -4.], False), 0.8)
+        self.assertAlmostEqual(_directionCorrection([0., 0., 0.], False), 1.)
+
+class MipScaleStepCollectionsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        steeringFile = os.path.join(self.directory, "steering.xml")
+        with open(steeringFile, "w") as f:
+            f.write(steering)
+        self.marlin = Marlin(steeringFile)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def createStep(self, stepClass):
+        step = stepClass()
+        step._marlin = self.marlin
+        return step
+
+    def testDigitizerCollections(self):
+        step = self.createStep(SplitDigiMipScaleStep)
+        step.setEcalDigiNames("ECalBarrelDigi", "ECalEndcapDigi", None)
+        step.setHcalDigiNames("HCalBarrelDigi", "HCalEndcapDigi", None)
+        self.assertEqual(step._getSimCaloHitCollections(), {
+            "ECal" : (["ECalBarrelCollection"], ["ECalEndcapCollection"]),
+            "HCalBarrel" : (["HCalBarrelCollection"], []),
+            "HCalEndcap" : ([], ["HCalEndcapCollection"])})
+
+        # explicit collections
+        step.setSimCaloHitCollections({"ECal" : (["A"], ["B"])})
+        self.assertEqual(step._getSimCaloHitCollections(), {"ECal" : (["A"], ["B"])})
+
+    def testNativeFallback(self):
+        # unknown digitizer
+        step = self.createStep(SplitDigiMipScaleStep)
+        calibrator = MipCalibrator()
+        calibrator.setBackend("native")
+        self.assertFalse(step._runNativeMipCalibrator(calibrator))
+
+        # the hcal input collections of the ILDCaloDigi processor aren't split in barrel, endcap and ring
+        step = self.createStep(ILDCaloDigiMipScaleStep)
+        self.assertFalse(step._runNativeMipCalibrator(calibrator))
+
+    def testAutoBackend(self):
+        calibrator = MipCalibrator()
+        calibrator.setBackend("auto")
+        self.assertFalse(calibrator.usesNativeBackend())
+
+""" Compare the native and binary mip values on a reference muon sample :
+     - CALIBRATION_REFERENCE_MUON_LCIO_FILE : lcio file of the muon sample (native backend)
+     - CALIBRATION_REFERENCE_MUON_ROOT_FILE : PfoAnalysis root file of the same sample (binary)
+     - CALIBRATION_REFERENCE_MUON_COLLECTIONS : json dictionary subdetector -> [barrel collections, endcap collections]
+    The relative difference of the mip values must be below CALIBRATION_BACKEND_TOLERANCE (default 0.005).
+    Requires PANDORA_ANALYSIS_DIR, numpy and pyLCIO
+"""
+class MipBackendsTest(unittest.TestCase):
+    def testReferenceSample(self):
+        variables = ["CALIBRATION_REFERENCE_MUON_LCIO_FILE", "CALIBRATION_REFERENCE_MUON_ROOT_FILE", "CALIBRATION_REFERENCE_MUON_COLLECTIONS"]
+        if not os.environ.get("PANDORA_ANALYSIS_DIR") or not all([os.environ.get(variable) for variable in variables]):
+            self.skipTest("PANDORA_ANALYSIS_DIR or {0} not set".format(", ".join(variables)))
+        if not MipExtractor.isAvailable():
+            self.skipTest("native backend not available (numpy and pyLCIO)")
+
+        tolerance = float(os.environ.get("CALIBRATION_BACKEND_TOLERANCE", 0.005))
+        mips = {}
+
+        for backend in ["binary", "native"]:
+            calibrator = MipCalibrator()
+            calibrator.setBackend(backend)
+            calibrator.setResultCache(None)
+            calibrator.setRootFile(os.environ["CALIBRATION_REFERENCE_MUON_ROOT_FILE"])
+            calibrator.setLcioFiles([os.environ["CALIBRATION_REFERENCE_MUON_LCIO_FILE"]])
+            calibrator.setSimCaloHitCollections(json.loads(os.environ["CALIBRATION_REFERENCE_MUON_COLLECTIONS"]))
+            calibrator.run()
+            mips[backend] = calibrator
+
+        for getter in ["getEcalMip", "getHcalBarrelMip", "getHcalEndcapMip", "getHcalRingMip"]:
+            native, binary = getattr(mips["native"], getter)(), getattr(mips["binary"], getter)()
+            if native:
+                self.assertTrue(abs(1. - native / binary) < tolerance, "{0}: native {1}, binary {2}".format(getter, native, binary))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from lxml import etree
+from calibration.StepScheduler import StepScheduler
+from calibration.PandoraSoftCompStep import PandoraSoftCompStep
+
+""" Calibrator returning fixed weights, in place of the minimizer
+"""
+class FixedWeightsCalibrator(object):
+    def __init__(self, weights):
+        self.weights = weights
+        self.initialWeights = None
+
+    def setInitialWeights(self, weights):
+        self.initialWeights = weights
+
+    def run(self):
+        pass
+
+    def getSoftCompWeights(self):
+        return self.weights
+
+    def usesNativeBackend(self):
+        return False
+
+class PandoraSoftCompStepTest(unittest.TestCase):
+    def createStep(self, weights):
+        step = PandoraSoftCompStep()
+        step._runMarlin = False
+        step._runMinimizer = True
+        step._calibrator = FixedWeightsCalibrator(weights)
+        return step
+
+    def readWeights(self, config):
+        elements = config.xpath("//step[@name='PandoraSoftComp']/output/parameter[@name='SoftwareCompensationWeights']")
+        self.assertEqual(len(elements), 1)
+        return [float(w) for w in elements[0].text.split()]
+
+    def testWriteWeights(self):
+        config = etree.ElementTree(etree.fromstring("<calibration><input/></calibration>"))
+        weights = [float(i) for i in range(1, 10)]
+        StepScheduler([self.createStep(weights)], 1).run(config)
+        self.assertEqual(self.readWeights(config), weights)
+
+        # a new run starts from the weights of the previous one and replaces them
+        newWeights = [w + 0.5 for w in weights]
+        step = self.createStep(newWeights)
+        StepScheduler([step], 1).run(config)
+        self.assertEqual([float(w) for w in step._calibrator.initialWeights], weights)
+        self.assertEqual(self.readWeights(config), newWeights)
+
+if __name__ == "__main__":
+    unittest.main()
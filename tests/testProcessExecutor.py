@@ -0,0 +1,55 @@
+import os
+import time
+import threading
+import unittest
+from calibration.ProcessExecutor import ProcessExecutor
+
+class ProcessExecutorTest(unittest.TestCase):
+    def testReturnCodes(self):
+        executor = ProcessExecutor(2)
+        jobs = [executor.submit(["true"]), executor.submit(["false"]), executor.submit(["sh", "-c", "exit 3"])]
+        executor.wait(jobs)
+        self.assertEqual([job.returnCode() for job in jobs], [0, 1, 3])
+        self.assertEqual([job.succeeded() for job in jobs], [True, False, False])
+
+    def testWaitAny(self):
+        executor = ProcessExecutor(2)
+        slow = executor.submit(["sleep", "1"])
+        fast = executor.submit(["true"])
+        self.assertTrue(executor.waitAny([slow, fast]) is fast)
+        executor.wait([slow])
+
+    def testForeignChildrenNotReaped(self):
+        # a child process not started by the executor must be left to its owner
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(0.2)
+            os._exit(5)
+        executor = ProcessExecutor(1)
+        executor.run(["sleep", "0.5"])
+        endedPid, status = os.waitpid(pid, 0)
+        self.assertEqual(endedPid, pid)
+        self.assertEqual(os.WEXITSTATUS(status), 5)
+
+    def testWakeUpOnJobEnd(self):
+        # the waiting threads are woken up by the job end, not by a polling interval
+        executor = ProcessExecutor(4)
+        jobs = [executor.submit(["sleep", "0.3"]) for i in range(3)]
+        startTime = time.time()
+        executor.wait(jobs)
+        self.assertTrue(time.time() - startTime < 0.45)
+
+    def testConcurrentWaits(self):
+        executor = ProcessExecutor(2)
+        results = []
+        def runJob(code):
+            results.append(executor.run(["sh", "-c", "sleep 0.1; exit {0}".format(code)]).returnCode())
+        threads = [threading.Thread(target=runJob, args=(code,)) for code in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), range(4))
+
+if __name__ == "__main__":
+    unittest.main()
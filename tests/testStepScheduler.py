@@ -0,0 +1,52 @@
+import time
+import threading
+import unittest
+from lxml import etree
+from calibration.CalibrationStep import CalibrationStep
+from calibration.StepScheduler import StepScheduler
+
+""" Step recording the steps running at the same time
+"""
+class RecordingStep(CalibrationStep):
+    lock = threading.Lock()
+    running = set()
+    overlaps = {}
+
+    def __init__(self, name, processPool=False):
+        CalibrationStep.__init__(self, name)
+        self._processPool = processPool
+        self.setDependencies([])
+
+    def usesProcessPool(self):
+        return self._processPool
+
+    def run(self, config):
+        with RecordingStep.lock:
+            RecordingStep.running.add(self.name())
+            for name in RecordingStep.running:
+                RecordingStep.overlaps.setdefault(name, set()).update(RecordingStep.running - set([name]))
+        time.sleep(0.05)
+        with RecordingStep.lock:
+            RecordingStep.running.remove(self.name())
+
+    def writeOutput(self, config):
+        self._getXMLStepOutput(config, create=True)
+
+class StepSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        RecordingStep.running = set()
+        RecordingStep.overlaps = {}
+
+    def testProcessPoolStepsRunAlone(self):
+        steps = [RecordingStep("A"), RecordingStep("B"), RecordingStep("Pool", True), RecordingStep("C"), RecordingStep("D")]
+        config = etree.ElementTree(etree.fromstring("<calibration><input/></calibration>"))
+        StepScheduler(steps, 4).run(config)
+
+        self.assertEqual(RecordingStep.overlaps.get("Pool", set()), set())
+        # the independent steps still run concurrently
+        self.assertTrue("B" in RecordingStep.overlaps.get("A", set()))
+        self.assertTrue("D" in RecordingStep.overlaps.get("C", set()))
+        self.assertEqual([element.get("name") for element in config.xpath("//step")], ["A", "B", "Pool", "C", "D"])
+
+if __name__ == "__main__":
+    unittest.main()
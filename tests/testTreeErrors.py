@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from calibration.PfoAnalysisTree import PfoAnalysisTree, windowMean
+from calibration.PandoraAnalysis import PandoraEMScaleCalibrator
+
+dataDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "calibration")
+
+class TreeErrorsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.isAvailable = PfoAnalysisTree.isAvailable
+        PfoAnalysisTree.clearCache()
+
+    def tearDown(self):
+        PfoAnalysisTree.isAvailable = self.isAvailable
+        PfoAnalysisTree.clearCache()
+        shutil.rmtree(self.directory)
+
+    """ Write a fake root file and the column cache of its branches, read instead of the root file
+    """
+    def writeColumns(self, columns):
+        rootFile = os.path.join(self.directory, "PfoAnalysis.root")
+        with open(rootFile, "w") as f:
+            f.write("not a root file")
+        path = os.path.realpath(rootFile)
+        PfoAnalysisTree(rootFile)._storeCachedColumns(path, os.stat(path), columns)
+        return rootFile
+
+    def testWindowMean(self):
+        values = numpy.concatenate([numpy.linspace(9., 11., 90), [100.]*10])
+        mean, error, nValues = windowMean(values)
+        self.assertEqual(nValues, 90)
+        self.assertAlmostEqual(mean, 10.)
+        self.assertAlmostEqual(error, numpy.std(values[:90]) / numpy.sqrt(90.))
+
+    def testBinaryBackendError(self):
+        random = numpy.random.RandomState(2)
+        ecal = random.normal(9.5, 0.4, 1000)
+        rootFile = self.writeColumns({"pfoECalToEmEnergy" : ecal, "pfoHCalToEmEnergy" : numpy.full(1000, 0.5)})
+
+        calibrator = PandoraEMScaleCalibrator()
+        calibrator.setRootFile(rootFile)
+        calibrator._calibrationFile = os.path.join(dataDirectory, "PandoraPFACalibrate_EMScale_Calibration.txt")
+
+        # the root file can't be read : no error
+        PfoAnalysisTree.isAvailable = staticmethod(lambda: False)
+        calibrator._readOutputs()
+        self.assertEqual(calibrator.getEcalToEMMean(), 9.95816)
+        self.assertEqual(calibrator.getEcalToEMMeanError(), None)
+
+        PfoAnalysisTree.isAvailable = staticmethod(lambda: True)
+        calibrator._readOutputs()
+        self.assertEqual(calibrator.getEcalToEMMeanError(), windowMean(ecal + 0.5)[1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+import unittest
+from calibration.Workspace import Workspace
+
+class WorkspaceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def createFiles(self, workspace):
+        fileNames = [workspace.path("gear_0123_compact.xml"), workspace.path("PfoAnalysis.root", "EcalEnergy", 0), 
+            workspace.path("ECalDigitisation_ContainedEvents_1_0_Calibration.txt", "EcalEnergy", 0)]
+        for fileName in fileNames + [workspace.scratchPath("marlin.xml")]:
+            open(fileName, "w").close()
+        return fileNames
+
+    def testKeepAll(self):
+        workspace = Workspace(self.directory, self.directory)
+        fileNames = self.createFiles(workspace)
+        scratchDirectory = workspace.scratchDirectory()
+        workspace.cleanup()
+        self.assertTrue(all([os.path.isfile(fileName) for fileName in fileNames]))
+        self.assertFalse(os.path.exists(scratchDirectory))
+
+    def testKeepPatterns(self):
+        workspace = Workspace(self.directory, self.directory)
+        workspace.setKeepPatterns(["*.root"])
+        gearFile, rootFile, calibrationFile = self.createFiles(workspace)
+        workspace.cleanup()
+        self.assertTrue(os.path.isfile(rootFile))
+        self.assertFalse(os.path.exists(gearFile))
+        self.assertFalse(os.path.exists(calibrationFile))
+
+if __name__ == "__main__":
+    unittest.main()